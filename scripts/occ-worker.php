@@ -0,0 +1,68 @@
+<?php
+//
+// Persistent occ worker used by the charm (see OccSession in src/occ.py).
+//
+// Bootstraps Nextcloud once and then runs one occ command per request line
+// read from stdin, answering each with exactly one JSON line on stdout:
+//
+//   request:  {"id": 1, "argv": ["status", "--output=json"]}
+//   response: {"id": 1, "returncode": 0, "stdout": "{...}"}
+//
+// Usage: sudo -u www-data php -r "<this file>" -- /var/www/nextcloud
+//
+use Symfony\Component\Console\Input\ArgvInput;
+use Symfony\Component\Console\Output\BufferedOutput;
+use Symfony\Component\Console\Output\ConsoleOutput;
+use Symfony\Component\Console\Output\OutputInterface;
+
+$root = $argv[1] ?? '/var/www/nextcloud';
+chdir($root);
+// Anything PHP prints on its own must not end up in the protocol stream.
+ini_set('display_errors', 'stderr');
+
+require_once $root . '/lib/base.php';
+
+$application = \OCP\Server::get(\OC\Console\Application::class);
+$application->loadCommands(new ArgvInput(['occ']),
+                           new ConsoleOutput(OutputInterface::VERBOSITY_QUIET));
+
+// The wrapped Symfony application calls exit() after a command by default.
+$inner = new ReflectionProperty(\OC\Console\Application::class, 'application');
+$inner->setAccessible(true);
+$inner->getValue($application)->setAutoExit(false);
+
+$reply = function (array $response) {
+    fwrite(STDOUT, json_encode($response, JSON_INVALID_UTF8_SUBSTITUTE) . "\n");
+    fflush(STDOUT);
+};
+
+$reply(['ready' => true]);
+
+while (($line = fgets(STDIN)) !== false) {
+    $request = json_decode($line, true);
+    if (!is_array($request) || !isset($request['argv']) || !is_array($request['argv'])) {
+        $reply(['id' => null, 'returncode' => 1, 'stdout' => 'Malformed request']);
+        continue;
+    }
+    $args = array_merge(['occ'], $request['argv']);
+    // stdin is the request pipe, never let a command prompt on it.
+    if (!in_array('--no-interaction', $args, true) && !in_array('-n', $args, true)) {
+        $args[] = '--no-interaction';
+    }
+
+    $output = new BufferedOutput();
+    ob_start();
+    try {
+        $returncode = $application->run(new ArgvInput($args), $output);
+    } catch (\Throwable $e) {
+        $returncode = 1;
+        $output->writeln(get_class($e) . ': ' . $e->getMessage());
+    }
+    $stray = ob_get_clean();
+
+    $reply([
+        'id' => $request['id'] ?? null,
+        'returncode' => (int)$returncode,
+        'stdout' => $stray . $output->fetch(),
+    ]);
+}
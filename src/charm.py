@@ -19,12 +19,21 @@ from ops.model import (
     BlockedStatus,
     MaintenanceStatus,
     WaitingStatus,
-    ModelError
+    ModelError,
+    SecretNotFoundError
 )
 import tarfile
 import utils
+import templating
 import emojis
-from occ import Occ
+from occ import Occ, OccSession, VALID_PHONE_REGIONS
+from release_cache import ReleaseCache
+import tuning
+import hostfacts
+import reconcile
+import config_drift
+import peer_payload
+import profiler
 from interface_http import HttpProvider
 import interface_redis
 import interface_mount
@@ -37,13 +46,24 @@ logger = logging.getLogger(__name__)
 NEXTCLOUD_ROOT = os.path.abspath('/var/www/nextcloud')
 NEXTCLOUD_CONFIG_PHP = os.path.abspath('/var/www/nextcloud/config/config.php')
 NEXTCLOUD_CEPH_CONFIG_PHP = os.path.join(NEXTCLOUD_ROOT, 'config/ceph.config.php')
+# Config files the leader shares with the peers, by their name in the payload.
+SHARED_CONFIG_FILES = {
+    'config.php': NEXTCLOUD_CONFIG_PHP,
+    'ceph.config.php': NEXTCLOUD_CEPH_CONFIG_PHP,
+}
+# The Juju secret holding the values kept out of the shared config payload.
+CONFIG_SECRET_LABEL = 'shared-config'
 
 
+@profiler.instrument_handlers
 class NextcloudCharm(CharmBase):
     _stored = StoredState()
 
     def __init__(self, *args):
         super().__init__(*args)
+        profiler.enable(self._hook_profiling())
+        # Nextcloud's status, probed at most once per hook, see _nextcloud_status().
+        self._status = None
         # Postgres
         self.database = DatabaseRequires(self, relation_name="database", database_name="nextcloud")
         # Haproxy
@@ -60,21 +80,26 @@ class NextcloudCharm(CharmBase):
                                  php_configured=False,
                                  ceph_configured=False,
                                  config_altered_on_disk=False,
-                                 redis_info=dict())
+                                 redis_info=dict(),
+                                 reconciled=dict(),
+                                 file_digests=dict(),
+                                 peer_config_applied=dict(),
+                                 config_secret_applied=dict())
 
         event_bindings = {
             self.on.install: self._on_install,
             self.on.config_changed: self._on_config_changed,
+            self.on.upgrade_charm: self._on_upgrade_charm,
             self.on.start: self._on_start,
             self.on.leader_elected: self._on_leader_elected,
             self.database.on.database_created: self._on_database_created,
 #            self.database.on.endpoints_changed: self._on_database_created,
             self.redis.on.redis_available: self._on_redis_available,
             self.redis.on.redis_broken: self._on_redis_broken,
-            self.on.update_status: self._on_update_status,
-            self.on.cluster_relation_changed: self._on_cluster_relation_changed,
-            self.on.cluster_relation_joined: self._on_cluster_relation_joined,
-            self.on.cluster_relation_departed: self._on_cluster_relation_departed,
+            self.on.update_status: self._on_update_status_hook,
+            self.on.cluster_relation_changed: self._on_cluster_relation_event,
+            self.on.cluster_relation_joined: self._on_cluster_relation_event,
+            self.on.cluster_relation_departed: self._on_cluster_relation_event,
             self.on.cluster_relation_broken: self._on_cluster_relation_broken,
             self.on.ceph_relation_changed: self._on_ceph_relation_changed,
             self.on.datadir_storage_attached: self._on_datadir_storage_attached,
@@ -95,6 +120,10 @@ class NextcloudCharm(CharmBase):
             self.on.maintenance_action: self._on_maintenance_action,
             self.on.set_trusted_domain_action: self._on_set_trusted_domain_action,
             self.on.get_admin_password_action: self._on_get_admin_password_action,
+            self.on.seed_cache_action: self._on_seed_cache_action,
+            self.on.opcache_reset_action: self._on_opcache_reset_action,
+            self.on.hook_profile_action: self._on_hook_profile_action,
+            self.on.config_drift_action: self._on_config_drift_action,
         }
 
         for action, handler in action_bindings.items():
@@ -114,10 +143,16 @@ class NextcloudCharm(CharmBase):
             # Try local resource install
             try:
                 tarfile_path = self.model.resources.fetch('nextcloud-tarfile')
-                if tarfile.is_tarfile(tarfile_path):
-                    logger.info("Resource is a tarfile.")
-                    utils.extract_nextcloud(tarfile_path)
+                codec = utils.detect_tar_codec(tarfile_path)
+                if codec:
+                    logger.info(f"Resource is a tarfile ({codec}).")
+                    cache = self._release_cache()
+                    if cache:
+                        cache.install(cache.add_file(tarfile_path))
+                    else:
+                        utils.extract_nextcloud(tarfile_path)
                     utils.set_nextcloud_permissions(self)
+                    self._reset_opcache()
                     self.unit.status = MaintenanceStatus("Nextcloud extracted from supplied tarfile.")
                     self._stored.nextcloud_fetched = True
                     return
@@ -134,91 +169,279 @@ class NextcloudCharm(CharmBase):
             # Try network install
             try:
                 self.unit.status = MaintenanceStatus("fetching nextcloud from network...")
-                utils.fetch_and_extract_nextcloud(self.config.get('nextcloud-tarfile'))
+                cache = self._release_cache()
+                if cache:
+                    cache.install(cache.add_url(self.config.get('nextcloud-tarfile'),
+                                                sha256=self.config.get('nextcloud-tarfile-sha256'),
+                                                progress=self._report_fetch_progress))
+                else:
+                    utils.fetch_and_extract_nextcloud(
+                        self.config.get('nextcloud-tarfile'),
+                        sha256=self.config.get('nextcloud-tarfile-sha256'),
+                        progress=self._report_fetch_progress)
                 utils.set_nextcloud_permissions(self)
+                self._reset_opcache()
                 self._stored.nextcloud_fetched = True
                 return
             except Exception as ex:
-                logger.error("Fetching nextcloud from network failed. Aborting: " + str(e))
+                logger.error("Fetching nextcloud from network failed. Aborting: " + str(ex))
                 raise SystemExit(1)
         else:
             logger.debug("Nextcloud already flagged as installed.")
             self.unit.status = MaintenanceStatus("Nextcloud already installed.")
-            
+
+    def _release_cache(self):
+        """
+        The machine local cache of nextcloud releases, or None if disabled by config.
+        """
+        max_size = utils.parse_size(self.config.get('release-cache-size') or 0)
+        return ReleaseCache(max_size=max_size) if max_size else None
+
+    def _report_fetch_progress(self, bytes_read, total):
+        """
+        Shows download progress of the nextcloud tarfile in the unit status.
+        """
+        if total:
+            msg = f"fetching nextcloud from network... {100 * bytes_read // total}%"
+        else:
+            msg = f"fetching nextcloud from network... {bytes_read // (1024 * 1024)}MB"
+        self.unit.status = MaintenanceStatus(msg)
 
     def updateClusterRelationData(self):
         """
         Trigger update of the cluster-relation data.
+        The leader shares config.php and ceph.config.php as one compressed
+        payload (see peer_payload) with its digest and a revision, which only
+        advances when the content changed; peers apply each revision once.
+        The database password, instance secret and S3 keys are kept out of
+        the payload and shared through a Juju secret, see _share_config_secret().
         """
-        if self.model.unit.is_leader() and self._stored.nextcloud_initialized:
-            logger.debug("Leader unit updating cluster relation data config.php from config.php")
-            cluster_rel = self.model.relations['cluster'][0]
-            with open(NEXTCLOUD_CONFIG_PHP) as f:
-                nextcloud_config = f.read()
-                cluster_rel.data[self.app]['nextcloud_config'] = str(nextcloud_config)
+        cluster_rel = self.model.get_relation('cluster')
+        if self.model.unit.is_leader() and self._stored.nextcloud_initialized and cluster_rel:
+            files = {}
+            for name, path in SHARED_CONFIG_FILES.items():
+                if os.path.exists(path):
+                    with open(path) as f:
+                        files[name] = f.read()
+            app_data = cluster_rel.data[self.app]
+            nextcloud_config_sha256 = config_drift.digest(files.get('config.php', ''))
+            secret_changed = False
+            if self.model.juju_version.has_secrets:
+                files, secrets = peer_payload.split_secrets(files)
+                secret_changed = self._share_config_secret(app_data, secrets)
+            payload, sha256 = peer_payload.encode(files)
+            if app_data.get('config_sha256') == sha256 and not secret_changed:
+                logger.debug("Shared config unchanged, not updating cluster relation data.")
+                return
+            revision = int(app_data.get('config_revision') or 0) + 1
+            logger.debug(f"Leader unit sharing config revision {revision}, {len(payload)} bytes.")
+            app_data['config_payload'] = payload
+            app_data['config_sha256'] = sha256
+            app_data['config_revision'] = str(revision)
+            # Lets every unit check for drift without decoding the payload.
+            app_data['nextcloud_config_sha256'] = nextcloud_config_sha256
+            # Shared as plain text before.
+            for key in ('nextcloud_config', 'ceph_config'):
+                if key in app_data:
+                    del app_data[key]
         else:
             logger.debug("Leader unit waiting for nextcloud before reading config.php")
 
     def _on_config_changed(self, event):
         """
-        Any configuration change trigger a complete reconfigure of
-        the php and apache and also a restart of apache.
-        
-        * All units reconfigure apache and php settings.
-        * Leader configure nextcloud
-        * All changes restarts apache.
-
-        :param event:
-        :return:
+        Any configuration change is reconciled, see reconcile().
+        Steps whose prerequisites are missing, e.g. an uninitialized
+        nextcloud, run from a later hook instead of deferring this one.
         """
         logger.debug(emojis.EMOJI_CORE_HOOK_EVENT + sys._getframe().f_code.co_name)
-        
-        # All units reconfigure apache and php settings.
-        self._config_apache()
-        self._config_php()
-        
-        # Leader configures nextcloud
-        if self.model.unit.is_leader():
-            logger.debug(f"Leader unit runs config_change event")
-        
-            if self._stored.nextcloud_initialized:
-                self._config_overwriteprotocol()
-                self._config_overwritecliurl()
-                self._config_default_phone_region()
-                self.updateClusterRelationData()
-                # Set self._stored.config_altered_on_disk = False after we have ran updateClusterRelationData
-                # So to be sure that it can be toggled again if other component changes needs to signal this.
-                self._stored.config_altered_on_disk = False
-            else:
-                logger.debug(f"Leader unit defering config change while waiting for database")
-                self.unit.status = BlockedStatus("Nextcloud not initialized. Missing postgresql?")
-                event.defer()
-                return
-        # Non leaders
+        self.reconcile(event)
+        # TODO: Need to refactor backup
+        # if self.config.get('backup-host') and self._stored.nextcloud_initialized \
+        #         and self._stored.database_available:
+        #     self.unit.status = MaintenanceStatus("Configuring backup")
+        #     utils.config_backup(self.config, self._stored.nextcloud_datadir, self._stored.dbhost,
+        #                         self._stored.dbuser, self._stored.dbpass)
+        self._on_update_status(event)
+
+    def reconcile(self, event=None):
+        """
+        Brings this unit to the state desired by config, relations and storage.
+        Every step runs only if its inputs changed since it last completed,
+        so this is cheap to call from any hook; see reconcile.run_steps().
+
+        * All units render apache, php and php-fpm config (web) and the
+          charm owned part of config.php (charm-php).
+        * Leader keeps trusted domains and proxies in sync with the
+          relations and shares config.php with the peers (cluster-data).
+        * Non leaders write the config shared by the leader (peer-config).
+
+        :param event: the hook's event, a departing unit is left out.
+        :return: list of (step, outcome, seconds)
+        """
+        departing = getattr(event, 'departing_unit', None)
+        steps = [
+            ('web', self._web_inputs, self._config_web),
+            ('charm-php', self._charm_php_inputs, self._config_charm_php),
+            ('trusted-domains', lambda: self._trusted_domains_inputs(departing),
+             lambda: self.update_config_php_trusted_domains(departing)),
+            ('trusted-proxies', lambda: self._trusted_proxies_inputs(departing),
+             lambda: utils.sync_trusted_proxies(self.haproxy.proxy_addresses(departing))),
+            ('cluster-data', self._cluster_data_inputs, self._update_cluster_data),
+            ('peer-config', self._peer_config_inputs, self._write_peer_config),
+        ]
+        return reconcile.run_steps(steps, self._stored.reconciled)
+
+    def _web_inputs(self):
+        """
+        What _config_web() depends on: the php, opcache and redis config,
+        the unit's cores and RAM and the installed php and apache modules.
+        """
+        cores, memory = tuning.host_resources()
+        return {
+            'config': {k: v for k, v in self.config.items()
+                       if k.startswith(('php', 'opcache-', 'redis-'))},
+            'cores': cores,
+            'memory': memory,
+            'extracted': os.path.isdir(os.path.join(NEXTCLOUD_ROOT, 'config')),
+            'php': hostfacts.php_version(),
+            'apache_modules': sorted(hostfacts.apache_modules()),
+            'memcache_local': interface_redis.memcache_local(),
+        }
+
+    def _charm_php_inputs(self):
+        if not os.path.isdir(os.path.join(NEXTCLOUD_ROOT, 'config')):
+            return None
+        return self._charm_system_config()
+
+    def _leader_ready(self):
+        """
+        True if this unit is the leader of an initialized nextcloud.
+        """
+        if not (self.model.unit.is_leader() and self._stored.nextcloud_initialized):
+            return False
+        cluster_rel = self.model.get_relation('cluster')
+        return cluster_rel is not None and os.path.exists(NEXTCLOUD_CONFIG_PHP)
+
+    def _trusted_domains_inputs(self, departing=None):
+        if not self._leader_ready():
+            return None
+        return sorted(self._peer_addresses(departing))
+
+    def _trusted_proxies_inputs(self, departing=None):
+        if not self._leader_ready():
+            return None
+        return sorted(self.haproxy.proxy_addresses(departing))
+
+    def _cluster_data_inputs(self):
+        if not self._leader_ready():
+            return None
+        return {'nextcloud_config': self._config_php_digest(),
+                'ceph_config': self._file_digest(NEXTCLOUD_CEPH_CONFIG_PHP)}
+
+    def _peer_config_inputs(self):
+        cluster_rel = self.model.get_relation('cluster')
+        if self.model.unit.is_leader() or cluster_rel is None:
+            return None
+        app_data = cluster_rel.data[self.app]
+        # A new revision is all that's needed, local changes are reported
+        # as drift instead of being overwritten on every hook.
+        return app_data.get('config_revision')
+
+    def _config_web(self):
+        """
+        Renders apache, php and php-fpm config and reloads what changed.
+        :return: the subsystems that changed.
+        """
+        runtime = self._php_runtime()
+        php_tuning = self._php_tuning()
+        changed = {
+            'php': self._config_php(php_tuning),
+            'fpm': self._config_php_fpm(runtime, php_tuning),
+            'runtime': self._switch_php_runtime(runtime),
+            'apache': self._config_apache(runtime),
+            # Session handler ini and connection settings.
+            'redis': self._config_redis(),
+        }
+        changed = [k for k, v in changed.items() if v]
+        logger.info(f"Config changed for: {changed or 'nothing'}")
+        if runtime == 'fpm' and {'php', 'redis', 'fpm', 'runtime'} & set(changed):
+            utils.reload_php_fpm()
+        if 'runtime' in changed:
+            self._reload_apache(restart=True)
+        elif 'apache' in changed or ({'php', 'redis'} & set(changed) and runtime == 'mod_php'):
+            self._reload_apache()
+        return changed
+
+    def _config_redis(self):
+        """
+        Re-renders the redis configs if related to redis.
+        :return: True if php needs a reload.
+        """
+        if not os.path.isdir(os.path.join(NEXTCLOUD_ROOT, 'config')):
+            return False
+        try:
+            return self.redis.reconfigure()
+        except ValueError as e:
+            logger.error(f"Configuring redis failed: {e}")
+            sys.exit(-1)
+
+    def _reload_php(self):
+        """
+        Makes php pick up changed ini files: reloads php-fpm, or apache for mod_php.
+        """
+        if self._php_runtime() == 'fpm':
+            utils.reload_php_fpm()
         else:
-            logger.debug(f"Non-leader unit runs config_change event")
-            # TODO: Need to refactor backup 
-            # if self.config.get('backup-host') and self._stored.nextcloud_initialized and self._stored.database_available:
-            #     self.unit.status = MaintenanceStatus("Configuring backup")
-            #     utils.config_backup(self.config, self._stored.nextcloud_datadir, self._stored.dbhost,
-            #                         self._stored.dbuser, self._stored.dbpass)
-            pass
-
-        # All config changes restarts apache. This unfucks mis-configures
-        sp.check_call(['systemctl', 'restart', 'apache2.service'])
-
-        # Sleep 3 seconds to let apache settle. Then check status.
-        time.sleep(3)
+            self._reload_apache()
+
+    def _on_upgrade_charm(self, event):
+        """
+        A new charm revision may render its templates or run its steps
+        differently while their inputs are the same, so every step runs again.
+        """
+        logger.debug(emojis.EMOJI_CORE_HOOK_EVENT + sys._getframe().f_code.co_name)
+        self._stored.reconciled.clear()
+        self.reconcile(event)
+
+    def _on_update_status_hook(self, event):
+        """
+        Reconciles, e.g. retunes php after the unit's cores or RAM changed,
+        then reports status.
+        """
+        self.reconcile(event)
         self._on_update_status(event)
 
+    def _reload_apache(self, restart=False):
+        """
+        Gracefully reloads apache and waits for nextcloud to answer again.
+        A full restart is only needed when switching MPM.
+        """
+        self.unit.status = MaintenanceStatus("reloading apache...")
+        if restart:
+            utils.apache_restart()
+        else:
+            utils.apache_graceful()
+        if not utils.wait_for_status_php(timeout=30):
+            logger.warning("Nextcloud did not answer on status.php within 30s "
+                           "after reloading apache.")
+
     # Only leader is running this hook (verify this)
     def _on_leader_elected(self, event):
         logger.debug(emojis.EMOJI_CORE_HOOK_EVENT + sys._getframe().f_code.co_name)
         logger.debug("!!!!!!!! I'm new nextcloud leader !!!!!!!!")
-        if self.model.unit.is_leader() and self._stored.nextcloud_initialized:
-            self.update_config_php_trusted_domains()
+        self.reconcile(event)
 
-    def update_config_php_trusted_domains(self):
+    def _peer_addresses(self, departing=None):
+        """
+        Ingress addresses of the peers and this unit, without departing.
+        """
+        cluster_rel = self.model.get_relation('cluster')
+        addresses = [cluster_rel.data[u].get('ingress-address')
+                     for u in cluster_rel.units if u != departing]
+        addresses.append(cluster_rel.data[self.model.unit].get('ingress-address'))
+        return [a for a in addresses if a]
+
+    def update_config_php_trusted_domains(self, departing=None):
         """
         Updates trusted domains on peer relation
         Updates nextcloud via occ-command with trusted domains
@@ -227,63 +450,131 @@ class NextcloudCharm(CharmBase):
         """
         if not os.path.exists(NEXTCLOUD_CONFIG_PHP):
             return
-
-        cluster_rel = self.model.relations['cluster'][0]
-        rel_unit_ip = [cluster_rel.data[u]['ingress-address'] for u in cluster_rel.units]
-        this_unit_ip = cluster_rel.data[self.model.unit]['ingress-address']
-        rel_unit_ip.append(this_unit_ip)
-        Occ.update_trusted_domains_peer_ips(rel_unit_ip)
+        Occ.update_trusted_domains_peer_ips(self._peer_addresses(departing))
         self.updateClusterRelationData()
 
     def update_relation_ceph_config_php(self):
-        if not os.path.exists(NEXTCLOUD_CEPH_CONFIG_PHP):
-            return
-        cluster_rel = self.model.relations['cluster'][0]
-        with open(NEXTCLOUD_CEPH_CONFIG_PHP) as f:
-            ceph_config = f.read()
-            cluster_rel.data[self.app]['ceph_config'] = str(ceph_config)
-
-    def _on_cluster_relation_joined(self, event):
-        logger.debug(emojis.EMOJI_CLOUD + sys._getframe().f_code.co_name)
-        if self.model.unit.is_leader():
-            if not self._stored.nextcloud_initialized:
-                event.defer()
-                return
-            self.framework.breakpoint('joined')
-            self.update_config_php_trusted_domains()
+        """
+        Shares the changed ceph.config.php, it travels in the same payload as config.php.
+        """
+        self.updateClusterRelationData()
 
-    def _on_cluster_relation_changed(self, event):
+    def _on_cluster_relation_event(self, event):
         """
-        When a change on the config happens:
+        Peers joining, changing or departing:
+        Leader syncs trusted domains and shares config.php.
         Peers (non-leaders) pull in config from (cluster) relation and writes to local disk.
         """
         logger.debug(emojis.EMOJI_CLOUD + sys._getframe().f_code.co_name)
-        if not self.model.unit.is_leader():
-            if 'nextcloud_config' not in event.relation.data[self.app]:
-                event.defer()
-                return
+        self.reconcile(event)
 
-            nextcloud_config = event.relation.data[self.app]['nextcloud_config']
-            with open(NEXTCLOUD_CONFIG_PHP, "w") as f:
-                f.write(nextcloud_config)
+    def _update_cluster_data(self):
+        """
+        Leader shares config.php and ceph.config.php with the peers.
+        """
+        self.updateClusterRelationData()
+        # Set self._stored.config_altered_on_disk = False after we have ran
+        # updateClusterRelationData, so to be sure that it can be toggled again
+        # if other component changes needs to signal this.
+        self._stored.config_altered_on_disk = False
 
-            # TODO: only create .ocdata file for debug since it scale out
-            # will only work with a shared-fs like NFS.
-            self._make_ocdata_for_occ()
+    def _write_peer_config(self):
+        """
+        Peers (non-leaders) write the config shared by the leader to local
+        disk, if its revision advanced since they last did. Revisions count
+        per cluster relation and restart when it or its databag is recreated,
+        so the applied one is remembered with the relation id and digest.
+        :return: False to retry in a later hook, e.g. the secret isn't readable yet.
+        """
+        cluster_rel = self.model.get_relation('cluster')
+        app_data = cluster_rel.data[self.app]
+        revision = int(app_data['config_revision'])
+        applied = self._stored.peer_config_applied
+        if applied.get('relation') == cluster_rel.id \
+                and applied.get('sha256') == app_data.get('config_sha256') \
+                and revision <= applied.get('revision', 0):
+            logger.debug(f"Shared config revision {revision} already applied.")
+            return
+        try:
+            files = self._shared_files(app_data)
+        except ValueError as e:
+            logger.error(f"Not applying shared config revision {revision}: {e}")
+            return False
 
-            if 'ceph_config' in event.relation.data[self.app]:
-                ceph_config = event.relation.data[self.app]['ceph_config']
-                with open(NEXTCLOUD_CEPH_CONFIG_PHP, "w") as f:
-                    f.write(ceph_config)
+        for name, path in SHARED_CONFIG_FILES.items():
+            if name in files:
+                # Atomic, with the ownership nextcloud needs.
+                templating.write_if_changed(path, files[name], mode=0o640,
+                                            owner=('www-data', 'www-data'))
 
-            # Set correct permissions
-            utils.set_nextcloud_permissions(self)
+        # TODO: only create .ocdata file for debug since it scale out
+        # will only work with a shared-fs like NFS.
+        self._make_ocdata_for_occ()
+        applied.update(relation=cluster_rel.id, revision=revision,
+                       sha256=app_data.get('config_sha256'))
+        logger.info(f"Applied shared config revision {revision}.")
 
-    def _on_cluster_relation_departed(self, event):
-        logger.debug(emojis.EMOJI_CLOUD + sys._getframe().f_code.co_name)
-        self.framework.breakpoint('departed')
-        if self.model.unit.is_leader():
-            self.update_config_php_trusted_domains()
+    def _share_config_secret(self, app_data, secrets):
+        """
+        Leader puts the values split out of the shared config into the Juju
+        secret CONFIG_SECRET_LABEL, adding a secret revision only when they changed.
+        Peers find the secret's id and revision in the cluster/peer application databag.
+        :return: True if the secret changed.
+        """
+        if not secrets:
+            return False
+        if 'config_secret_id' in app_data:
+            secret = self.model.get_secret(id=app_data['config_secret_id'])
+            if secret.peek_content() == secrets:
+                return False
+            secret.set_content(secrets)
+            revision = int(app_data.get('config_secret_revision') or 1) + 1
+        else:
+            secret = self.app.add_secret(
+                secrets, label=CONFIG_SECRET_LABEL,
+                description="Secret values of the nextcloud config shared with peers")
+            app_data['config_secret_id'] = secret.id
+            revision = 1
+        app_data['config_secret_revision'] = str(revision)
+        logger.info(f"Shared config secret updated to revision {revision}.")
+        return True
+
+    def _config_secret(self, app_data):
+        """
+        The values kept out of the shared config. Only the secret revision
+        last read is remembered; the content is refreshed when the databag
+        announces a new one, else read from the revision Juju tracks for us.
+        Raises ValueError if it can't be had.
+        """
+        current = {'id': app_data.get('config_secret_id'),
+                   'revision': app_data.get('config_secret_revision')}
+        applied = self._stored.config_secret_applied
+        refresh = dict(applied) != current
+        try:
+            secret = self.model.get_secret(id=current['id'])
+            content = secret.get_content(refresh=refresh)
+        except (SecretNotFoundError, ModelError) as e:
+            raise ValueError(f"Can't get the shared config secret: {e}")
+        if refresh:
+            applied.update(current)
+            logger.debug(f"Fetched the shared config secret revision {current['revision']}.")
+        return content
+
+    def _shared_files(self, app_data):
+        """
+        The config files shared in the cluster/peer application databag,
+        {name: content}, see SHARED_CONFIG_FILES, with the secret values
+        put back in.
+        Raises ValueError if the payload is damaged or the secret is missing.
+        """
+        if 'config_payload' in app_data:
+            files = peer_payload.decode(app_data['config_payload'], app_data.get('config_sha256'))
+            if 'config_secret_id' in app_data:
+                files = peer_payload.join_secrets(files, self._config_secret(app_data))
+            return files
+        # Shared as plain text before.
+        legacy = {'config.php': 'nextcloud_config', 'ceph.config.php': 'ceph_config'}
+        return {name: app_data[key] for name, key in legacy.items() if key in app_data}
 
     def _on_cluster_relation_broken(self, event):
         logger.debug(emojis.EMOJI_CLOUD + sys._getframe().f_code.co_name)
@@ -330,11 +621,14 @@ class NextcloudCharm(CharmBase):
             utils.set_nextcloud_permissions(self)
             self._init_nextcloud(db_data)
             self._add_initial_trusted_domain()
+            self._config_charm_php()
             utils.setPrettyUrls()
             utils.installCrontab()
             Occ.setBackgroundCron()
-            if self._is_nextcloud_operational():
+            if self._is_nextcloud_operational(refresh=True):
                 self._stored.nextcloud_initialized = True
+                # Trusted domains, proxies and the peers' config.
+                self.reconcile(event)
                 self._on_update_status(event)
             else:
                 logger.error("FAILED initializing Nextcloud, check logs.")
@@ -352,9 +646,10 @@ class NextcloudCharm(CharmBase):
         retries = 3
         delay = 10
         for attempt in range(retries):
-            if self._is_nextcloud_operational():
+            if self._is_nextcloud_operational(refresh=attempt > 0):
                 break
-            logger.debug(f"Nextcloud not operational yet (occ fails), deferring start event. Attempt {attempt + 1} of {retries}")
+            logger.debug("Nextcloud not operational yet, deferring start event. "
+                         f"Attempt {attempt + 1} of {retries}")
             self.unit.status = WaitingStatus("Waiting for Nextcloud to be ready before we can start.")
             if attempt < retries - 1:
                 time.sleep(delay)
@@ -429,29 +724,204 @@ class NextcloudCharm(CharmBase):
         else:
             event.set_results({"initial-admin-password": "NOT AVAILABLE"})
 
-    def _config_php(self):
+    def _on_seed_cache_action(self, event):
+        """
+        Action to download a nextcloud release into the local release cache,
+        so that later installs on this machine don't need the network.
+        """
+        logger.debug(emojis.EMOJI_ACTION_EVENT + sys._getframe().f_code.co_name)
+        cache = self._release_cache()
+        if not cache:
+            event.fail("The release cache is disabled (release-cache-size is 0).")
+            return
+        url = event.params.get('url') or self.config.get('nextcloud-tarfile')
+        sha256 = event.params.get('sha256')
+        if not sha256 and url == self.config.get('nextcloud-tarfile'):
+            sha256 = self.config.get('nextcloud-tarfile-sha256')
+        try:
+            digest = cache.add_url(url, sha256=sha256)
+        except Exception as e:
+            event.fail(f"Seeding the release cache from {url} failed: {e}")
+            return
+        cache.evict(keep=[digest])
+        event.set_results({"url": url, "sha256": digest,
+                           "cached-releases": len(cache.entries())})
+
+    def _on_opcache_reset_action(self, event):
+        """
+        Action to reset php's opcache after code changed outside the charm,
+        e.g. after updating apps or running the nextcloud updater.
+        """
+        logger.debug(emojis.EMOJI_ACTION_EVENT + sys._getframe().f_code.co_name)
+        self._reset_opcache()
+        event.set_results({"opcache-mode": self._opcache_mode()})
+
+    def _on_hook_profile_action(self, event):
+        """
+        Action to show where recent hooks spent their time: the timing trees
+        of hook handlers, reconcile steps, occ calls, commands and apt runs.
+        """
+        logger.debug(emojis.EMOJI_ACTION_EVENT + sys._getframe().f_code.co_name)
+        records = profiler.recent(event.params.get('count', 10),
+                                  slowest=event.params.get('slowest', False))
+        event.set_results({"dispatches": json.dumps(records),
+                           "log": str(profiler.PROFILE_LOG)})
+
+    def _hook_profiling(self):
+        """
+        The profiler enabled for every hook from the hook-profiling config, or ''.
+        """
+        mode = self.config.get('hook-profiling') or ''
+        if mode not in profiler.PROFILE_MODES:
+            logger.error("Unsupported hook-profiling provided as config: " + mode)
+            sys.exit(-1)
+        return mode
+
+    def _config_php(self, php_tuning):
         """
         Renders the phpmodule for nextcloud (nextcloud.ini)
         This is instead of manipulating the system wide php.ini
         which might be overwitten or changed from elsewhere.
+        :return: True if php needs a reload.
         """
         self.unit.status = MaintenanceStatus("config php...")
         phpmod_context = {
             'max_file_uploads': self.config.get('php_max_file_uploads'),
             'upload_max_filesize': self.config.get('php_upload_max_filesize'),
             'post_max_size': self.config.get('php_post_max_size'),
-            'memory_limit': self.config.get('php_memory_limit')
+            'memory_limit': self.config.get('php_memory_limit'),
+            'opcache_memory_consumption': php_tuning['opcache.memory_consumption'],
+            'opcache_interned_strings_buffer': php_tuning['opcache.interned_strings_buffer'],
+            'opcache_max_accelerated_files': php_tuning['opcache.max_accelerated_files'],
+            'opcache_frozen': self._opcache_mode() == 'frozen',
+            'opcache_file_cache': str(utils.OPCACHE_FILE_CACHE),
+            'php_jit': self._php_jit(),
+            'opcache_jit_buffer_size': php_tuning['opcache.jit_buffer_size'],
+            'apc_shm_size': php_tuning['apc.shm_size'],
         }
-        utils.config_php(phpmod_context, Path(self.charm_dir / 'templates'), 'nextcloud.ini.j2')
+        if phpmod_context['opcache_frozen']:
+            utils.prepare_opcache_file_cache()
+        changed = utils.config_php(phpmod_context, Path(self.charm_dir / 'templates'),
+                                   'nextcloud.ini.j2')
+        if changed and phpmod_context['opcache_frozen']:
+            # php reloads with the new ini, don't let it pick up scripts
+            # compiled before, possibly from other code.
+            utils.clear_opcache_file_cache()
         self._stored.php_configured = True
+        return changed
+
+    def _opcache_mode(self):
+        """
+        'revalidate' (php checks files for changes) or 'frozen' (code only
+        changes when the charm installs it), from the opcache-mode config.
+        """
+        mode = self.config.get('opcache-mode') or 'revalidate'
+        if mode not in ('revalidate', 'frozen'):
+            logger.error("Unsupported opcache-mode provided as config: " + mode)
+            sys.exit(-1)
+        return mode
+
+    def _php_jit(self):
+        """
+        The opcache.jit mode from the php-jit config, or '' when off.
+        """
+        jit = self.config.get('php-jit') or ''
+        if jit not in ('', 'tracing', 'function'):
+            logger.error("Unsupported php-jit provided as config: " + jit)
+            sys.exit(-1)
+        if jit and utils.get_phpversion().startswith('7.'):
+            logger.warning("php-jit needs php 8, ignoring it.")
+            return ''
+        return jit
+
+    def _reset_opcache(self):
+        """
+        Makes php forget compiled code after the code tree changed: clears the
+        opcache file cache, reloads php and warms the opcache again.
+        Needed in the frozen opcache-mode, where php doesn't look for changes.
+        """
+        utils.clear_opcache_file_cache()
+        if not (self._stored.apache_configured and self._stored.php_configured):
+            return
+        if self._php_runtime() == 'fpm':
+            utils.reload_php_fpm()
+        else:
+            utils.apache_graceful()
+        if utils.wait_for_status_php(timeout=30):
+            utils.warm_opcache()
 
-    def _config_apache(self):
+    def _config_apache(self, runtime='mod_php'):
         """
         Configured apache
+        :return: True if apache needs a reload.
         """
         self.unit.status = MaintenanceStatus("config apache....")
-        utils.config_apache2(Path(self.charm_dir / 'templates'), 'nextcloud.conf.j2')
+        ctx = {'php_runtime': runtime}
+        if runtime == 'fpm':
+            ctx['fpm_socket'] = utils.php_fpm_socket()
+        changed = utils.config_apache2(Path(self.charm_dir / 'templates'), 'nextcloud.conf.j2',
+                                       ctx)
         self._stored.apache_configured = True
+        return changed
+
+    def _php_runtime(self):
+        """
+        How apache runs php, from the php-runtime config.
+        """
+        runtime = self.config.get('php-runtime') or 'mod_php'
+        if runtime not in utils.PHP_RUNTIMES:
+            logger.error("Unsupported php-runtime provided as config: " + runtime)
+            sys.exit(-1)
+        return runtime
+
+    def _php_tuning(self):
+        """
+        Pool and opcache sizes for this unit's cores and RAM, see tuning.php_tuning().
+        """
+        cores, memory = tuning.host_resources()
+        memory_limit = utils.parse_size(self.config.get('php_memory_limit'))
+        try:
+            overrides = tuning.parse_overrides(self.config.get('php-tuning-overrides'))
+            php_tuning = tuning.php_tuning(cores, memory, memory_limit, overrides)
+        except ValueError as e:
+            self.unit.status = BlockedStatus(f"Invalid php-tuning-overrides: {e}")
+            logger.error(f"Invalid php-tuning-overrides provided as config: {e}")
+            sys.exit(-1)
+        logger.debug(f"php tuning for {cores} cores, {memory // 1024 ** 2}MiB: {php_tuning}")
+        return php_tuning
+
+    def _config_php_fpm(self, runtime, php_tuning):
+        """
+        Renders the nextcloud php-fpm pool, or removes it when not using fpm.
+        :return: True if php-fpm needs a reload.
+        """
+        if runtime != 'fpm':
+            return utils.remove_php_fpm_pool()
+        pool_context = {
+            'pm': php_tuning['pm'],
+            'max_children': php_tuning['pm.max_children'],
+            'start_servers': php_tuning['pm.start_servers'],
+            'min_spare_servers': php_tuning['pm.min_spare_servers'],
+            'max_spare_servers': php_tuning['pm.max_spare_servers'],
+            'max_requests': php_tuning['pm.max_requests'],
+        }
+        try:
+            return utils.config_php_fpm_pool(pool_context, Path(self.charm_dir / 'templates'),
+                                             'nextcloud-fpm-pool.conf.j2')
+        except RuntimeError as e:
+            logger.error(f"Configuring php-fpm failed: {e}")
+            sys.exit(-1)
+
+    def _switch_php_runtime(self, runtime):
+        """
+        Switches apache modules and MPM for the php runtime.
+        :return: True if apache needs a full restart.
+        """
+        try:
+            return utils.switch_php_runtime(runtime)
+        except (RuntimeError, sp.CalledProcessError) as e:
+            logger.error(f"Switching php-runtime to {runtime} failed: {e}")
+            sys.exit(-1)
 
     def _init_nextcloud(self, database_info):
         """
@@ -547,20 +1017,19 @@ class NextcloudCharm(CharmBase):
 
     def _on_redis_available(self, event):
         """
-        When redis is available, apache needs a restart.
+        When redis is available, php needs a reload.
         /var/www/nextcloud/config/redis.config.php - modified
         /etc/php/X.Y/mods-available/redis_session.ini - modified
         """
-        
-        sp.run(['systemctl', 'restart', 'apache2.service'])
+        self._reload_php()
 
     def _on_redis_broken(self, event):
         """
-        When redis integration removed, apache needs a restart.
+        When redis integration removed, php needs a reload.
         /var/www/nextcloud/config/redis.config.php - removed
         /etc/php/X.Y/mods-available/redis_session.ini - removed
         """
-        sp.run(['systemctl', 'restart', 'apache2.service'])
+        self._reload_php()
 
     def _on_set_trusted_domain_action(self, event):
         domain = event.params['domain']
@@ -590,12 +1059,12 @@ class NextcloudCharm(CharmBase):
         sp.run(cmd.split())
 
         # Set new datadir
-        cmd = "sudo -u www-data php occ config:system:set datadirectory --value=/media/nextcloud/data/"
-        sp.run(cmd.split(), cwd="/var/www/nextcloud/")
+        cmd = "config:system:set datadirectory --value=/media/nextcloud/data/"
+        Occ.run(cmd.split())
 
         # Cleanup cache
-        cmd = "sudo -u www-data php occ files:cleanup"
-        sp.run(cmd.split(), cwd="/var/www/nextcloud/")
+        cmd = "files:cleanup"
+        Occ.run(cmd.split())
 
         # sudo -u www-data php /path/to/nextcloud/occ maintenance:mode --off
         Occ.maintenance_mode(enable=False)
@@ -621,109 +1090,187 @@ class NextcloudCharm(CharmBase):
             self.unit.status = MaintenanceStatus("ceph config complete.")
             self.update_relation_ceph_config_php()
 
-    def _config_overwriteprotocol(self):
-        """
-        Configures nextcloud overwriteprotocol to http or https.
-        :return:
-        """
-        if self._stored.nextcloud_initialized:
-            Occ.overwriteprotocol(self.config.get('overwriteprotocol'))
-
-    def _config_debug(self):
+    def _charm_system_config(self):
         """
-        Configures nextcloud system:debug from config value.
-        :return:
+        The system config owned by the charm, computed from charm config.
+        :return: dict of config.php keys and values
         """
-        if self._stored.nextcloud_initialized:
-            Occ.setDebug(self.config.get('debug'))
+        protocol = self.config.get('overwriteprotocol')
+        if protocol not in ('http', 'https'):
+            logger.error("Unsupported overwriteprotocol provided as config: " + protocol)
+            sys.exit(-1)
+        region = self.config.get('default-phone-region')
+        if region not in VALID_PHONE_REGIONS:
+            logger.error("Unsupported phone region code provided as config: " + region)
+            sys.exit(-1)
 
-    def _config_overwritecliurl(self):
-        """
-        Configures nextcloud overwrite-cli-url config value.
-        :return:
-        """
-        if self._stored.nextcloud_initialized:
-            Occ.overwriteCliUrl(self.config.get('overwrite-cli-url'))
+        system_config = {
+            'overwriteprotocol': protocol,
+            'default_phone_region': region,
+            'debug': bool(self.config.get('debug')),
+            # Pretty URLs, see utils.setPrettyUrls()
+            'htaccess.RewriteBase': '/',
+        }
+        if self.config.get('overwrite-cli-url'):
+            system_config['overwrite.cli.url'] = self.config.get('overwrite-cli-url')
+        return system_config
 
-    def _config_default_phone_region(self):
+    def _config_charm_php(self):
         """
-        Configures nextcloud overwriteprotocol to http or https.
-        :return:
+        Renders config/charm.config.php with the system config owned by the charm.
+        :return: True if the file changed.
         """
-        if self._stored.nextcloud_initialized:
-            Occ.defaultPhoneRegion(self.config.get('default-phone-region'))
+        if not os.path.isdir(os.path.join(NEXTCLOUD_ROOT, 'config')):
+            logger.debug("Nextcloud not extracted yet, not rendering charm.config.php")
+            return False
+        changed = utils.config_charm_php(self._charm_system_config(),
+                                         Path(self.charm_dir / 'templates'), 'charm.config.php.j2')
+        if changed:
+            logger.info("charm.config.php updated.")
+        return changed
 
     def _make_ocdata_for_occ(self):
         """
         This create a .ocdata file which nextcloud wants or will error
         on all occ commands.
         """
-        if not self._stored.nextcloud_datadir.exists():
-            self._stored.nextcloud_datadir.mkdir()
-        if not self._stored.nextcloud_datadir.joinpath('.ocdata').exists():
-            self._stored.nextcloud_datadir.joinpath('.ocdata').touch()
+        datadir = Path(self._stored.nextcloud_datadir)
+        if not datadir.exists():
+            datadir.mkdir()
+        if not datadir.joinpath('.ocdata').exists():
+            datadir.joinpath('.ocdata').touch()
 
-    def _is_nextcloud_operational(self):
+    def _nextcloud_status(self, refresh=False):
         """
-        Determine operational status by calling on 'occ status'.
+        Nextcloud's status: installed, version, maintenance, needsDbUpgrade...
+        Probed once per hook, first through apache's status.php, which takes
+        milliseconds and checks the real serving path, then with 'occ status'
+        if apache doesn't answer. refresh probes again, e.g. after installing.
+        :return: dict, empty if neither answered.
         """
-        # Get stdout from the CompletedProcess object
-        stdout_data = Occ.status().stdout
-        
-        # Parse the stdout as JSON and convert it into a dictionary
-        try:
-            status_dict = json.loads(stdout_data)
-            logger.debug(f"Nextcloud OCC status: {status_dict}")
-        except:
-            return False
-
-        # stdout='{"installed":false,
-        # "version":"26.0.1.1",
-        # "versionstring":"26.0.1",
-        # "edition":"",
-        # "maintenance":false,
-        # "needsDbUpgrade":false,
-        # "productname":"Nextcloud",
-        # "extendedSupport":false}
-
-        installed = bool(status_dict["installed"])
+        if self._status is None or refresh:
+            status = utils.get_status_php()
+            if status is not None:
+                logger.debug(f"Nextcloud status.php status: {status}")
+            else:
+                try:
+                    status = json.loads(Occ.status().stdout)
+                    logger.debug(f"Nextcloud OCC status: {status}")
+                except ValueError:
+                    status = {}
+                if not isinstance(status, dict):
+                    status = {}
+            self._status = status
+        return self._status
+
+    def _is_nextcloud_operational(self, refresh=False):
+        """
+        Determine operational status from the installed flag of _nextcloud_status().
+        """
+        installed = bool(self._nextcloud_status(refresh).get('installed'))
         logger.debug(f"Nextcloud operational status: {str(installed)}")
         return installed
 
     def _nextcloud_version(self):
         """
-        Get Nextcloud version by calling Occ.status()
+        Get Nextcloud version from _nextcloud_status()
         Returns: 0 if it can't be retrieved.
         """
-        try:
-            _v = json.loads(Occ.status().stdout)['version']
-            logger.debug(f"Determined nextcloud version: {_v}")
-            return _v
-        except:
-            return "0"
+        _v = str(self._nextcloud_status().get('version', "0"))
+        logger.debug(f"Determined nextcloud version: {_v}")
+        return _v
+
+    def _config_php_digest(self):
+        """
+        The sha256 of the local config.php, see _file_digest().
+        """
+        return self._file_digest(NEXTCLOUD_CONFIG_PHP)
+
+    def _file_digest(self, path):
+        """
+        The sha256 of a local file, only read when its mtime or size changed.
+        """
+        return config_drift.file_digest(path, self._stored.file_digests)
+
+    def _shared_config_digest(self, cluster_rel):
+        """
+        The sha256 of the config.php shared in the cluster/peer application
+        databag, or None if nothing is shared yet.
+        """
+        app_data = cluster_rel.data[self.app]
+        if 'nextcloud_config_sha256' in app_data:
+            return app_data['nextcloud_config_sha256']
+        if 'nextcloud_config' in app_data:
+            # Shared before digests were.
+            return config_drift.digest(app_data['nextcloud_config'])
+        return None
+
+    def _config_drift(self):
+        """
+        Compares the local config.php with the one shared in the cluster/peer
+        application databag.
+        :return: None if nothing to compare with, else a dict with 'drifted' and
+                 the keys that 'changed', are 'local_only' or 'shared_only'.
+        """
+        cluster_rel = self.model.get_relation('cluster')
+        if cluster_rel is None:
+            return None
+        shared_digest = self._shared_config_digest(cluster_rel)
+        local_digest = self._config_php_digest()
+        if shared_digest is None or local_digest is None:
+            return None
+        report = {'drifted': local_digest != shared_digest,
+                  'changed': [], 'local_only': [], 'shared_only': []}
+        if report['drifted']:
+            with open(NEXTCLOUD_CONFIG_PHP) as f:
+                local = f.read()
+            try:
+                shared = self._shared_files(cluster_rel.data[self.app]).get('config.php', '')
+            except ValueError as e:
+                logger.error(f"Can't compare config.php with the shared config: {e}")
+                shared = ''
+            report.update(config_drift.diff(local, shared))
+        return report
 
     def _checkLogConfigDiff(self):
         """
-        Compares nextcloud config.php with cluster/peer with application databag.
-        Logs this information only.
+        Compares the digest of nextcloud config.php with the one in the
+        cluster/peer application databag; config.php is only read when it
+        changed on disk. Logs this information only, see the config-drift action.
         """
-        cluster_rel = self.model.relations['cluster'][0]
-        try:
-            if 'nextcloud_config' in cluster_rel.data[self.app]:
-                with open(NEXTCLOUD_CONFIG_PHP) as f:
-                    nextcloud_config = f.read()
-                    if cluster_rel.data[self.app]['nextcloud_config'] == str(nextcloud_config):
-                        logger.info("No manual/local changes to nextcloud config.php detected.")
-                    else:
-                        # Toggle this information. Resolve it within config_changed.
-                        self._stored.config_altered_on_disk = True
-                        logger.warning("Manual/local changes to config.php detected, \
-                                       will be overwritten by config updates!")
-            else:
-                logger.info("nextcloud_config key not found in cluster_rel.data.")
-        except KeyError:
-            logger.error("Error accessing cluster_rel.data dictionary.")
+        report = self._config_drift()
+        if report is None:
+            logger.info("No shared nextcloud config to compare config.php with.")
+        elif not report['drifted']:
+            logger.info("No manual/local changes to nextcloud config.php detected.")
+            self._stored.config_altered_on_disk = False
+        else:
+            # Toggle this information. Resolved by reconcile() sharing or rewriting config.php.
+            self._stored.config_altered_on_disk = True
+            logger.warning("Manual/local changes to config.php detected, will be overwritten "
+                           f"by config updates! changed: {report['changed']}, "
+                           f"local only: {report['local_only']}, "
+                           f"shared only: {report['shared_only']}")
+
+    def _on_config_drift_action(self, event):
+        """
+        Action to show which config.php keys differ from the config shared by the leader.
+        Only key names are shown, values may be secrets.
+        """
+        logger.debug(emojis.EMOJI_ACTION_EVENT + sys._getframe().f_code.co_name)
+        report = self._config_drift()
+        if report is None:
+            event.fail("No shared nextcloud config to compare config.php with.")
+            return
+        event.set_results({"drifted": report['drifted'],
+                           "changed": ",".join(report['changed']),
+                           "local-only": ",".join(report['local_only']),
+                           "shared-only": ",".join(report['shared_only'])})
 
 
 if __name__ == "__main__":
-    main(NextcloudCharm)
+    # Every dispatch is timed, see the hook-profile action.
+    with profiler.dispatch(os.environ.get('JUJU_DISPATCH_PATH', 'unknown')):
+        # One persistent occ worker serves all occ calls made during this hook.
+        with OccSession():
+            main(NextcloudCharm)
@@ -0,0 +1,115 @@
+import hashlib
+import logging
+import os
+
+logger = logging.getLogger(__name__)
+
+
+def digest(content) -> str:
+    """
+    Returns the sha256 hex digest of content, str or bytes.
+    """
+    data = content.encode() if isinstance(content, str) else content
+    return hashlib.sha256(data).hexdigest()
+
+
+def file_digest(path, cache):
+    """
+    Returns the sha256 hex digest of the file at path, or None if missing.
+    cache is a dict remembering the digests with the files' mtime and size,
+    by path, e.g. in StoredState; while those are unchanged a file isn't read.
+    """
+    key = str(path)
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        cache.pop(key, None)
+        return None
+    known = cache.get(key)
+    if known is not None and list(known[:2]) == [st.st_mtime_ns, st.st_size]:
+        return known[2]
+    with open(path, 'rb') as f:
+        sha256 = digest(f.read())
+    cache[key] = [st.st_mtime_ns, st.st_size, sha256]
+    return sha256
+
+
+def config_entries(content) -> dict:
+    """
+    Parses the top level entries of a nextcloud config.php,
+    $CONFIG = array ( 'key' => value, ... );
+    Returns {key: value}, values as php source without whitespace outside of
+    strings and with arrays in [] form, so equal values compare equal
+    however they are formatted.
+    """
+    start = content.find('$CONFIG')
+    if start < 0:
+        return {}
+    entries = {}
+    token = []
+    depth = 0
+    quote = None
+    escaped = False
+
+    def flush():
+        key, sep, value = ''.join(token).partition('=>')
+        if sep:
+            entries[_unquote(key)] = value
+        token.clear()
+
+    for ch in content[start:]:
+        if quote:
+            token.append(ch)
+            if escaped:
+                escaped = False
+            elif ch == '\\':
+                escaped = True
+            elif ch == quote:
+                quote = None
+            continue
+        if depth == 0:
+            if ch in '([':
+                depth = 1
+            continue
+        if ch in '\'"':
+            quote = ch
+        elif ch in '([':
+            depth += 1
+            # array ( ... ) and [ ... ] are the same value.
+            if ch == '(' and token[-5:] == list('array'):
+                del token[-5:]
+            ch = '['
+        elif ch in ')]':
+            depth -= 1
+            if depth == 0:
+                flush()
+                break
+            ch = ']'
+        elif ch == ',' and depth == 1:
+            flush()
+            continue
+        if not ch.isspace():
+            token.append(ch)
+    return entries
+
+
+def diff(local, shared) -> dict:
+    """
+    Compares two config.php contents and returns which keys diverged:
+    {'changed': [...], 'local_only': [...], 'shared_only': [...]}
+    Only key names are reported, values may be secrets.
+    """
+    local = config_entries(local)
+    shared = config_entries(shared)
+    return {
+        'changed': sorted(k for k in local.keys() & shared.keys() if local[k] != shared[k]),
+        'local_only': sorted(local.keys() - shared.keys()),
+        'shared_only': sorted(shared.keys() - local.keys()),
+    }
+
+
+def _unquote(key):
+    key = key.strip()
+    if len(key) >= 2 and key[0] == key[-1] and key[0] in '\'"':
+        return key[1:-1].replace("\\'", "'").replace('\\\\', '\\')
+    return key
@@ -0,0 +1,121 @@
+import logging
+import json
+import os
+import re
+import subprocess as sp
+from pathlib import Path
+
+logger = logging.getLogger(__name__)
+
+CACHE_FILE = Path('/var/lib/nextcloud-charm/hostfacts.json')
+# Installing or removing packages rewrites the dpkg status file, enabling or
+# disabling apache modules touches mods-enabled; either invalidates the cache.
+DPKG_STATUS = Path('/var/lib/dpkg/status')
+APACHE_MODS_ENABLED = Path('/etc/apache2/mods-enabled')
+
+# In process copy of CACHE_FILE: {'signature': [...], 'facts': {...}}
+_cache = None
+
+
+def php_version() -> str:
+    """
+    Returns the installed php version as X.Y, e.g. '8.3'.
+    """
+    return _fact('php_version', _probe_php_version)
+
+
+def distro_codename() -> str:
+    """
+    Returns the distro codename, e.g. 'noble'.
+    """
+    return _fact('distro_codename', _probe_distro_codename)
+
+
+def apache_modules() -> set:
+    """
+    Returns the names of the enabled apache modules, e.g. {'rewrite', 'php8.3'}.
+    """
+    return set(_fact('apache_modules', _probe_apache_modules))
+
+
+def invalidate():
+    """
+    Forgets all facts, e.g. after changing the host in a way the package
+    state doesn't reflect.
+    """
+    global _cache
+    _cache = {'signature': _signature(), 'facts': {}}
+    _save()
+
+
+def _fact(name, probe):
+    """
+    Returns a fact from the cache, probing and storing it if missing or stale.
+    Facts are probed one at a time so asking for the codename before php is
+    installed works.
+    """
+    global _cache
+    signature = _signature()
+    if _cache is None or _cache['signature'] != signature:
+        _cache = _load()
+        if _cache['signature'] != signature:
+            _cache = {'signature': signature, 'facts': {}}
+    facts = _cache['facts']
+    if name not in facts:
+        facts[name] = probe()
+        logger.debug(f"Probed host fact {name}: {facts[name]}")
+        _save()
+    return facts[name]
+
+
+def _signature():
+    """
+    Returns what the cached facts depend on, as a json friendly list.
+    """
+    signature = []
+    for path in (DPKG_STATUS, APACHE_MODS_ENABLED):
+        try:
+            st = path.stat()
+            signature.append([str(path), st.st_mtime_ns, st.st_size])
+        except FileNotFoundError:
+            signature.append([str(path), None, None])
+    return signature
+
+
+def _load():
+    try:
+        cache = json.loads(CACHE_FILE.read_text())
+        if isinstance(cache.get('facts'), dict):
+            return cache
+    except (OSError, ValueError, AttributeError):
+        pass
+    return {'signature': None, 'facts': {}}
+
+
+def _save():
+    try:
+        CACHE_FILE.parent.mkdir(parents=True, exist_ok=True)
+        tmp = CACHE_FILE.with_name(f".{CACHE_FILE.name}.tmp")
+        tmp.write_text(json.dumps(_cache))
+        os.replace(tmp, CACHE_FILE)
+    except OSError as e:
+        # Only costs a probe in the next hook.
+        logger.debug(f"Could not save host facts: {e}")
+
+
+def _probe_php_version():
+    response = sp.check_output(['php', '-v'], universal_newlines=True)
+    match = re.match(r'PHP (\d+\.\d+)', response)
+    if not match:
+        raise RuntimeError(f"Could not parse php version from: {response.splitlines()[:1]}")
+    return match.group(1)
+
+
+def _probe_distro_codename():
+    return sp.check_output(['lsb_release', '-sc'], universal_newlines=True).strip()
+
+
+def _probe_apache_modules():
+    if not APACHE_MODS_ENABLED.is_dir():
+        return []
+    return sorted(p.stem for p in APACHE_MODS_ENABLED.glob('*.load'))
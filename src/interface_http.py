@@ -3,9 +3,10 @@
 
 from ops.framework import Object
 import logging
-import utils
+import profiler
 
 
+@profiler.instrument_handlers
 class HttpProvider(Object):
     """
     Http interface provider interface.
@@ -36,15 +37,7 @@ class HttpProvider(Object):
 
         A joining reverse-proxy is added to the list of _trusted_proxies
         """
-        if self.charm.model.unit.is_leader():
-            if not self.charm._is_nextcloud_installed():
-                logging.debug("Defering relation_joined until nextcloud is installed.")
-                event.defer()
-                return
-            else:
-                raddr = event.relation.data[event.unit]['private-address']
-                logging.debug(f"Adding a trusted_proxy: {raddr}")
-                utils.addTrustedProxy(raddr)
+        self.charm.reconcile(event)
 
     def _on_relation_changed(self, event):
         raddr = event.relation.data[event.unit]['private-address']
@@ -52,23 +45,23 @@ class HttpProvider(Object):
         event.relation.data[self.model.unit]['hostname'] = self._hostname
         event.relation.data[self.model.unit]['port'] = str(self._port)
         event.relation.data[self.model.unit]['service_name'] = "nextcloud"
+        self.charm.reconcile(event)
 
     def _on_relation_departed(self, event):
         """
-        Re-adds only joined units to _trusted_proxies
-        (Effectively removing departed units)
+        Removes the departed unit from _trusted_proxies
         """
-        if self.charm.model.unit.is_leader():
-            if not self.charm._is_nextcloud_installed():
-                logging.debug("Defering relation_departed until nextcloud is installed.")
-                event.defer()
-                return
-            else:
-                # TODO: Figure out how to remove a single unit since it seems not avilable
-                # in this hook (private-address is not available in the data bucket)
-                utils.deleteTrustedProxies()
-                logging.debug("Re-adding remaning units:" + str(event.relation.units))
-                for u in event.relation.units:
-                    raddr = event.relation.data[u]['private-address']
-                    utils.addTrustedProxy(raddr)
-                    # utils.deleteTrustedProxy(raddr)
+        self.charm.reconcile(event)
+
+    def proxy_addresses(self, departing=None):
+        """
+        Addresses of the reverse-proxy units currently in the relations,
+        the charm's leader makes trusted_proxies match them.
+        """
+        addresses = []
+        for relation in self.model.relations[self._relation_name]:
+            for u in relation.units:
+                raddr = relation.data[u].get('private-address')
+                if u != departing and raddr:
+                    addresses.append(raddr)
+        return addresses
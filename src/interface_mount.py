@@ -13,6 +13,7 @@ from ops.framework import (
 )
 
 import utils
+import profiler
 
 logger = logging.getLogger()
 
@@ -27,6 +28,7 @@ class MountEvents(ObjectEvents):
     nfsmount_available = EventSource(NFSMountAvailableEvent)
 
 
+@profiler.instrument_handlers
 class NFSMountClient(Object):
     """NFSMount Client Interface."""
 
@@ -59,12 +61,9 @@ class NFSMountClient(Object):
             return
         ctx = event_unit_data.items()
         logger.info("Remote NFS data: " + str(ctx))
+        # Reloads systemd only if the unit file changed.
         utils.install_nfs_systemd_mount(Path(self._charm.charm_dir / 'templates'),
-                                        'media-nextcloud-data.mount.j2', ctx)
-
-        # Reload daemons
-        cmd = "systemctl daemon-reload"
-        sp.run(cmd.split())
+                                        'media-nextcloud-data.mount.j2', dict(ctx))
 
         # Let the world know we're done.
         self.on.nfsmount_available.emit()
@@ -1,9 +1,11 @@
 #!/usr/bin/env python3
 import logging
 from pathlib import Path
-import subprocess as sp
-import jinja2
+from urllib.parse import urlencode
 import utils
+import templating
+import phpmods
+import profiler
 
 from ops.framework import (
     EventBase,
@@ -15,6 +17,9 @@ from ops.framework import (
 
 logger = logging.getLogger()
 
+# single: one redis (the first unit), cluster: a redis cluster of all units.
+REDIS_MODES = ('single', 'cluster')
+
 
 class RedisAvailableEvent(EventBase):
     """RedisAvailableEvent."""
@@ -30,6 +35,7 @@ class RedisEvents(ObjectEvents):
     redis_broken = EventSource(RedisBrokenEvent)
 
 
+@profiler.instrument_handlers
 class RedisClient(Object):
     """Redis Client Interface."""
 
@@ -46,37 +52,36 @@ class RedisClient(Object):
             self._charm.on[self._relation_name].relation_changed,
             self._on_relation_changed
         )
+        self.framework.observe(
+            self._charm.on[self._relation_name].relation_departed,
+            self._on_relation_departed
+        )
         self.framework.observe(
             self._charm.on[self._relation_name].relation_broken,
             self._on_relation_broken
         )
 
     def _on_relation_changed(self, event):
-        event_unit_data = event.relation.data.get(event.unit)
-        if not event_unit_data:
-            event.defer()
+        data = event.relation.data.get(event.unit) or {}
+        if not (data.get('hostname') and data.get('port')):
+            # No need to defer, relation-changed fires again when the
+            # unit publishes its data.
+            logger.debug("Redis unit has not published hostname and port yet.")
             return
-        password = event_unit_data.get('password')
-        host = event_unit_data.get('hostname')
-        port = event_unit_data.get('port')
-
-        if (host and port):
-            redis_info = {
-                'redis_password': password,
-                'redis_hostname': host,
-                'redis_port': port,
-            }
-
-            # Configure redis
-            self.config_redis(redis_info)
-            self.config_redis_session(redis_info)
-
-            # Announce that redis is configured.
+
+        # Configure redis from all units of the relation.
+        changed = self.reconfigure()
+
+        # Announce that redis is configured.
+        if changed:
+            self.on.redis_available.emit()
+
+    def _on_relation_departed(self, event):
+        """
+        Drops a departed redis unit, e.g. from the cluster seeds.
+        """
+        if self.reconfigure():
             self.on.redis_available.emit()
-        else:
-            logger.warning("REDIS INFO NOT AVAILABLE WHEN IT SHOULD.")
-            event.defer()
-            return
 
     def _on_relation_broken(self, event):
         """
@@ -88,65 +93,141 @@ class RedisClient(Object):
         logger.info("Redis relation was removed, configs purged.")
         self.on.redis_broken.emit()
 
-    def config_redis(self, redis_info, template='redis.config.php.j2') -> str:
+    def reconfigure(self) -> bool:
+        """
+        Re-renders the redis configs from the relation and the charm config,
+        e.g. after the redis-* options changed or units came and went.
+        Returns True if anything changed and php needs a reload.
+        """
+        relation = self.model.get_relation(self._relation_name)
+        if relation is None:
+            return False
+        endpoints = []
+        for unit in sorted(relation.units, key=lambda u: u.name):
+            data = relation.data[unit]
+            if data.get('hostname') and data.get('port'):
+                endpoints.append((data['hostname'], data['port'], data.get('password')))
+        if not endpoints:
+            return False
+        redis_info = self.redis_info(endpoints)
+        changed = self.config_redis(redis_info)
+        return self.config_redis_session(redis_info) or changed
+
+    def redis_info(self, endpoints) -> dict:
+        """
+        Connection settings from the relation data, a list of
+        (hostname, port, password) of all redis units, and the redis-* config.
+
+        With redis-mode=single the first unit is used, through the redis unix
+        socket (redis-socket) when redis runs on this machine.
+        With redis-mode=cluster all units are cluster seeds; phpredis follows
+        the cluster's own failover without the config being rewritten.
+        """
+        config = self._charm.config
+        mode = config.get('redis-mode') or 'single'
+        if mode not in REDIS_MODES:
+            raise ValueError(f"Unsupported redis-mode: {mode}")
+        host, port, _ = endpoints[0]
+        redis_info = {
+            'redis_cluster': mode == 'cluster',
+            'redis_seeds': [f"{h}:{int(p)}" for h, p, _ in endpoints],
+            'redis_password': next((pw for _, _, pw in endpoints if pw), ''),
+            'redis_hostname': host,
+            'redis_port': int(port),
+            'redis_socket': '',
+            'redis_dbindex': int(config.get('redis-dbindex') or 0),
+            'redis_session_dbindex': int(config.get('redis-session-dbindex') or 0),
+            'redis_persistent': bool(config.get('redis-persistent')),
+            'redis_timeout': float(config.get('redis-timeout') or 0),
+            'redis_read_timeout': float(config.get('redis-read-timeout') or 0),
+        }
+        socket_path = config.get('redis-socket')
+        if mode == 'single' and socket_path and Path(socket_path).is_socket() \
+                and utils.is_local_address(host):
+            logger.debug(f"Redis at {host} runs on this machine, using {socket_path}")
+            redis_info['redis_socket'] = socket_path
+            utils.grant_socket_access(socket_path, 'www-data')
+        redis_info['memcache_local'] = memcache_local()
+        redis_info['session_save_handler'] = \
+            'rediscluster' if redis_info['redis_cluster'] else 'redis'
+        redis_info['session_save_path'] = redis_session_save_path(redis_info)
+        return redis_info
+
+    def config_redis(self, redis_info, template='redis.config.php.j2') -> bool:
         """
         Configure redis.
-        Return the rendered config as text or emtpy string.
+        Removes the config if redis_info = None.
+        Returns True if the config changed.
         """
         templates_path = Path(self._charm.charm_dir / 'templates')
+        target = Path('/var/www/nextcloud/config/redis.config.php')
         if redis_info is None:
-            file_path = '/var/www/nextcloud/config/redis.config.php'
-            target = Path(file_path)
             if target.exists():
                 target.unlink()
-            else:
-                pass
-            return ""
+                return True
+            return False
         else:
-            template = jinja2.Environment(
-                loader=jinja2.FileSystemLoader(templates_path)
-            ).get_template(template)
-            target = Path('/var/www/nextcloud/config/redis.config.php')
-            rendered_content = template.render(redis_info)
-            target.write_text(rendered_content)
-        return rendered_content
-
-    def config_redis_session(self, redis_info, template='redis_session.ini.j2'):
+            # Holds the redis password.
+            return templating.render_to_file(templates_path, template, target, redis_info,
+                                             mode=0o640, owner=('www-data', 'www-data'))
+
+    def config_redis_session(self, redis_info, template='redis_session.ini.j2') -> bool:
         """
-        Puts redis session manager in place and enables the mod.
-        Removes the file if redis_info = None.
+        Puts redis session manager in place and enables the mod
+        for all installed php versions.
+        Removes the mod if redis_info = None.
 
-        Returns the rendered config or empty string.
+        Returns True if the session config changed.
         """
         templates_path = Path(self._charm.charm_dir / 'templates')
         if redis_info is None:
-            target_72 = Path('/etc/php/7.2/mods-available/redis_session.ini')
-            target_74 = Path('/etc/php/7.4/mods-available/redis_session.ini')
-            target_81 = Path('/etc/php/8.1/mods-available/redis_session.ini')
-            if utils.get_phpversion() == "7.4":
-                if target_74.exists():
-                    target_74.unlink()
-            elif utils.get_phpversion() == "7.2":
-                if target_72.exists():
-                    target_72.unlink()
-            elif utils.get_phpversion() == "8.1":
-                if target_81.exists():
-                    target_81.unlink()
-            return ""
+            return phpmods.remove_module('redis_session')
         else:
-            template_env = jinja2.Environment(
-                loader=jinja2.FileSystemLoader(templates_path)
-            )
-            template = template_env.get_template(template)
-            target_72 = Path('/etc/php/7.2/mods-available/redis_session.ini')
-            target_74 = Path('/etc/php/7.4/mods-available/redis_session.ini')
-            target_81 = Path('/etc/php/8.1/mods-available/redis_session.ini')
-            rendered_content = template.render(redis_info)
-            if utils.get_phpversion() == "7.4":
-                target_74.write_text(rendered_content)
-            elif utils.get_phpversion() == "7.2":
-                target_72.write_text(rendered_content)
-            elif utils.get_phpversion() == "8.1":
-                target_81.write_text(rendered_content)
-            sp.check_call(['phpenmod', 'redis_session'])
-            return rendered_content
+            rendered_content = templating.render(templates_path, template, redis_info)
+            # Holds the redis password, php run as www-data (occ, cron) reads it too.
+            return phpmods.config_module('redis_session', rendered_content, mode=0o640,
+                                         owner=('root', 'www-data'))
+
+
+def memcache_local() -> str:
+    """
+    The nextcloud memcache.local backend: APCu when the apcu php module is
+    enabled, Redis otherwise, e.g. on units installed before php-apcu was a
+    dependency, where nextcloud would fail every request without it.
+    """
+    versions = phpmods.installed_versions()
+    return 'APCu' if versions and phpmods.is_enabled('apcu', versions) else 'Redis'
+
+
+def redis_session_save_path(redis_info) -> str:
+    """
+    The phpredis session.save_path for redis_info, e.g.
+    tcp://10.0.0.5:6379?database=1&persistent=1&timeout=1.5&auth=...
+    or for a cluster (session.save_handler = rediscluster)
+    seed[]=10.0.0.5:6379&seed[]=10.0.0.6:6379&timeout=1.5&failover=error&...
+    """
+    if redis_info['redis_cluster']:
+        # Clusters only have database 0.
+        params = [('seed[]', seed) for seed in redis_info['redis_seeds']]
+        params += [
+            ('timeout', redis_info['redis_timeout']),
+            ('read_timeout', redis_info['redis_read_timeout']),
+            ('failover', 'error'),
+            ('persistent', int(redis_info['redis_persistent'])),
+        ]
+        if redis_info['redis_password']:
+            params.append(('auth', redis_info['redis_password']))
+        return urlencode(params, safe='[]:')
+    if redis_info['redis_socket']:
+        base = f"unix://{redis_info['redis_socket']}"
+    else:
+        base = f"tcp://{redis_info['redis_hostname']}:{redis_info['redis_port']}"
+    params = {
+        'database': redis_info['redis_session_dbindex'],
+        'persistent': int(redis_info['redis_persistent']),
+        'timeout': redis_info['redis_timeout'],
+        'read_timeout': redis_info['redis_read_timeout'],
+    }
+    if redis_info['redis_password']:
+        params['auth'] = redis_info['redis_password']
+    return f"{base}?{urlencode(params)}"
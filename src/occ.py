@@ -1,23 +1,108 @@
 import subprocess as sp
 from subprocess import CompletedProcess
+from pathlib import Path
 import logging
+import threading
+import json
 import sys
+import os
+import profiler
 
 logger = logging.getLogger(__name__)
 
+NEXTCLOUD_ROOT = '/var/www/nextcloud'
+OCC_WORKER_SCRIPT = Path(__file__).parent.parent / 'scripts' / 'occ-worker.php'
+
+# occ commands after which the worker's bootstrapped state (installed flag,
+# maintenance mode, loaded app commands) can no longer be trusted.
+_BOOTSTRAP_CHANGING_COMMANDS = ('maintenance:install', 'maintenance:mode', 'upgrade',
+                                'app:enable', 'app:disable', 'app:install', 'app:remove')
+
+# ISO 3166-1 codes accepted for default_phone_region.
+VALID_PHONE_REGIONS = [
+    'AD', 'AE', 'AF', 'AG', 'AI', 'AL', 'AM', 'AO', 'AQ', 'AR', 'AS', 'AT', 'AU', 'AW', 'AX',
+    'AZ', 'BA', 'BB', 'BD', 'BE', 'BF', 'BG', 'BH', 'BI', 'BJ', 'BL', 'BM', 'BN', 'BO', 'BQ',
+    'BR', 'BS', 'BT', 'BV', 'BW', 'BY', 'BZ', 'CA', 'CC', 'CD', 'CF', 'CG', 'CH', 'CI', 'CK',
+    'CL', 'CM', 'CN', 'CO', 'CR', 'CU', 'CV', 'CW', 'CX', 'CY', 'CZ', 'DE', 'DJ', 'DK', 'DM',
+    'DO', 'DZ', 'EC', 'EE', 'EG', 'EH', 'ER', 'ES', 'ET', 'FI', 'FJ', 'FK', 'FM', 'FO', 'FR',
+    'GA', 'GB', 'GD', 'GE', 'GF', 'GG', 'GH', 'GI', 'GL', 'GM', 'GN', 'GP', 'GQ', 'GR', 'GS',
+    'GT', 'GU', 'GW', 'GY', 'HK', 'HM', 'HN', 'HR', 'HT', 'HU', 'ID', 'IE', 'IL', 'IM', 'IN',
+    'IO', 'IQ', 'IR', 'IS', 'IT', 'JE', 'JM', 'JO', 'JP', 'KE', 'KG', 'KH', 'KI', 'KM', 'KN',
+    'KP', 'KR', 'KW', 'KY', 'KZ', 'LA', 'LB', 'LC', 'LI', 'LK', 'LR', 'LS', 'LT', 'LU', 'LV',
+    'LY', 'MA', 'MC', 'MD', 'ME', 'MF', 'MG', 'MH', 'MK', 'ML', 'MM', 'MN', 'MO', 'MP', 'MQ',
+    'MR', 'MS', 'MT', 'MU', 'MV', 'MW', 'MX', 'MY', 'MZ', 'NA', 'NC', 'NE', 'NF', 'NG', 'NI',
+    'NL', 'NO', 'NP', 'NR', 'NU', 'NZ', 'OM', 'PA', 'PE', 'PF', 'PG', 'PH', 'PK', 'PL', 'PM',
+    'PN', 'PR', 'PS', 'PT', 'PW', 'PY', 'QA', 'RE', 'RO', 'RS', 'RU', 'RW', 'SA', 'SB', 'SC',
+    'SD', 'SE', 'SG', 'SH', 'SI', 'SJ', 'SK', 'SL', 'SM', 'SN', 'SO', 'SR', 'SS', 'ST', 'SV',
+    'SX', 'SY', 'SZ', 'TC', 'TD', 'TF', 'TG', 'TH', 'TJ', 'TK', 'TL', 'TM', 'TN', 'TO', 'TR',
+    'TT', 'TV', 'TW', 'TZ', 'UA', 'UG', 'UM', 'US', 'UY', 'UZ', 'VA', 'VC', 'VE', 'VG', 'VI',
+    'VN', 'VU', 'WF', 'WS', 'YE', 'YT', 'ZA', 'ZM', 'ZW'
+]
+
+
+def config_list_to_dict(value) -> dict:
+    """
+    Normalizes a config list decoded from occ json output to {index: value}.
+    PHP encodes arrays with holes in their indices as objects.
+    """
+    if not value:
+        return {}
+    if isinstance(value, dict):
+        return {int(k): v for k, v in value.items()}
+    return dict(enumerate(value))
+
+
+def diff_indexed_list(current, desired):
+    """
+    Computes the minimal changes turning the config list current ({index: value})
+    into desired, laid out at indices 0..n-1.
+    Returns (sets, deletes): sets is a list of (index, value) to set,
+    deletes a list of indices to delete, highest first.
+    """
+    sets = [(i, v) for i, v in enumerate(desired) if current.get(i) != v]
+    deletes = sorted((i for i in current if not 0 <= i < len(desired)), reverse=True)
+    return sets, deletes
+
+
+class OccWorkerError(Exception):
+    """The persistent occ worker could not be started or stopped answering."""
+
 
 class Occ:
 
+    # Set while an OccSession is active, see OccSession.__enter__().
+    _session = None
+
+    @staticmethod
+    def run(args) -> CompletedProcess:
+        """
+        Runs a single occ command, given as a list of arguments without the
+        leading 'occ', e.g. ['status', '--output=json'].
+        Goes through the active OccSession if there is one, else forks.
+        """
+        with profiler.span('occ', str(args[0]) if args else ''):
+            if Occ._session is not None:
+                return Occ._session.execute(args)
+            return Occ.fork(args)
+
+    @staticmethod
+    def fork(args) -> CompletedProcess:
+        """
+        Runs a single occ command in a fresh 'sudo -u www-data php occ' process.
+        """
+        cmd = ['sudo', '-u', 'www-data', 'php', os.path.join(NEXTCLOUD_ROOT, 'occ')] + list(args)
+        return sp.run(cmd, cwd=NEXTCLOUD_ROOT,
+                      stdout=sp.PIPE, stderr=sp.PIPE, universal_newlines=True)
+
     @staticmethod
     def delete_trusted_proxies() -> CompletedProcess:
         """
         Removes all trusted_proxies from config via occ.
         """
-        cmd = ("sudo -u www-data php /var/www/nextcloud/occ config:system:set"
+        cmd = ("config:system:set"
                " trusted_proxies "
                " --value=''")
-        return sp.run(cmd.split(), cwd='/var/www/nextcloud',
-                      stdout=sp.PIPE, stderr=sp.PIPE, universal_newlines=True)
+        return Occ.run(cmd.split())
 
     @staticmethod
     def set_trusted_proxy(host, index) -> CompletedProcess:
@@ -27,11 +112,18 @@ class Occ:
         #
         # TODO: Check that the input is really a IP or host.
         #
-        cmd = ("sudo -u www-data php /var/www/nextcloud/occ config:system:set"
+        cmd = ("config:system:set"
                " trusted_proxies {index}"
                " --value={host} ").format(index=index, host=host)
-        return sp.run(cmd.split(), cwd='/var/www/nextcloud',
-                      stdout=sp.PIPE, stderr=sp.PIPE, universal_newlines=True)
+        return Occ.run(cmd.split())
+
+    @staticmethod
+    def delete_trusted_proxy(index) -> CompletedProcess:
+        """
+        Deletes the trusted proxy at the given index.
+        """
+        cmd = f"config:system:delete trusted_proxies {index}"
+        return Occ.run(cmd.split())
 
     @staticmethod
     def config_system_set_trusted_domains(domain, index) -> CompletedProcess:
@@ -39,34 +131,25 @@ class Occ:
         Adds a trusted domain to nextcloud config.php with occ
         """
 
-        cmd = ("sudo -u www-data php /var/www/nextcloud/occ config:system:set"
+        cmd = ("config:system:set"
                " trusted_domains {index}"
                " --value={domain} ").format(index=index, domain=domain)
-        return sp.run(cmd.split(), cwd='/var/www/nextcloud',
-                      stdout=sp.PIPE, stderr=sp.PIPE, universal_newlines=True)
+        return Occ.run(cmd.split())
 
     @staticmethod
     def remove_trusted_domain(domain):
         """
         Removes a trusted domain from nextcloud with occ
         """
-        current_domains = Occ.config_system_get_trusted_domains()
+        current_domains = Occ.get_trusted_domains()
         if domain in current_domains:
             current_domains.remove(domain)
-            # First delete all trusted domains from config.php
-            # since they might have indices not in order.
-            Occ.config_system_delete_trusted_domains()
-            if current_domains:
-                # Now, add all the domains with indices in order starting from 0
-                for index, domain in enumerate(current_domains):
-                    Occ.config_system_set_trusted_domains(domain, index)
+            Occ.reconcile_trusted_domains(current_domains)
 
     @staticmethod
     def config_system_delete_trusted_domains() -> CompletedProcess:
-        cmd = "sudo -u www-data php /var/www/nextcloud/occ \
-                                  config:system:delete trusted_domains"
-        return sp.run(cmd.split(), cwd='/var/www/nextcloud',
-                      stdout=sp.PIPE, stderr=sp.PIPE, universal_newlines=True)
+        cmd = "config:system:delete trusted_domains"
+        return Occ.run(cmd.split())
 
     @staticmethod
     def config_system_get_trusted_domains() -> CompletedProcess:
@@ -74,41 +157,78 @@ class Occ:
         Get all current trusted domains in config.php with occ
         return list
         """
-        cmd = "sudo -u www-data php /var/www/nextcloud/occ \
-                           config:system:get trusted_domains"
-        return sp.run(cmd.split(), cwd='/var/www/nextcloud',
-                      stdout=sp.PIPE, stderr=sp.PIPE, universal_newlines=True)
+        cmd = "config:system:get trusted_domains"
+        return Occ.run(cmd.split())
         # domains = output.stdout.split()
 
+    @staticmethod
+    def config_system_delete_trusted_domain(index) -> CompletedProcess:
+        """
+        Deletes the trusted domain at the given index.
+        """
+        cmd = f"config:system:delete trusted_domains {index}"
+        return Occ.run(cmd.split())
+
+    @staticmethod
+    def config_system_get_json(key):
+        """
+        Returns the decoded value of a system config key, or None if it is not set.
+        """
+        cp = Occ.run(['config:system:get', key, '--output=json'])
+        if cp.returncode != 0 or not cp.stdout.strip():
+            return None
+        return json.loads(cp.stdout)
+
+    @staticmethod
+    def get_trusted_domains() -> list:
+        """
+        Returns the trusted domains in config.php, ordered by index.
+        """
+        domains = config_list_to_dict(Occ.config_system_get_json('trusted_domains'))
+        return [domain for _, domain in sorted(domains.items())]
+
+    @staticmethod
+    def reconcile_trusted_domains(domains) -> int:
+        """
+        Makes trusted_domains in config.php equal to domains (at indices 0..n-1)
+        with as few occ calls as possible. The list is read once. Changed
+        indices are set before surplus ones are deleted, so there is never a
+        moment where a domain that stays trusted is missing.
+        Returns the number of changes made.
+        """
+        current = config_list_to_dict(Occ.config_system_get_json('trusted_domains'))
+        sets, deletes = diff_indexed_list(current, domains)
+        for index, domain in sets:
+            Occ.config_system_set_trusted_domains(domain, index)
+        for index in deletes:
+            Occ.config_system_delete_trusted_domain(index)
+        if sets or deletes:
+            logger.info(f"trusted_domains reconciled: {len(sets)} set, {len(deletes)} deleted.")
+        return len(sets) + len(deletes)
+
     @staticmethod
     def update_trusted_domains_peer_ips(domains):
-        current_domains = Occ.config_system_get_trusted_domains().stdout.split()
+        current_domains = Occ.get_trusted_domains()
         # Copy 'localhost' and fqdn but replace all peers IP:s
         # with the ones currently available in the relation.
         new_domains = current_domains[0:2] + domains[:]
-        Occ.config_system_delete_trusted_domains()
-        for index, d in enumerate(new_domains):
-            Occ.config_system_set_trusted_domains(d, index)
+        Occ.reconcile_trusted_domains(new_domains)
 
     @staticmethod
     def db_add_missing_indices() -> CompletedProcess:
-        cmd = "sudo -u www-data php /var/www/nextcloud/occ db:add-missing-indices"
-        return sp.run(cmd.split(), cwd='/var/www/nextcloud',
-                      stdout=sp.PIPE, stderr=sp.PIPE, universal_newlines=True)
+        cmd = "db:add-missing-indices"
+        return Occ.run(cmd.split())
 
     @staticmethod
     def db_convert_filecache_bigint() -> CompletedProcess:
-        cmd = "sudo -u www-data php /var/www/nextcloud/occ \
-               db:convert-filecache-bigint --no-interaction"
-        return sp.run(cmd.split(), cwd='/var/www/nextcloud',
-                      stdout=sp.PIPE, stderr=sp.PIPE, universal_newlines=True)
+        cmd = "db:convert-filecache-bigint --no-interaction"
+        return Occ.run(cmd.split())
 
     @staticmethod
     def maintenance_mode(enable) -> CompletedProcess:
         m = "--on" if enable else "--off"
-        cmd = f"sudo -u www-data php /var/www/nextcloud/occ maintenance:mode {m}"
-        return sp.run(cmd.split(), cwd='/var/www/nextcloud',
-                      stdout=sp.PIPE, stderr=sp.PIPE, universal_newlines=True)
+        cmd = f"maintenance:mode {m}"
+        return Occ.run(cmd.split())
 
     @staticmethod
     def maintenance_install(ctx) -> CompletedProcess:
@@ -116,14 +236,16 @@ class Occ:
         Initializes nextcloud via the nextcloud occ interface.
         :return: <CompletedProcess>
         """
-        cmd = ("sudo -u www-data /usr/bin/php occ maintenance:install "
+        cmd = ("maintenance:install "
                "--database {dbtype} --database-name {dbname} "
                "--database-host {dbhost} --database-pass {dbpass} "
                "--database-user {dbuser} --admin-user {adminusername} "
                "--admin-pass {adminpassword} "
                "--data-dir {datadir} ").format(**ctx)
-        cp = sp.run(cmd.split(), cwd='/var/www/nextcloud',
-                    stdout=sp.PIPE, stderr=sp.PIPE, universal_newlines=True)
+        # Always forked: a worker bootstrapped before the install would not see it.
+        cp = Occ.fork(cmd.split())
+        if Occ._session is not None:
+            Occ._session.close()
 
         # Remove potential passwords from reaching the log.
         cp.args[13] = '*********'
@@ -142,9 +264,8 @@ class Occ:
         """
         Returns CompletedProcess with nextcloud status in .stdout as json.
         """
-        cmd = "sudo -u www-data /usr/bin/php occ status --output=json --no-warnings"
-        return sp.run(cmd.split(), cwd='/var/www/nextcloud',
-                      stdout=sp.PIPE, stderr=sp.PIPE, universal_newlines=True)
+        cmd = "status --output=json --no-warnings"
+        return Occ.run(cmd.split())
 
     @staticmethod
     def overwriteprotocol(protocol='http') -> CompletedProcess:
@@ -154,9 +275,8 @@ class Occ:
         """
         if protocol == "http" or protocol == "https":
             logger.info("Setting overwriteprotocol to: " + protocol)
-            cmd = ("sudo -u www-data /usr/bin/php occ config:system:set overwriteprotocol --value=" + protocol)
-            return sp.run(cmd.split(), cwd='/var/www/nextcloud',
-                          stdout=sp.PIPE, stderr=sp.PIPE, universal_newlines=True)
+            cmd = ("config:system:set overwriteprotocol --value=" + protocol)
+            return Occ.run(cmd.split())
         else:
             logger.error("Unsupported overwriteprotocol provided as config: " + protocol)
             sys.exit(-1)
@@ -167,25 +287,10 @@ class Occ:
         Sets the default_phone_region with occ
         :return:
         """
-        valid_codes = ['AD', 'AE', 'AF', 'AG', 'AI', 'AL', 'AM', 'AO', 'AQ', 'AR', 'AS', 'AT', 'AU', 'AW', 'AX', 'AZ', 'BA', 'BB',
-        'BD', 'BE', 'BF', 'BG', 'BH', 'BI', 'BJ', 'BL', 'BM', 'BN', 'BO', 'BQ', 'BR', 'BS', 'BT', 'BV', 'BW', 'BY',
-        'BZ', 'CA', 'CC', 'CD', 'CF', 'CG', 'CH', 'CI', 'CK', 'CL', 'CM', 'CN', 'CO', 'CR', 'CU', 'CV', 'CW', 'CX',
-        'CY', 'CZ', 'DE', 'DJ', 'DK', 'DM', 'DO', 'DZ', 'EC', 'EE', 'EG', 'EH', 'ER', 'ES', 'ET', 'FI', 'FJ', 'FK',
-        'FM', 'FO', 'FR', 'GA', 'GB', 'GD', 'GE', 'GF', 'GG', 'GH', 'GI', 'GL', 'GM', 'GN', 'GP', 'GQ', 'GR', 'GS',
-        'GT', 'GU', 'GW', 'GY', 'HK', 'HM', 'HN', 'HR', 'HT', 'HU', 'ID', 'IE', 'IL', 'IM', 'IN', 'IO', 'IQ', 'IR',
-        'IS', 'IT', 'JE', 'JM', 'JO', 'JP', 'KE', 'KG', 'KH', 'KI', 'KM', 'KN', 'KP', 'KR', 'KW', 'KY', 'KZ', 'LA',
-        'LB', 'LC', 'LI', 'LK', 'LR', 'LS', 'LT', 'LU', 'LV', 'LY', 'MA', 'MC', 'MD', 'ME', 'MF', 'MG', 'MH', 'MK',
-        'ML', 'MM', 'MN', 'MO', 'MP', 'MQ', 'MR', 'MS', 'MT', 'MU', 'MV', 'MW', 'MX', 'MY', 'MZ', 'NA', 'NC', 'NE',
-        'NF', 'NG', 'NI', 'NL', 'NO', 'NP', 'NR', 'NU', 'NZ', 'OM', 'PA', 'PE', 'PF', 'PG', 'PH', 'PK', 'PL', 'PM',
-        'PN', 'PR', 'PS', 'PT', 'PW', 'PY', 'QA', 'RE', 'RO', 'RS', 'RU', 'RW', 'SA', 'SB', 'SC', 'SD', 'SE', 'SG',
-        'SH', 'SI', 'SJ', 'SK', 'SL', 'SM', 'SN', 'SO', 'SR', 'SS', 'ST', 'SV', 'SX', 'SY', 'SZ', 'TC', 'TD', 'TF',
-        'TG', 'TH', 'TJ', 'TK', 'TL', 'TM', 'TN', 'TO', 'TR', 'TT', 'TV', 'TW', 'TZ', 'UA', 'UG', 'UM', 'US', 'UY',
-        'UZ', 'VA', 'VC', 'VE', 'VG', 'VI', 'VN', 'VU', 'WF', 'WS', 'YE', 'YT', 'ZA', 'ZM', 'ZW']
-        if regionCode in valid_codes:
+        if regionCode in VALID_PHONE_REGIONS:
             logger.info("Setting default_phone_region to: " + regionCode)
-            cmd = ("sudo -u www-data /usr/bin/php occ config:system:set default_phone_region --value=" + regionCode)
-            return sp.run(cmd.split(), cwd='/var/www/nextcloud',
-                          stdout=sp.PIPE, stderr=sp.PIPE, universal_newlines=True)
+            cmd = ("config:system:set default_phone_region --value=" + regionCode)
+            return Occ.run(cmd.split())
         else:
             logger.error("Unsupported phone region code provided as config: " + regionCode)
             sys.exit(-1)
@@ -195,9 +300,8 @@ class Occ:
         """
         Sets the background job scheulder to cron
         """
-        cmd = "sudo -u www-data /usr/bin/php occ background:cron --no-warnings"
-        return sp.run(cmd.split(), cwd='/var/www/nextcloud',
-                      stdout=sp.PIPE, stderr=sp.PIPE, universal_newlines=True)
+        cmd = "background:cron --no-warnings"
+        return Occ.run(cmd.split())
 
     @staticmethod
     def setRewriteBase() -> CompletedProcess:
@@ -206,18 +310,16 @@ class Occ:
         https://nextcloud.dwellir.com/index.php/login -> https://nextcloud.dwellir.com/login
         updateHtaccess() must run for this to have effect.
         """
-        cmd = "sudo -u www-data php occ config:system:set htaccess.RewriteBase --value='/'"
-        return sp.run(cmd.split(), cwd='/var/www/nextcloud',
-                      stdout=sp.PIPE, stderr=sp.PIPE, universal_newlines=True)
+        cmd = "config:system:set htaccess.RewriteBase --value='/'"
+        return Occ.run(cmd.split())
 
     @staticmethod
     def updateHtaccess() -> CompletedProcess:
         """
         Updates the .htaccess file. Needed for some settings to have effect, e.g. setRewriteBase().
         """
-        cmd = "sudo -u www-data php occ maintenance:update:htaccess"
-        return sp.run(cmd.split(), cwd='/var/www/nextcloud',
-                      stdout=sp.PIPE, stderr=sp.PIPE, universal_newlines=True)
+        cmd = "maintenance:update:htaccess"
+        return Occ.run(cmd.split())
 
     @staticmethod
     def overwriteCliUrl(url) -> CompletedProcess:
@@ -225,15 +327,153 @@ class Occ:
         Specify the base URL for any URLs which are generated within Nextcloud using any kind of command
         line tools (cron or occ). The value should contain the full base URL: https://nextcloud.dwellir.com
         """
-        cmd = f"sudo -u www-data php occ config:system:set overwrite.cli.url --value={url}"
-        return sp.run(cmd.split(), cwd='/var/www/nextcloud',
-                      stdout=sp.PIPE, stderr=sp.PIPE, universal_newlines=True)
+        cmd = f"config:system:set overwrite.cli.url --value={url}"
+        return Occ.run(cmd.split())
 
     @staticmethod
     def setDebug(onoff: bool) -> CompletedProcess:
         """
         Set the debug flag in config.php
         """
-        cmd = f"sudo -u www-data php occ config:system:set debug --type=boolean --value={onoff}"
-        return sp.run(cmd.split(), cwd='/var/www/nextcloud',
-                      stdout=sp.PIPE, stderr=sp.PIPE, universal_newlines=True)
+        cmd = f"config:system:set debug --type=boolean --value={onoff}"
+        return Occ.run(cmd.split())
+
+
+class OccSession(Occ):
+    """
+    Keeps one long-lived occ worker (scripts/occ-worker.php) for the duration
+    of a hook, so that Nextcloud is bootstrapped once instead of once per
+    occ command. While the session is active every Occ call goes through it:
+
+        with OccSession():
+            Occ.maintenance_mode(enable=True)
+            ...
+
+    The worker is started lazily on the first occ call. If it can not be
+    started, or dies, the session falls back to forking one process per call.
+    """
+
+    def __init__(self, nextcloud_root=NEXTCLOUD_ROOT, startup_timeout=60.0):
+        self._nextcloud_root = nextcloud_root
+        self._startup_timeout = startup_timeout
+        self._proc = None
+        self._request_id = 0
+        self._config_signature = None
+        self._fallback = False
+
+    def __enter__(self):
+        Occ._session = self
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        Occ._session = None
+        self.close()
+
+    def execute(self, args) -> CompletedProcess:
+        """
+        Runs one occ command in the worker, or forks if the worker is unusable.
+        """
+        if self._fallback:
+            return Occ.fork(args)
+        try:
+            self._ensure_worker()
+            cp = self._call(args)
+        except OccWorkerError as e:
+            logger.warning(f"occ worker unavailable, forking per occ call from now on: {e}")
+            self._fallback = True
+            self.close()
+            return Occ.fork(args)
+
+        if args and str(args[0]).startswith(_BOOTSTRAP_CHANGING_COMMANDS):
+            self.close()
+        else:
+            # Changes made by our own command are already known to the worker.
+            self._config_signature = self._read_config_signature()
+        return cp
+
+    def close(self):
+        """
+        Stops the worker. The next call through the session starts a new one.
+        """
+        if self._proc is None:
+            return
+        proc, self._proc = self._proc, None
+        try:
+            # EOF on stdin ends the worker loop.
+            proc.stdin.close()
+            proc.wait(timeout=10)
+        except (OSError, sp.TimeoutExpired):
+            proc.kill()
+            proc.wait()
+        finally:
+            proc.stdout.close()
+
+    def _ensure_worker(self):
+        if self._proc is not None and self._proc.poll() is None:
+            # config.php changed behind the worker's back, e.g. written by a peer hook.
+            if self._read_config_signature() == self._config_signature:
+                return
+            logger.debug("Nextcloud config changed on disk, restarting occ worker.")
+        self.close()
+        self._start_worker()
+
+    @profiler.timed('occ', 'worker-start')
+    def _start_worker(self):
+        try:
+            code = OCC_WORKER_SCRIPT.read_text().replace('<?php', '', 1)
+            cmd = ['sudo', '-u', 'www-data', 'php', '-r', code, '--', self._nextcloud_root]
+            self._config_signature = self._read_config_signature()
+            self._proc = sp.Popen(cmd, cwd=self._nextcloud_root, stdin=sp.PIPE, stdout=sp.PIPE,
+                                  universal_newlines=True, bufsize=1)
+        except OSError as e:
+            raise OccWorkerError(f"could not start worker: {e}")
+
+        # Bootstrapping Nextcloud should take seconds, a hung worker is killed.
+        watchdog = threading.Timer(self._startup_timeout, self._proc.kill)
+        watchdog.start()
+        try:
+            while not self._read_message().get('ready'):
+                pass
+        finally:
+            watchdog.cancel()
+        logger.debug("occ worker started.")
+
+    def _call(self, args) -> CompletedProcess:
+        self._request_id += 1
+        request = {'id': self._request_id, 'argv': [str(a) for a in args]}
+        try:
+            self._proc.stdin.write(json.dumps(request) + "\n")
+            self._proc.stdin.flush()
+        except OSError as e:
+            raise OccWorkerError(f"could not send request: {e}")
+
+        while True:
+            response = self._read_message()
+            if response.get('id') == self._request_id:
+                break
+        cmd = ['sudo', '-u', 'www-data', 'php', os.path.join(self._nextcloud_root, 'occ')]
+        return CompletedProcess(cmd + request['argv'], response.get('returncode', 1),
+                                stdout=response.get('stdout', ''), stderr='')
+
+    def _read_message(self) -> dict:
+        """
+        Reads the next protocol message, skipping anything that is not one.
+        """
+        line = self._proc.stdout.readline()
+        if not line:
+            raise OccWorkerError("worker exited unexpectedly")
+        try:
+            message = json.loads(line)
+        except ValueError:
+            logger.debug(f"occ worker: {line.rstrip()}")
+            return {}
+        return message if isinstance(message, dict) else {}
+
+    def _read_config_signature(self):
+        config_dir = os.path.join(self._nextcloud_root, 'config')
+        try:
+            with os.scandir(config_dir) as entries:
+                return sorted((e.name, e.stat().st_mtime_ns, e.stat().st_size)
+                              for e in entries if e.name.endswith('.php'))
+        except OSError:
+            return None
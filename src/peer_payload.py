@@ -0,0 +1,88 @@
+import base64
+import hashlib
+import json
+import re
+import zlib
+
+# Bumped when the layout of the payload changes.
+FORMAT = 1
+
+# Keys whose values are taken out of the payload, see split_secrets();
+# the charm shares them through a Juju secret instead.
+SECRET_KEYS = {
+    'config.php': ('dbpassword', 'secret', 'passwordsalt'),
+    'ceph.config.php': ('key', 'secret'),
+}
+PLACEHOLDER = "'@juju-secret:{}@'"
+_PLACEHOLDER_RE = re.compile(r"'@juju-secret:([a-z0-9-]+)@'")
+
+
+def encode(files) -> tuple:
+    """
+    Packs files, {name: content}, for the cluster app databag.
+    Returns (payload, sha256): payload is the zlib compressed json as base64
+    text, sha256 the digest of the uncompressed json, equal for equal files.
+    """
+    data = json.dumps({'format': FORMAT, 'files': files}, sort_keys=True).encode()
+    return base64.b64encode(zlib.compress(data, 9)).decode(), hashlib.sha256(data).hexdigest()
+
+
+def decode(payload, sha256=None) -> dict:
+    """
+    Unpacks a payload from encode() into {name: content}.
+    Raises ValueError if it is damaged, doesn't match sha256 (when given)
+    or has an unknown format.
+    """
+    try:
+        data = zlib.decompress(base64.b64decode(payload, validate=True))
+    except (ValueError, zlib.error) as e:
+        raise ValueError(f"Damaged peer payload: {e}")
+    if sha256 is not None and hashlib.sha256(data).hexdigest() != sha256:
+        raise ValueError("Peer payload doesn't match its digest")
+    content = json.loads(data)
+    if content.get('format') != FORMAT:
+        raise ValueError(f"Unknown peer payload format: {content.get('format')}")
+    return content['files']
+
+
+def split_secrets(files) -> tuple:
+    """
+    Takes the values of SECRET_KEYS out of files, {name: content}, leaving
+    placeholders. config.php is written by php's var_export, so the values
+    are single quoted php strings.
+    Returns (files, secrets): secrets maps Juju secret content keys, e.g.
+    'config-php-dbpassword', to the php literals taken out.
+    """
+    shared = {}
+    secrets = {}
+    for name, content in files.items():
+        keys = SECRET_KEYS.get(name)
+        if keys:
+            names = '|'.join(map(re.escape, keys))
+            # 'key' => 'value', the value a single quoted php string.
+            pattern = re.compile(r"('(%s)'\s*=>\s*)('(?:[^'\\]|\\.)*')" % names)
+
+            def take(match, name=name):
+                base = re.sub(r'[^a-z0-9]+', '-', f"{name}-{match.group(2)}".lower()).strip('-')
+                key = base
+                n = 0
+                while key in secrets:
+                    n += 1
+                    key = f"{base}-{n}"
+                secrets[key] = match.group(3)
+                return match.group(1) + PLACEHOLDER.format(key)
+            content = pattern.sub(take, content)
+        shared[name] = content
+    return shared, secrets
+
+
+def join_secrets(files, secrets) -> dict:
+    """
+    Puts the values taken out by split_secrets() back into files.
+    Raises ValueError if secrets lacks one of them.
+    """
+    def restore(match):
+        if match.group(1) not in secrets:
+            raise ValueError(f"Secret value {match.group(1)} missing")
+        return secrets[match.group(1)]
+    return {name: _PLACEHOLDER_RE.sub(restore, content) for name, content in files.items()}
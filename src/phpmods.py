@@ -0,0 +1,69 @@
+import logging
+import re
+import subprocess as sp
+from pathlib import Path
+import templating
+
+logger = logging.getLogger(__name__)
+
+PHP_ETC = Path('/etc/php')
+
+
+def installed_versions() -> list:
+    """
+    Returns the php versions with a config tree under /etc/php, e.g. ['8.1', '8.3'].
+    """
+    if not PHP_ETC.is_dir():
+        return []
+    return sorted((p.name for p in PHP_ETC.iterdir()
+                   if re.fullmatch(r'\d+\.\d+', p.name) and (p / 'mods-available').is_dir()),
+                  key=lambda v: tuple(int(x) for x in v.split('.')))
+
+
+def is_enabled(name, versions=None) -> bool:
+    """
+    Returns True if module name is enabled for every SAPI of every version.
+    """
+    for version in versions or installed_versions():
+        for confd in (PHP_ETC / version).glob('*/conf.d'):
+            if not any(confd.glob(f'*-{name}.ini')):
+                return False
+    return True
+
+
+def config_module(name, content, mode=0o644, owner=None) -> bool:
+    """
+    Writes mods-available/<name>.ini with content for all installed php
+    versions and enables it, with a single phpenmod for all of them.
+    content should start with a '; priority=NN' line for phpenmod.
+    Returns True if any version's module changed or got enabled.
+    """
+    versions = installed_versions()
+    if not versions:
+        raise RuntimeError(f"No php installed under {PHP_ETC}, can't configure {name}.ini")
+    changed = False
+    for version in versions:
+        target = PHP_ETC / version / 'mods-available' / f'{name}.ini'
+        changed = templating.write_if_changed(target, content, mode=mode, owner=owner) or changed
+    if changed or not is_enabled(name, versions):
+        sp.check_call(['phpenmod', '-v', 'ALL', '-s', 'ALL', name])
+        changed = True
+    if changed:
+        logger.info(f"php module {name} configured for php {', '.join(versions)}")
+    return changed
+
+
+def remove_module(name) -> bool:
+    """
+    Disables and removes module name from all installed php versions.
+    Returns True if it was there.
+    """
+    versions = installed_versions()
+    targets = [PHP_ETC / v / 'mods-available' / f'{name}.ini' for v in versions]
+    if not any(t.exists() for t in targets):
+        return False
+    sp.check_call(['phpdismod', '-v', 'ALL', '-s', 'ALL', name])
+    for target in targets:
+        target.unlink(missing_ok=True)
+    logger.info(f"php module {name} removed from php {', '.join(versions)}")
+    return True
@@ -0,0 +1,264 @@
+import functools
+import json
+import logging
+import os
+import time
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from pathlib import Path
+
+logger = logging.getLogger(__name__)
+
+# One json line per dispatch: the timing tree of its hook handlers, occ
+# calls, subprocesses and apt runs.
+PROFILE_LOG = Path('/var/log/nextcloud-charm/hook-profile.jsonl')
+# The log is trimmed to the last KEEP_DISPATCHES once twice that long.
+KEEP_DISPATCHES = 100
+# cProfile and tracemalloc dumps of the slowest dispatches, see enable().
+PROFILE_DIR = Path('/var/log/nextcloud-charm/profiles')
+KEEP_PROFILES = 5
+PROFILE_MODES = ('', 'cprofile', 'tracemalloc')
+# Commands recorded in spans are cut to this many arguments.
+MAX_RECORDED_ARGS = 6
+
+# Open spans of the current dispatch, outermost first.
+_stack = []
+_mode = ''
+_cprofile = None
+
+
+class Span:
+    """
+    A timed piece of work and the spans it contains.
+    """
+
+    def __init__(self, kind, name, **attrs):
+        self.kind = kind
+        self.name = name
+        self.attrs = attrs
+        self.children = []
+        self.start = time.monotonic()
+        self.seconds = None
+
+    def to_dict(self) -> dict:
+        d = {'kind': self.kind, 'name': self.name,
+             'ms': round((self.seconds or 0) * 1000, 3)}
+        d.update(self.attrs)
+        if self.children:
+            d['children'] = [c.to_dict() for c in self.children]
+        return d
+
+
+@contextmanager
+def span(kind, name, **attrs):
+    """
+    Times the enclosed block as a child of the current span.
+    Does nothing outside of dispatch(), e.g. in unittests.
+    """
+    if not _stack:
+        yield None
+        return
+    s = Span(kind, name, **attrs)
+    _stack[-1].children.append(s)
+    _stack.append(s)
+    try:
+        yield s
+    except BaseException as e:
+        s.attrs['error'] = type(e).__name__
+        raise
+    finally:
+        s.seconds = time.monotonic() - s.start
+        _stack.pop()
+
+
+def timed(kind, name=None):
+    """
+    Decorator timing every call of the function as a span.
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with span(kind, name or func.__qualname__):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def instrument_handlers(cls):
+    """
+    Class decorator timing all event handlers, the methods named _on_*.
+    The wrappers keep the handlers' names, as the ops framework needs them.
+    """
+    for attr, value in list(vars(cls).items()):
+        if attr.startswith('_on_') and callable(value):
+            setattr(cls, attr, timed('hook')(value))
+    return cls
+
+
+class TimedSubprocess:
+    """
+    Stands in for the subprocess module, timing run, call, check_call and
+    check_output. apt runs are recorded as 'apt', everything else as
+    'subprocess'.
+    """
+
+    TIMED = ('run', 'call', 'check_call', 'check_output')
+
+    def __init__(self, module):
+        self._module = module
+
+    def __getattr__(self, attr):
+        value = getattr(self._module, attr)
+        if attr not in self.TIMED:
+            return value
+
+        @functools.wraps(value)
+        def wrapper(args, *a, **kw):
+            argv = args.split() if isinstance(args, str) else [str(x) for x in args]
+            kind = 'apt' if {'apt', 'apt-get'} & set(argv[:3]) else 'subprocess'
+            with span(kind, ' '.join(argv[:MAX_RECORDED_ARGS])):
+                return value(args, *a, **kw)
+        return wrapper
+
+
+def enable(mode):
+    """
+    Profiles the rest of the dispatch with cProfile ('cprofile') or
+    tracemalloc ('tracemalloc'); the KEEP_PROFILES slowest dispatches'
+    profiles are kept in PROFILE_DIR. '' profiles nothing.
+    """
+    global _mode, _cprofile
+    if mode not in PROFILE_MODES:
+        raise ValueError(f"Unsupported profiling mode: {mode}")
+    if not mode or _mode or not _stack:
+        return
+    _mode = mode
+    if mode == 'cprofile':
+        import cProfile
+        _cprofile = cProfile.Profile()
+        _cprofile.enable()
+    else:
+        import tracemalloc
+        tracemalloc.start(10)
+
+
+@contextmanager
+def dispatch(hook):
+    """
+    Times a whole dispatch of the charm and appends its record to
+    PROFILE_LOG: the hook, its duration, error, ms per span kind and the
+    tree of spans.
+    """
+    global _mode
+    root = Span('dispatch', hook)
+    _stack[:] = [root]
+    started = datetime.now(timezone.utc).isoformat(timespec='seconds')
+    try:
+        yield root
+    except BaseException as e:
+        # sys.exit(0) is how some handlers end a hook.
+        if not (isinstance(e, SystemExit) and not e.code):
+            root.attrs['error'] = type(e).__name__
+        raise
+    finally:
+        root.seconds = time.monotonic() - root.start
+        _stack.clear()
+        record = {
+            'hook': hook,
+            'unit': os.environ.get('JUJU_UNIT_NAME'),
+            'started': started,
+            'ms': round(root.seconds * 1000, 3),
+            'error': root.attrs.get('error'),
+            'totals': totals(root),
+            'spans': [c.to_dict() for c in root.children],
+        }
+        if _mode:
+            record.update(_dump_profile(hook, root.seconds))
+            _mode = ''
+        _append(record)
+
+
+def totals(root) -> dict:
+    """
+    Returns the ms spent per span kind below root, nested spans of the
+    same kind are not counted twice.
+    """
+    result = {}
+
+    def walk(s, open_kinds):
+        if s.kind not in open_kinds:
+            result[s.kind] = result.get(s.kind, 0) + (s.seconds or 0) * 1000
+        for c in s.children:
+            walk(c, open_kinds | {s.kind})
+    for c in root.children:
+        walk(c, frozenset())
+    return {k: round(v, 3) for k, v in sorted(result.items())}
+
+
+def recent(count=10, slowest=False) -> list:
+    """
+    Returns the last count dispatch records from PROFILE_LOG, or the
+    slowest count of those in the log.
+    """
+    try:
+        lines = PROFILE_LOG.read_text().splitlines()
+    except FileNotFoundError:
+        return []
+    records = []
+    for line in lines:
+        try:
+            records.append(json.loads(line))
+        except ValueError:
+            continue
+    if slowest:
+        return sorted(records, key=lambda r: r.get('ms', 0), reverse=True)[:count]
+    return records[-count:]
+
+
+def _append(record):
+    try:
+        PROFILE_LOG.parent.mkdir(parents=True, exist_ok=True)
+        with open(PROFILE_LOG, 'a') as f:
+            f.write(json.dumps(record) + '\n')
+        lines = PROFILE_LOG.read_text().splitlines()
+        if len(lines) > 2 * KEEP_DISPATCHES:
+            tmp = PROFILE_LOG.with_name(f".{PROFILE_LOG.name}.tmp")
+            tmp.write_text('\n'.join(lines[-KEEP_DISPATCHES:]) + '\n')
+            os.replace(tmp, PROFILE_LOG)
+    except OSError as e:
+        logger.debug(f"Could not write hook profile: {e}")
+
+
+def _dump_profile(hook, seconds) -> dict:
+    """
+    Stops the profiler enabled for this dispatch and keeps its dump if it
+    is among the KEEP_PROFILES slowest.
+    Returns what to add to the dispatch record.
+    """
+    global _cprofile
+    name = f"{int(seconds * 1000):09d}ms-{Path(hook).name}-{time.time_ns() // 1000}"
+    extra = {}
+    try:
+        PROFILE_DIR.mkdir(parents=True, exist_ok=True)
+        if _mode == 'cprofile':
+            _cprofile.disable()
+            path = PROFILE_DIR / f"{name}.prof"
+            _cprofile.dump_stats(path)
+            _cprofile = None
+        else:
+            import tracemalloc
+            _, peak = tracemalloc.get_traced_memory()
+            stats = tracemalloc.take_snapshot().statistics('lineno')[:30]
+            tracemalloc.stop()
+            path = PROFILE_DIR / f"{name}.tracemalloc.txt"
+            path.write_text(f"peak {peak // 1024} KiB\n" + '\n'.join(str(s) for s in stats) + '\n')
+            extra['peak_kib'] = peak // 1024
+        # Names start with the zero padded duration, so sorting ranks them.
+        dumps = sorted(PROFILE_DIR.glob('*ms-*'), reverse=True)
+        for old in dumps[KEEP_PROFILES:]:
+            old.unlink()
+        if path.exists():
+            extra['profile'] = str(path)
+    except OSError as e:
+        logger.debug(f"Could not write profile: {e}")
+    return extra
@@ -0,0 +1,60 @@
+import hashlib
+import json
+import logging
+import time
+import profiler
+
+logger = logging.getLogger(__name__)
+
+RAN = 'ran'
+UNCHANGED = 'unchanged'
+WAITING = 'waiting'
+RETRY = 'retry'
+
+
+def fingerprint(inputs) -> str:
+    """
+    Returns a digest of inputs, anything json serializable.
+    """
+    data = json.dumps(inputs, sort_keys=True, default=str)
+    return hashlib.sha256(data.encode()).hexdigest()
+
+
+def run_steps(steps, fingerprints) -> list:
+    """
+    Runs the steps whose inputs changed since they last completed.
+
+    steps is a list of (name, inputs, action). inputs is a callable returning
+    the desired and cheaply observable state the step depends on, or None
+    while the step's prerequisites are missing; action does the work.
+    fingerprints maps step names to the digest of their inputs after they
+    last completed, e.g. a StoredState dict, and is updated in place.
+    The digest is taken again after the action, so what a step changes
+    itself (e.g. enabled apache modules) doesn't make it run again.
+    A step that raises, or whose action returns False, keeps its old digest
+    and runs again next time.
+
+    Returns a list of (name, outcome, seconds), outcome is one of
+    RAN, UNCHANGED, WAITING or RETRY.
+    """
+    report = []
+    for name, inputs, action in steps:
+        start = time.monotonic()
+        with profiler.span('step', name) as s:
+            current = inputs()
+            if current is None:
+                fingerprints.pop(name, None)
+                outcome = WAITING
+            elif fingerprints.get(name) == fingerprint(current):
+                outcome = UNCHANGED
+            elif action() is False:
+                outcome = RETRY
+            else:
+                fingerprints[name] = fingerprint(inputs())
+                outcome = RAN
+            if s:
+                s.attrs['outcome'] = outcome
+        report.append((name, outcome, time.monotonic() - start))
+    logger.info("Reconciled: " + ", ".join(f"{name} {outcome} {seconds:.3f}s"
+                                           for name, outcome, seconds in report))
+    return report
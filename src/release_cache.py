@@ -0,0 +1,233 @@
+import logging
+import hashlib
+import json
+import os
+import re
+import shutil
+import subprocess as sp
+import tempfile
+import time
+from pathlib import Path
+import utils
+
+logger = logging.getLogger(__name__)
+
+CACHE_DIR = Path('/var/cache/nextcloud-charm/releases')
+
+# Response headers telling if a moving url (e.g. latest-29.tar.bz2) changed.
+_VALIDATOR_HEADERS = ('ETag', 'Last-Modified', 'Content-Length')
+
+
+class ReleaseCache:
+    """
+    Content addressed cache of nextcloud release tarfiles and their extracted
+    trees, kept on the machine across unit redeploys:
+
+        <cache_dir>/archives/<sha256>   the tarfile as downloaded or supplied
+        <cache_dir>/trees/<sha256>/     the pristine extracted tree (nextcloud/...)
+        <cache_dir>/index.json          urls and entries, see _load_index()
+
+    Installing a cached release is a reflink copy of its tree (a plain copy on
+    filesystems without reflinks) instead of a download and a decompress.
+    Hardlinks are not used since nextcloud rewrites files like .htaccess in
+    place, which would corrupt the cached tree.
+    Least recently used entries are evicted when max_size (bytes) is exceeded.
+    """
+
+    def __init__(self, cache_dir=CACHE_DIR, max_size=None):
+        self._cache_dir = Path(cache_dir)
+        self._archives = self._cache_dir / 'archives'
+        self._trees = self._cache_dir / 'trees'
+        self._index_path = self._cache_dir / 'index.json'
+        self._max_size = max_size
+        self._archives.mkdir(parents=True, exist_ok=True)
+        self._trees.mkdir(parents=True, exist_ok=True)
+        self._index = self._load_index()
+
+    def lookup(self, url, sha256=None):
+        """
+        Returns the sha256 of the cached release for url, or None if not cached.
+        Without a sha256 the url's release is assumed unchanged as long as
+        the server reports the same ETag/Last-Modified/Content-Length.
+        """
+        if sha256:
+            digest = _valid_digest(sha256)
+            return digest if self._has(digest) else None
+        known = self._index['urls'].get(url)
+        if not known or not self._has(known['sha256']):
+            return None
+        validators = _head_validators(url)
+        if validators is not None and validators != known.get('validators'):
+            logger.info(f"{url} changed upstream, not using the cached release.")
+            return None
+        return known['sha256']
+
+    def add_url(self, url, sha256=None, progress=None) -> str:
+        """
+        Makes sure the release at url is cached, downloading it if needed.
+        Returns its sha256.
+        """
+        digest = self.lookup(url, sha256)
+        if digest:
+            logger.info(f"Release {url} found in cache ({digest}).")
+            return digest
+
+        tree = Path(tempfile.mkdtemp(prefix='.tmp-', dir=self._trees))
+        with tempfile.NamedTemporaryFile(prefix='.tmp-', dir=self._archives, delete=False) as f:
+            try:
+                digest = utils.fetch_and_extract_nextcloud(url, sha256, progress,
+                                                           dst=tree, archive=f)
+            except BaseException:
+                os.unlink(f.name)
+                shutil.rmtree(tree, ignore_errors=True)
+                raise
+        self._index['urls'][url] = {'sha256': digest, 'validators': _head_validators(url)}
+        self._store(digest, Path(f.name), tree, url)
+        return digest
+
+    def add_file(self, path) -> str:
+        """
+        Makes sure the release tarfile at path is cached. Returns its sha256.
+        """
+        sha = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                sha.update(chunk)
+        digest = sha.hexdigest()
+        if self._has(digest):
+            logger.info(f"Release {path} found in cache ({digest}).")
+            return digest
+
+        archive = self._archives / f".tmp-{digest}"
+        tree = Path(tempfile.mkdtemp(prefix='.tmp-', dir=self._trees))
+        try:
+            sp.run(['cp', '--reflink=auto', str(path), str(archive)], check=True)
+            utils.extract_nextcloud(archive, dst=tree)
+        except BaseException:
+            archive.unlink(missing_ok=True)
+            shutil.rmtree(tree, ignore_errors=True)
+            raise
+        self._store(digest, archive, tree, str(path))
+        return digest
+
+    def install(self, digest, dst=Path('/var/www/')):
+        """
+        Copies the cached tree of a release into dst, like extracting it there.
+        """
+        tree = self._trees / _valid_digest(digest)
+        logger.info(f"Installing cached release {digest} into {dst}")
+        sp.run(['cp', '-a', '--reflink=auto', f"{tree}/.", str(dst)], check=True)
+        self._index['entries'][digest]['last_used'] = time.time()
+        self._save_index()
+        self.evict(keep=[digest])
+
+    def evict(self, keep=()):
+        """
+        Removes least recently used releases until the cache fits in max_size.
+        Returns the evicted sha256s.
+        """
+        if not self._max_size:
+            return []
+        entries = self._index['entries']
+        total = sum(e['size'] for e in entries.values())
+        evicted = []
+        for digest in sorted(entries, key=lambda d: entries[d]['last_used']):
+            if total <= self._max_size:
+                break
+            if digest in keep:
+                continue
+            total -= entries[digest]['size']
+            self._remove(digest)
+            evicted.append(digest)
+        if evicted:
+            logger.info(f"Evicted from release cache: {evicted}")
+            self._save_index()
+        return evicted
+
+    def entries(self) -> dict:
+        """
+        Returns {sha256: {'size': bytes, 'last_used': epoch, 'source': url or path}}.
+        """
+        return dict(self._index['entries'])
+
+    def _has(self, digest):
+        return digest in self._index['entries'] and (self._trees / digest).is_dir()
+
+    def _store(self, digest, archive, tree, source):
+        """
+        Moves a freshly downloaded archive and extracted tree in place under digest.
+        """
+        if (self._trees / digest).exists():
+            shutil.rmtree(self._trees / digest)
+        os.replace(archive, self._archives / digest)
+        os.replace(tree, self._trees / digest)
+        self._index['entries'][digest] = {
+            'size': _du(self._archives / digest) + _du(self._trees / digest),
+            'last_used': time.time(),
+            'source': source,
+        }
+        self._save_index()
+        logger.info(f"Cached release {source} as {digest}")
+
+    def _remove(self, digest):
+        (self._archives / digest).unlink(missing_ok=True)
+        shutil.rmtree(self._trees / digest, ignore_errors=True)
+        del self._index['entries'][digest]
+        for url in [u for u, v in self._index['urls'].items() if v['sha256'] == digest]:
+            del self._index['urls'][url]
+
+    def _load_index(self):
+        """
+        {'urls': {url: {'sha256': ..., 'validators': {...}}},
+         'entries': {sha256: {'size': ..., 'last_used': ..., 'source': ...}}}
+        """
+        try:
+            index = json.loads(self._index_path.read_text())
+            if 'urls' in index and 'entries' in index:
+                return index
+        except (OSError, ValueError):
+            pass
+        return {'urls': {}, 'entries': {}}
+
+    def _save_index(self):
+        tmp = self._index_path.with_name('.index.json.tmp')
+        tmp.write_text(json.dumps(self._index, indent=2))
+        os.replace(tmp, self._index_path)
+
+
+def _valid_digest(digest) -> str:
+    digest = str(digest).strip().lower()
+    if not re.fullmatch(r'[0-9a-f]{64}', digest):
+        raise ValueError(f"Not a sha256 hex digest: {digest}")
+    return digest
+
+
+def _head_validators(url):
+    """
+    Returns the validator headers of url, or None if the server can't be reached.
+    """
+    import requests
+    try:
+        response = requests.head(url, allow_redirects=True, timeout=10)
+        response.raise_for_status()
+    except requests.RequestException as e:
+        logger.warning(f"Could not check {url} for changes: {e}")
+        return None
+    return {h: response.headers.get(h) for h in _VALIDATOR_HEADERS if response.headers.get(h)}
+
+
+def _du(path) -> int:
+    """
+    Returns the apparent size in bytes of a file or directory tree.
+    """
+    path = Path(path)
+    if not path.is_dir():
+        return path.stat().st_size
+    total = 0
+    for root, dirs, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.lstat(os.path.join(root, name)).st_size
+            except OSError:
+                pass
+    return total
@@ -0,0 +1,126 @@
+import grp
+import logging
+import os
+import pwd
+import stat
+from pathlib import Path
+
+logger = logging.getLogger(__name__)
+
+# Compiled templates survive between hooks here, so a hook doesn't
+# re-parse every template it renders.
+BYTECODE_CACHE_DIR = Path('/var/cache/nextcloud-charm/jinja')
+
+# One environment per templates directory for the life of the hook.
+_environments = {}
+
+
+def php_literal(value):
+    """
+    Returns value as a PHP literal for use in rendered *.config.php files.
+    Supports str, bool, int, float, None, list and dict.
+    """
+    if isinstance(value, bool):
+        return 'true' if value else 'false'
+    if value is None:
+        return 'null'
+    if isinstance(value, (int, float)):
+        return repr(value)
+    if isinstance(value, (list, tuple)):
+        return '[' + ', '.join(php_literal(v) for v in value) + ']'
+    if isinstance(value, dict):
+        return '[' + ', '.join(f"{php_literal(k)} => {php_literal(v)}"
+                               for k, v in value.items()) + ']'
+    return "'" + str(value).replace('\\', '\\\\').replace("'", "\\'") + "'"
+
+
+def environment(templates_path):
+    """
+    Returns the shared jinja2 environment for templates_path, with the
+    'php' filter (php_literal) and the on-disk bytecode cache.
+    jinja2 is only imported by the first hook step that renders something.
+    """
+    key = os.path.abspath(templates_path)
+    env = _environments.get(key)
+    if env is None:
+        import jinja2
+        env = jinja2.Environment(loader=jinja2.FileSystemLoader(key),
+                                 bytecode_cache=_bytecode_cache())
+        env.filters['php'] = php_literal
+        _environments[key] = env
+    return env
+
+
+def render(templates_path, template, ctx) -> str:
+    """
+    Renders template from templates_path with ctx.
+    """
+    return environment(templates_path).get_template(template).render(ctx)
+
+
+def render_to_file(templates_path, template, target, ctx, mode=None, owner=None) -> bool:
+    """
+    Renders template with ctx into target, see write_if_changed().
+    Returns True if the file on disk changed.
+    """
+    return write_if_changed(target, render(templates_path, template, ctx), mode=mode, owner=owner)
+
+
+def write_if_changed(target, content, mode=None, owner=None) -> bool:
+    """
+    Atomically writes content to target unless it already holds exactly that.
+    The new content is fsynced before it replaces target, so a crash leaves
+    either the old or the new file. owner is a (user, group) tuple; without
+    mode or owner those of an existing target are kept, a new file gets 0600.
+    Returns True if the file on disk changed.
+    """
+    target = Path(target)
+    data = content.encode() if isinstance(content, str) else content
+    try:
+        if target.read_bytes() == data:
+            return False
+        current = target.stat()
+    except FileNotFoundError:
+        current = None
+
+    if mode is None:
+        mode = stat.S_IMODE(current.st_mode) if current is not None else 0o600
+    if owner is not None:
+        uid, gid = pwd.getpwnam(owner[0]).pw_uid, grp.getgrnam(owner[1]).gr_gid
+    elif current is not None:
+        uid, gid = current.st_uid, current.st_gid
+    else:
+        uid = gid = -1
+
+    # The file may hold secrets: it gets its final mode and owner before
+    # any content, and a leftover from a crash isn't reused with its mode.
+    tmp = target.with_name(f".{target.name}.tmp")
+    tmp.unlink(missing_ok=True)
+    fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_EXCL, mode)
+    with open(fd, 'wb') as f:
+        os.fchmod(fd, mode)
+        os.fchown(fd, uid, gid)
+        f.write(data)
+        f.flush()
+        os.fsync(fd)
+    os.replace(tmp, target)
+    _fsync_dir(target.parent)
+    return True
+
+
+def _fsync_dir(path):
+    fd = os.open(path, os.O_RDONLY | os.O_DIRECTORY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def _bytecode_cache():
+    import jinja2
+    try:
+        BYTECODE_CACHE_DIR.mkdir(parents=True, exist_ok=True)
+    except OSError as e:
+        logger.debug(f"No template bytecode cache: {e}")
+        return None
+    return jinja2.FileSystemBytecodeCache(str(BYTECODE_CACHE_DIR))
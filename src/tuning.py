@@ -0,0 +1,133 @@
+import logging
+import os
+import re
+
+logger = logging.getLogger(__name__)
+
+MiB = 1024 ** 2
+
+# Share of the RAM php may use in total, the rest is left to apache,
+# the database client side, the os and its page cache.
+PHP_MEMORY_SHARE = 0.6
+# A nextcloud php process rarely gets close to memory_limit; the typical
+# resident size is estimated as a share of the limit, with a floor.
+CHILD_MEMORY_SHARE = 0.25
+MIN_CHILD_MEMORY = 64 * MiB
+# Requests mostly wait on the database and storage, so a core keeps
+# several php processes busy.
+CHILDREN_PER_CORE = 8
+# Used for the estimates when memory_limit is -1 (unlimited).
+UNLIMITED_MEMORY_LIMIT = 512 * MiB
+
+# Everything the charm tunes, see php_tuning(). Any of them can be
+# overridden with the php-tuning-overrides config.
+TUNABLES = {
+    'pm': str,
+    'pm.max_children': int,
+    'pm.start_servers': int,
+    'pm.min_spare_servers': int,
+    'pm.max_spare_servers': int,
+    'pm.max_requests': int,
+    'opcache.memory_consumption': int,
+    'opcache.interned_strings_buffer': int,
+    'opcache.max_accelerated_files': int,
+    'opcache.jit_buffer_size': int,
+    'apc.shm_size': int,
+}
+
+
+def host_resources():
+    """
+    Returns (cores, memory in bytes) available to this unit.
+    Inside lxd containers both reflect the container's limits.
+    """
+    cores = len(os.sched_getaffinity(0))
+    memory = None
+    with open('/proc/meminfo') as f:
+        for line in f:
+            if line.startswith('MemTotal:'):
+                memory = int(line.split()[1]) * 1024
+                break
+    if memory is None:
+        raise RuntimeError("MemTotal missing from /proc/meminfo")
+    return cores, memory
+
+
+def parse_overrides(value) -> dict:
+    """
+    Parses 'pm.max_children=40, opcache.memory_consumption=256' into a dict.
+    Entries are separated by commas or whitespace.
+    Raises ValueError on unknown keys or bad values.
+    """
+    overrides = {}
+    for item in re.split(r'[,\s]+', (value or '').strip()):
+        if not item:
+            continue
+        key, sep, raw = item.partition('=')
+        if not sep or key not in TUNABLES:
+            raise ValueError(f"Unknown php tuning override: {item}")
+        try:
+            overrides[key] = TUNABLES[key](raw)
+        except ValueError:
+            raise ValueError(f"Bad value for {key}: {raw}")
+    return overrides
+
+
+def php_tuning(cores, memory, memory_limit, overrides=None) -> dict:
+    """
+    Computes php-fpm pool and opcache sizes for a unit with cores and memory
+    (bytes), running php with memory_limit (bytes, -1 for unlimited).
+    Overridden keys are used as given and the others are derived from them,
+    so an overridden pm.max_children still gets consistent spare servers.
+    Returns a dict with all TUNABLES.
+    Raises ValueError if overrides make a pool php-fpm won't start, see
+    _check_pool().
+    """
+    overrides = overrides or {}
+    tuning = {}
+
+    def pick(key, computed):
+        tuning[key] = overrides.get(key, computed)
+        return tuning[key]
+
+    opcache = pick('opcache.memory_consumption', _clamp(memory // MiB // 64 // 64 * 64, 128, 512))
+    pick('opcache.interned_strings_buffer', _clamp(opcache // 8, 16, 64))
+    pick('opcache.max_accelerated_files', 10000 if opcache <= 128 else 20000)
+    # Only used with the php-jit config.
+    pick('opcache.jit_buffer_size', _clamp(opcache // 4, 32, 128))
+    # The APCu local cache (memcache.local) of the whole php runtime.
+    pick('apc.shm_size', _clamp(memory // MiB // 128 // 32 * 32, 32, 256))
+
+    if memory_limit is None or memory_limit < 0:
+        memory_limit = UNLIMITED_MEMORY_LIMIT
+    child = max(MIN_CHILD_MEMORY, int(memory_limit * CHILD_MEMORY_SHARE))
+    budget = int(memory * PHP_MEMORY_SHARE) - opcache * MiB
+    pick('pm', 'dynamic')
+    max_children = pick('pm.max_children', _clamp(budget // child, 2, cores * CHILDREN_PER_CORE))
+    min_spare = pick('pm.min_spare_servers',
+                     _clamp(cores, 1, overrides.get('pm.max_spare_servers', max_children)))
+    max_spare = pick('pm.max_spare_servers', _clamp(cores * 2, min_spare, max_children))
+    # php-fpm's own default for start_servers.
+    pick('pm.start_servers', min_spare + (max_spare - min_spare) // 2)
+    pick('pm.max_requests', 500)
+    _check_pool(tuning)
+    return tuning
+
+
+def _check_pool(tuning):
+    """
+    Raises ValueError unless
+    1 <= min_spare_servers <= start_servers <= max_spare_servers <= max_children,
+    which php-fpm requires of a dynamic pool.
+    """
+    if tuning['pm'] != 'dynamic':
+        return
+    keys = ['pm.min_spare_servers', 'pm.start_servers', 'pm.max_spare_servers', 'pm.max_children']
+    values = [tuning[k] for k in keys]
+    if values[0] < 1 or values != sorted(values):
+        chain = " <= ".join(f"{k} ({v})" for k, v in zip(keys, values))
+        raise ValueError(f"php-fpm needs 1 <= {chain}")
+
+
+def _clamp(value, low, high):
+    return max(low, min(value, high))
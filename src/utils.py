@@ -1,22 +1,39 @@
 import logging
-import subprocess as sp
+import subprocess
 from subprocess import CompletedProcess
 import sys
 import os
-import requests
 import tarfile
 from pathlib import Path
-import jinja2
 import json
 import io
+import http.client
+from urllib.parse import urlsplit
+import hashlib
+import shutil
+import tempfile
+import threading
+import contextlib
+import pwd
+import grp
+import socket
+import time
 import string
 from random import randint, choice
-from occ import Occ
-import charms.operator_libs_linux.v0.apt as apt
-from charms.operator_libs_linux.v0.apt import PackageNotFoundError, PackageError
+from occ import Occ, config_list_to_dict
+import hostfacts
+import templating
+import phpmods
+import profiler
+# requests, concurrent.futures and the apt lib are imported by the functions
+# using them, most hooks never do and shouldn't pay for loading them.
 
 logger = logging.getLogger(__name__)
 
+# Every command run from here is timed in the hook profile.
+sp = profiler.TimedSubprocess(subprocess)
+
+
 def _modify_port(start=None, end=None, protocol='tcp', hook_tool="open-port"):
     assert protocol in {'tcp', 'udp', 'icmp'}
     if protocol == 'icmp':
@@ -48,13 +65,150 @@ def close_port(start, end=None, protocol="tcp"):
     _modify_port(start, end, protocol=protocol, hook_tool="close-port")
 
 
-def set_nextcloud_permissions(charm):
+# Filesystem types of datadirs living on another machine (e.g. the shared-fs relation).
+REMOTE_FILESYSTEMS = ('nfs', 'nfs4', 'cifs', 'smb3', 'ceph', 'glusterfs', '9p', 'fuse.sshfs',
+                      'fuse.glusterfs', 'fuse.cephfs', 'fuse.s3fs')
+
+
+def set_nextcloud_permissions(charm, scope='all', include_remote=False):
     """
     Set ownershow to www-data for nextcloud locations.
+    Only entries not already owned by www-data are changed, see fix_ownership().
+    scope is one of:
+    - 'all': the nextcloud code tree and the datadir
+    - 'code': the nextcloud code tree, without the datadir
+    - 'config': only /var/www/nextcloud/config
+    - 'data': only the datadir
+    A datadir on a remote filesystem (NFS, ...) is skipped unless include_remote.
+    """
+    _datadir = os.path.abspath(str(charm._stored.nextcloud_datadir))
+    paths = {
+        'all': ['/var/www/nextcloud', _datadir],
+        'code': ['/var/www/nextcloud'],
+        'config': ['/var/www/nextcloud/config'],
+        'data': [_datadir],
+    }[scope]
+    exclude = [_datadir] if scope == 'code' else []
+    if _datadir in paths and not include_remote and is_remote_filesystem(_datadir):
+        logger.info(f"Not fixing ownership in remote datadir {_datadir}")
+        paths.remove(_datadir)
+        exclude.append(_datadir)
+
+    www_data = pwd.getpwnam('www-data')
+    changed = fix_ownership(paths, www_data.pw_uid, www_data.pw_gid, exclude=exclude)
+    logger.debug(f"Ownership fixed on {changed} entries in {paths}")
+
+
+def is_remote_filesystem(path) -> bool:
+    """
+    Returns True if path is on a network filesystem, see REMOTE_FILESYSTEMS.
+    """
+    path = os.path.realpath(path)
+    best, fstype = '', None
+    with open('/proc/mounts') as f:
+        for line in f:
+            fields = line.split()
+            mountpoint = fields[1].replace('\\040', ' ')
+            if (path == mountpoint or path.startswith(mountpoint.rstrip('/') + '/')) \
+                    and len(mountpoint) >= len(best):
+                best, fstype = mountpoint, fields[2]
+    return fstype in REMOTE_FILESYSTEMS
+
+
+def fix_ownership(paths, uid, gid, exclude=(), workers=8) -> int:
+    """
+    Recursively gives paths to uid:gid like 'chown -R -h', but only changes
+    entries whose owner differs, so an already correct tree is only read.
+    Directories are walked in parallel by a pool of workers.
+    Directories in exclude are neither changed nor walked, paths inside
+    another one of paths are walked once, with it.
+    Returns the number of entries changed.
     """
-    _datadir = str(charm._stored.nextcloud_datadir)
-    cmd = ['chown', '-R', 'www-data:www-data', '/var/www/nextcloud', _datadir]
-    sp.run(cmd, cwd='/var/www/nextcloud')
+    exclude = {os.path.abspath(p) for p in exclude}
+    paths = sorted({os.path.abspath(p) for p in paths})
+    paths = [p for p in paths
+             if not any(p.startswith(q.rstrip('/') + '/') for q in paths if q not in exclude)]
+
+    def fix(path, st):
+        if st.st_uid != uid or st.st_gid != gid:
+            os.lchown(path, uid, gid)
+            return 1
+        return 0
+
+    def walk(directory):
+        changed, subdirs = 0, []
+        try:
+            with os.scandir(directory) as entries:
+                for entry in entries:
+                    if entry.path in exclude:
+                        continue
+                    try:
+                        changed += fix(entry.path, entry.stat(follow_symlinks=False))
+                        if entry.is_dir(follow_symlinks=False):
+                            subdirs.append(entry.path)
+                    except FileNotFoundError:
+                        pass
+        except FileNotFoundError:
+            pass
+        return changed, subdirs
+
+    changed = 0
+    roots = []
+    for path in paths:
+        if path in exclude or not os.path.lexists(path):
+            continue
+        changed += fix(path, os.lstat(path))
+        if os.path.isdir(path) and not os.path.islink(path):
+            roots.append(path)
+
+    import concurrent.futures
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+        pending = {pool.submit(walk, root) for root in roots}
+        while pending:
+            done, pending = concurrent.futures.wait(
+                pending, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                count, subdirs = future.result()
+                changed += count
+                pending |= {pool.submit(walk, d) for d in subdirs}
+    return changed
+
+
+def is_local_address(host) -> bool:
+    """
+    Returns True if host resolves to an address of this machine.
+    """
+    try:
+        infos = socket.getaddrinfo(host, None)
+    except socket.gaierror:
+        return False
+    for family, _, _, _, sockaddr in infos:
+        # Only addresses of this machine can be bound to.
+        try:
+            with socket.socket(family, socket.SOCK_DGRAM) as s:
+                s.bind((sockaddr[0], 0))
+            return True
+        except OSError:
+            continue
+    return False
+
+
+def grant_socket_access(path, user) -> bool:
+    """
+    Adds user to the group owning the unix socket at path, unless user can
+    already use it. Apache and php-fpm pick up the group on their next reload.
+    Returns True if user was added.
+    """
+    st = os.stat(path)
+    if st.st_mode & 0o006 == 0o006:
+        return False
+    group = grp.getgrgid(st.st_gid)
+    entry = pwd.getpwnam(user)
+    if st.st_uid == entry.pw_uid or entry.pw_gid == st.st_gid or user in group.gr_mem:
+        return False
+    sp.check_call(['usermod', '-a', '-G', group.gr_name, user])
+    logger.info(f"Added {user} to group {group.gr_name} for {path}")
+    return True
 
 
 def install_dependencies():
@@ -62,7 +216,7 @@ def install_dependencies():
     Installs package dependencies for the supported distros.
     :return:
     """
-    distro_codename = sp.check_output(['lsb_release', '-sc'], universal_newlines=True).strip()
+    distro_codename = hostfacts.distro_codename()
     if 'focal' == distro_codename:
         _install_dependencies_focal()
     elif 'bionic' == distro_codename:
@@ -122,7 +276,8 @@ def _install_dependencies_bionic():
                     'php7.2-xml',
                     'php-apcu',
                     'php-redis',
-                    'php-smbclient']
+                    'php-smbclient',
+                    'lbzip2']
         command = ["sudo", "apt", "install", "-y"]
         command.extend(packages)
         sp.run(command, check=True)
@@ -158,7 +313,9 @@ def _install_dependencies_focal():
                     'php7.4-imagick',
                     'php-pear',
                     'php-apcu',
-                    'php-redis']
+                    'php-redis',
+                    'lbzip2',
+                    'zstd']
         command = ["sudo", "apt", "install", "-y"]
         command.extend(packages)
         sp.run(command, check=True)
@@ -176,7 +333,8 @@ def _install_dependencies_jammy():
     packages = "apache2 php8.1 libapache2-mod-php8.1 php8.1-curl php8.1-xml \
                 php8.1-pgsql php8.1-mbstring php8.1-gd php8.1-redis \
                 php8.1-intl php8.1-gmp php8.1-bcmath php8.1-imagick \
-                php8.1-zip php8.1-fpm php8.1-intl php8.1-ldap".split()
+                php8.1-zip php8.1-fpm php8.1-intl php8.1-ldap \
+                php8.1-apcu lbzip2 zstd".split()
 
     try:
         sp.run('sudo apt remove php8.1-common -y'.split(), check=True)
@@ -187,6 +345,7 @@ def _install_dependencies_jammy():
         print(e)
         sys.exit(-1)
 
+
 def _install_dependencies_noble():
     """
     Install packages that is needed by nextcloud to work with this charm.
@@ -197,12 +356,18 @@ def _install_dependencies_noble():
         "php8.3-common", "php8.3-opcache", "php8.3-readline", "php8.3-cli", "php8.3-fpm",
         "libapache2-mod-php8.3", "php8.3-igbinary", "php8.3-imagick", "php8.3-redis", "php8.3",
         "php8.3-bcmath", "php8.3-curl", "php8.3-gd", "php8.3-gmp", "php8.3-intl", "php8.3-ldap",
-        "php8.3-mbstring", "php8.3-pgsql", "php8.3-xml", "php8.3-zip"
+        "php8.3-mbstring", "php8.3-pgsql", "php8.3-xml", "php8.3-zip", "php8.3-apcu",
+        # Multi-threaded decompression of the nextcloud tarfile.
+        "lbzip2", "zstd"
     ]
 
+    import charms.operator_libs_linux.v0.apt as apt
+    from charms.operator_libs_linux.v0.apt import PackageNotFoundError, PackageError
     try:
-        apt.update()
-        apt.add_package(packages)
+        with profiler.span('apt', 'update'):
+            apt.update()
+        with profiler.span('apt', 'add_package ' + ' '.join(packages[:3])):
+            apt.add_package(packages)
     except PackageNotFoundError:
         logger.error("a specified package not found in package cache or on system")
         sys.exit(1)
@@ -210,122 +375,524 @@ def _install_dependencies_noble():
         logger.error("could not install package. Reason: %s", e.message)
         sys.exit(1)
 
-def fetch_and_extract_nextcloud(tarfile_url):
+
+# Leading bytes identifying the compression of a nextcloud tarfile.
+TAR_CODEC_MAGIC = [
+    (b'BZh', 'bz2'),
+    (b'\xfd7zXZ\x00', 'xz'),
+    (b'\x28\xb5\x2f\xfd', 'zst'),
+    (b'\x1f\x8b', 'gz'),
+]
+
+# Multi-threaded decompressors per codec, in order of preference.
+# Each reads the compressed archive on stdin and writes the tar to stdout.
+PARALLEL_DECOMPRESSORS = {
+    'bz2': [['lbzip2', '-d', '-c'], ['pbzip2', '-d', '-c']],
+    'xz': [['pixz', '-d'], ['xz', '-d', '-c', '-T0']],
+    'zst': [['zstd', '-d', '-c']],
+    'gz': [['pigz', '-d', '-c']],
+}
+
+# tarfile stream modes for the codecs python can decompress itself.
+_TAR_STREAM_MODES = {'tar': 'r|', 'bz2': 'r|bz2', 'xz': 'r|xz', 'gz': 'r|gz'}
+
+
+def detect_tar_codec(source):
+    """
+    Returns the compression of a tar archive: 'bz2', 'xz', 'zst', 'gz' or
+    'tar' (uncompressed), or None if it is not a supported archive.
+    source is a path or the first 512 bytes of the archive.
+    """
+    if isinstance(source, (bytes, bytearray)):
+        header = bytes(source)
+    else:
+        with open(source, 'rb') as f:
+            header = f.read(512)
+    for magic, codec in TAR_CODEC_MAGIC:
+        if header.startswith(magic):
+            return codec
+    if header[257:262] == b'ustar':
+        return 'tar'
+    return None
+
+
+def find_parallel_decompressor(codec):
+    """
+    Returns the command line of an installed multi-threaded decompressor for codec, or None.
+    """
+    for cmd in PARALLEL_DECOMPRESSORS.get(codec, []):
+        if shutil.which(cmd[0]):
+            return cmd
+    return None
+
+
+@contextlib.contextmanager
+def open_tar_stream(fileobj, codec, parallel=True):
+    """
+    Opens the compressed fileobj as a tarfile in stream mode.
+    Decompression runs in an external multi-threaded decompressor when one
+    is installed (see PARALLEL_DECOMPRESSORS), else in python's own codec.
+    fileobj is handed to the decompressor directly if it is a real file,
+    otherwise it is fed to it from a thread.
+    """
+    decompressor = find_parallel_decompressor(codec) if parallel and codec != 'tar' else None
+    if decompressor is None:
+        if codec not in _TAR_STREAM_MODES:
+            tool = PARALLEL_DECOMPRESSORS[codec][0][0]
+            raise tarfile.CompressionError(f"No decompressor for {codec} archives, install {tool}")
+        with tarfile.open(fileobj=fileobj, mode=_TAR_STREAM_MODES[codec]) as tfile:
+            yield tfile
+        return
+
+    logger.debug(f"Decompressing {codec} with {decompressor[0]}")
+    try:
+        fileobj.fileno()
+        stdin = fileobj
+    except (AttributeError, OSError, io.UnsupportedOperation):
+        stdin = sp.PIPE
+    proc = sp.Popen(decompressor, stdin=stdin, stdout=sp.PIPE)
+
+    feeder = None
+    feed_errors = []
+    if stdin is sp.PIPE:
+        def feed():
+            try:
+                for chunk in iter(lambda: fileobj.read(1024 * 1024), b''):
+                    proc.stdin.write(chunk)
+            except BrokenPipeError:
+                # The decompressor stopped reading, its exit code tells why.
+                pass
+            except BaseException as e:
+                feed_errors.append(e)
+            finally:
+                try:
+                    proc.stdin.close()
+                except BrokenPipeError:
+                    pass
+        feeder = threading.Thread(target=feed, daemon=True)
+        feeder.start()
+
+    try:
+        with tarfile.open(fileobj=proc.stdout, mode='r|') as tfile:
+            yield tfile
+        # tarfile stops at the end-of-archive marker, let the decompressor finish.
+        while proc.stdout.read(1024 * 1024):
+            pass
+    except BaseException:
+        proc.kill()
+        raise
+    finally:
+        proc.stdout.close()
+        proc.wait()
+        if feeder:
+            feeder.join()
+    if feed_errors:
+        raise feed_errors[0]
+    if proc.returncode != 0:
+        raise tarfile.ReadError(f"{decompressor[0]} exited with code {proc.returncode}")
+
+
+class ChecksumMismatchError(Exception):
+    """A downloaded file did not match its expected SHA-256."""
+
+
+class _ChunkReader(io.RawIOBase):
+    """
+    Read-only file object over an iterator of byte chunks, e.g. the body of a
+    streamed HTTP response. Every chunk is hashed (SHA-256) and counted as it
+    arrives, so verification and progress come without a second pass.
+    """
+
+    def __init__(self, chunks, total=0, progress=None, tee=None):
+        self._chunks = iter(chunks)
+        self._tee = tee
+        self._buffer = b''
+        self._total = total
+        self._progress = progress
+        self._reported = 0
+        self.sha256 = hashlib.sha256()
+        self.bytes_read = 0
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        while not self._buffer:
+            chunk = next(self._chunks, None)
+            if chunk is None:
+                return 0
+            self._consume(chunk)
+            self._buffer = chunk
+        n = min(len(b), len(self._buffer))
+        b[:n] = self._buffer[:n]
+        self._buffer = self._buffer[n:]
+        return n
+
+    def peek(self, n):
+        """
+        Returns up to the first n unread bytes without consuming them.
+        """
+        while len(self._buffer) < n:
+            chunk = next(self._chunks, None)
+            if chunk is None:
+                break
+            self._consume(chunk)
+            self._buffer += chunk
+        return self._buffer[:n]
+
+    def drain(self):
+        """
+        Hashes whatever the consumer did not read, e.g. tar end-of-archive padding.
+        """
+        self._buffer = b''
+        for chunk in self._chunks:
+            self._consume(chunk)
+
+    def _consume(self, chunk):
+        self.sha256.update(chunk)
+        if self._tee:
+            self._tee.write(chunk)
+        self.bytes_read += len(chunk)
+        # Report every 10% (or every 25MB if the size is unknown).
+        step = self._total // 10 if self._total else 25 * 1024 * 1024
+        if self._progress and self.bytes_read - self._reported >= step:
+            self._reported = self.bytes_read
+            self._progress(self.bytes_read, self._total)
+
+
+def _install_tree(staging, dst):
+    """
+    Moves everything extracted into staging to dst, merging into existing
+    directories like extracting over dst would.
+    """
+    for entry in staging.iterdir():
+        target = dst / entry.name
+        if target.is_dir() and entry.is_dir() and not entry.is_symlink():
+            shutil.copytree(entry, target, symlinks=True, dirs_exist_ok=True)
+        else:
+            os.replace(entry, target)
+    shutil.rmtree(staging)
+
+
+def fetch_and_extract_nextcloud(tarfile_url, sha256=None, progress=None, dst=Path('/var/www/'),
+                                archive=None):
     """
     Fetch and Install nextcloud from internet
-    Sources are about 100M.
+    Sources are about 250M.
+
+    The download is streamed from the HTTP response through the
+    decompressor (see open_tar_stream()) into tarfile, so memory use is constant.
+    The archive is extracted into a staging directory and only moved in
+    place if it matches sha256 (hex digest, optional).
+    progress(bytes_read, total_bytes) is called every 10% of the download.
+    If archive (a binary file object) is given, the download is also written to it.
+    Returns the sha256 hex digest of the download.
     """
+    import requests
     # tarfile_url = 'https://download.nextcloud.com/server/releases/nextcloud-18.0.3.tar.bz2'
-    # checksum = '7b67e709006230f90f95727f9fa92e8c73a9e93458b22103293120f9cb50fd72'
-    try:
-        response = requests.get(tarfile_url, allow_redirects=True, stream=True)
-        dst = Path('/var/www/')
-        with tarfile.open(fileobj=io.BytesIO(response.content), mode='r:bz2') as tfile:
-            tfile.extractall(path=dst)
-    except sp.CalledProcessError as e:
-        print(e)
-        sys.exit(-1)
+    with requests.get(tarfile_url, allow_redirects=True, stream=True,
+                      timeout=(10, 60)) as response:
+        response.raise_for_status()
+        total = int(response.headers.get('Content-Length', 0))
+        reader = _ChunkReader(response.iter_content(chunk_size=1024 * 1024), total, progress,
+                              tee=archive)
+        codec = detect_tar_codec(reader.peek(512))
+        if codec is None:
+            raise tarfile.ReadError(f"{tarfile_url} is not a supported tar archive")
+        staging = Path(tempfile.mkdtemp(prefix='.nextcloud-', dir=dst))
+        try:
+            with open_tar_stream(reader, codec) as tfile:
+                tfile.extractall(path=staging)
+            reader.drain()
+            digest = reader.sha256.hexdigest()
+            if sha256 and digest != sha256.strip().lower():
+                raise ChecksumMismatchError(
+                    f"{tarfile_url} has sha256 {digest}, expected {sha256}")
+        except BaseException:
+            shutil.rmtree(staging, ignore_errors=True)
+            raise
+    logger.info(f"Fetched {reader.bytes_read} bytes from {tarfile_url} (sha256 {digest})")
+    _install_tree(staging, dst)
+    return digest
 
 
-def extract_nextcloud(tarfile_path):
+def extract_nextcloud(tarfile_path, dst=Path('/var/www/'), parallel=True):
     """
     Install nextcloud from tarfile
+    The tarfile can be compressed with bz2, xz, zstd or gzip, see open_tar_stream().
     """
-    dst = Path('/var/www/')
-    with tarfile.open(tarfile_path, mode='r:bz2') as tfile:
+    codec = detect_tar_codec(tarfile_path)
+    if codec is None:
+        raise tarfile.ReadError(f"{tarfile_path} is not a supported tar archive")
+    with open(tarfile_path, 'rb') as f, open_tar_stream(f, codec, parallel) as tfile:
         tfile.extractall(path=dst)
 
 
-def config_apache2(templates_path, template):
+def config_apache2(templates_path, template, ctx=None) -> bool:
     """
     Configures apache2
+    ctx = {'php_runtime': 'mod_php' | 'fpm', 'fpm_socket': <path>}
+    Returns True if anything apache reads changed and it needs a reload.
     """
-    template = jinja2.Environment(
-        loader=jinja2.FileSystemLoader(templates_path)
-    ).get_template(template)
     target = Path('/etc/apache2/sites-available/nextcloud.conf')
-    ctx = {}
-    target.write_text(template.render(ctx))
+    changed = templating.render_to_file(templates_path, template, target, ctx or {}, mode=0o644)
     # Enable required modules.
+    enabled = hostfacts.apache_modules()
     for module in ['rewrite', 'headers', 'env', 'dir', 'mime', 'setenvif', 'proxy_fcgi']:
-        sp.call(['a2enmod', module])
+        if module not in enabled:
+            sp.call(['a2enmod', module])
+            changed = True
     # Disable default site
-    sp.check_call(['a2dissite', '000-default'])
+    if os.path.lexists('/etc/apache2/sites-enabled/000-default.conf'):
+        sp.check_call(['a2dissite', '000-default'])
+        changed = True
     # Enable nextcloud site (wich will be default)
-    sp.check_call(['a2ensite', 'nextcloud'])
+    if not os.path.lexists('/etc/apache2/sites-enabled/nextcloud.conf'):
+        sp.check_call(['a2ensite', 'nextcloud'])
+        changed = True
+    return changed
+
 
+PHP_RUNTIMES = ('mod_php', 'fpm')
 
-def install_nfs_systemd_mount(templates_path, template, ctx):
+
+def php_fpm_socket():
+    """
+    The socket of the nextcloud php-fpm pool.
+    """
+    return f'/run/php/php{get_phpversion()}-fpm-nextcloud.sock'
+
+
+def config_php_fpm_pool(pool_context, templates_path, template) -> bool:
+    """
+    Renders the nextcloud php-fpm pool (pool.d/nextcloud.conf).
+    pool_context = {'pm': 'dynamic', 'max_children': ..., 'start_servers': ...,
+                    'min_spare_servers': ..., 'max_spare_servers': ..., 'max_requests': ...}
+    Returns True if the pool changed and php-fpm needs a reload.
+    """
+    target = Path(f'/etc/php/{get_phpversion()}/fpm/pool.d/nextcloud.conf')
+    if not target.parent.is_dir():
+        raise RuntimeError(f"php{get_phpversion()}-fpm is not installed.")
+    return templating.render_to_file(templates_path, template, target,
+                                     dict(pool_context, socket=php_fpm_socket()), mode=0o644)
+
+
+def remove_php_fpm_pool() -> bool:
+    """
+    Removes the nextcloud php-fpm pool.
+    Returns True if there was one.
+    """
+    target = Path(f'/etc/php/{get_phpversion()}/fpm/pool.d/nextcloud.conf')
+    if not target.exists():
+        return False
+    target.unlink()
+    return True
+
+
+def switch_php_runtime(runtime) -> bool:
+    """
+    Makes apache serve php with mod_php under mpm_prefork, or through the
+    php-fpm service under mpm_event.
+    Returns True if modules were switched. Apache can't change its MPM on a
+    graceful reload, so it then needs a full restart.
+    """
+    if runtime not in PHP_RUNTIMES:
+        raise ValueError(f"Unsupported php runtime: {runtime}")
+    version = get_phpversion()
+    fpm_service = f'php{version}-fpm'
+    if runtime == 'fpm':
+        if not Path(f'/usr/sbin/php-fpm{version}').exists():
+            raise RuntimeError(f"{fpm_service} is not installed.")
+        disable, enable = [f'php{version}', 'mpm_prefork'], ['mpm_event', 'proxy_fcgi', 'setenvif']
+    else:
+        disable, enable = ['mpm_event', 'mpm_worker'], ['mpm_prefork', f'php{version}']
+
+    enabled = hostfacts.apache_modules()
+    # The php module conflicts with mpm_event, so disable before enabling.
+    to_disable = [m for m in disable if m in enabled]
+    to_enable = [m for m in enable if m not in enabled]
+    if to_disable:
+        sp.check_call(['a2dismod', '-q'] + to_disable)
+    if to_enable:
+        sp.check_call(['a2enmod', '-q'] + to_enable)
+
+    switched = bool(to_disable or to_enable)
+    if runtime == 'fpm':
+        sp.check_call(['systemctl', 'enable', '--now', fpm_service])
+    elif switched:
+        # Only stop php-fpm when moving away from it, it may serve something else.
+        sp.call(['systemctl', 'disable', '--now', fpm_service])
+    return switched
+
+
+def reload_php_fpm():
+    """
+    Gracefully reloads php-fpm, re-reading php ini files and pools.
+    """
+    sp.check_call(['systemctl', 'reload-or-restart', f'php{get_phpversion()}-fpm'])
+
+
+def apache_restart():
+    """
+    Restarts apache, dropping in-flight requests. Only needed for an MPM switch.
+    """
+    sp.check_call(['systemctl', 'restart', 'apache2.service'])
+
+
+def apache_graceful():
+    """
+    Gracefully reloads apache: workers finish their in-flight requests
+    (e.g. uploads) before picking up the new configuration.
+    Starts apache if it isn't running.
+    """
+    sp.check_call(['apachectl', 'graceful'])
+
+
+def get_status_php(url='http://localhost/status.php', timeout=2):
+    """
+    Returns nextcloud's status as served by apache from status.php, a dict
+    like 'occ status' gives: installed, version, maintenance, needsDbUpgrade...
+    Returns None if it doesn't answer with it within timeout seconds.
+    """
+    parts = urlsplit(url)
+    conn = http.client.HTTPConnection(parts.hostname, parts.port or 80, timeout=timeout)
+    try:
+        conn.request('GET', parts.path or '/')
+        response = conn.getresponse()
+        if response.status != 200:
+            return None
+        status = json.loads(response.read())
+    except (OSError, http.client.HTTPException, ValueError):
+        return None
+    finally:
+        conn.close()
+    return status if isinstance(status, dict) and 'installed' in status else None
+
+
+def wait_for_status_php(url='http://localhost/status.php', timeout=30, interval=0.5) -> bool:
+    """
+    Polls nextcloud's status.php until it answers with its json status,
+    for at most timeout seconds.
+    Returns True if nextcloud answered in time.
+    """
+    deadline = time.monotonic() + timeout
+    while True:
+        if get_status_php(url, timeout=min(5, timeout)) is not None:
+            return True
+        if time.monotonic() + interval > deadline:
+            return False
+        time.sleep(interval)
+
+
+def install_nfs_systemd_mount(templates_path, template, ctx) -> bool:
     """
     Installs nfs systemd.mount unit file
     ctx = {'nfs_host': <iphostname>, 'appname': <appname>}
+    Returns True if the unit changed (and systemd was reloaded).
     """
-    template = jinja2.Environment(
-        loader=jinja2.FileSystemLoader(templates_path)
-    ).get_template(template)
     target = Path('/etc/systemd/system/media-nextcloud-data.mount')
-    target.write_text(template.render(ctx))
-    sp.call(['systemctl', 'daemon-reload'])
+    changed = templating.render_to_file(templates_path, template, target, ctx, mode=0o644)
+    if changed:
+        sp.call(['systemctl', 'daemon-reload'])
+    return changed
 
 
-def config_php(phpmod_context, templates_path, template):
+def config_php(phpmod_context, templates_path, template) -> bool:
     """
-    Renders the phpmodule for nextcloud (nextcloud.ini)
+    Renders the phpmodule for nextcloud (nextcloud.ini) for all installed php versions.
     This is instead of manipulating the system wide php.ini
     which might be overwitten or changed from elsewhere.
+    Returns True if the module changed and php needs a reload.
     """
-    template = jinja2.Environment(
-        loader=jinja2.FileSystemLoader(templates_path)
-    ).get_template(template)
-    target_72 = Path('/etc/php/7.2/mods-available/nextcloud.ini')
-    target_74 = Path('/etc/php/7.4/mods-available/nextcloud.ini')
-    target_81 = Path('/etc/php/8.1/mods-available/nextcloud.ini')
-    target_81 = Path('/etc/php/8.3/mods-available/nextcloud.ini')
-    if get_phpversion() == "7.4":
-        target_74.write_text(template.render(phpmod_context))
-    elif get_phpversion() == "7.2":
-        target_72.write_text(template.render(phpmod_context))
-    elif get_phpversion() == "8.1":
-        target_81.write_text(template.render(phpmod_context))
-    elif get_phpversion() == "8.3":
-        target_81.write_text(template.render(phpmod_context))
-    sp.check_call(['phpenmod', 'nextcloud'])
-
-
-def config_ceph(ceph_info, templates_path, template):
-    """
-    Renders the phpmodule for nextcloud (nextcloud.ini)
-    This is instead of manipulating the system wide php.ini
-    which might be overwitten or changed from elsewhere.
+    content = templating.render(templates_path, template, phpmod_context)
+    return phpmods.config_module('nextcloud', content)
+
+
+OPCACHE_FILE_CACHE = Path('/var/cache/nextcloud-charm/opcache')
+# Requests that compile nextcloud's bootstrap and most used code paths.
+OPCACHE_WARM_URLS = ('http://localhost/status.php', 'http://localhost/index.php/login')
+
+
+def prepare_opcache_file_cache(path=OPCACHE_FILE_CACHE):
+    """
+    Creates the directory php persists compiled scripts in (opcache.file_cache),
+    so a restarted php starts from warm code instead of recompiling it all.
+    """
+    path = Path(path)
+    path.mkdir(parents=True, exist_ok=True)
+    path.chmod(0o700)
+    shutil.chown(path, 'www-data', 'www-data')
+
+
+def clear_opcache_file_cache(path=OPCACHE_FILE_CACHE):
+    """
+    Removes all compiled scripts from the opcache file cache.
+    They are not validated against the code once timestamps are off.
+    """
+    path = Path(path)
+    if not path.is_dir():
+        return
+    for entry in path.iterdir():
+        if entry.is_dir() and not entry.is_symlink():
+            shutil.rmtree(entry)
+        else:
+            entry.unlink()
+
+
+def warm_opcache(urls=OPCACHE_WARM_URLS):
+    """
+    Requests a few nextcloud pages so their code is compiled before users arrive.
+    """
+    import requests
+    for url in urls:
+        try:
+            requests.get(url, timeout=30, allow_redirects=False)
+        except requests.RequestException as e:
+            logger.debug(f"Warming opcache with {url} failed: {e}")
+
+
+def config_ceph(ceph_info, templates_path, template) -> bool:
+    """
+    Renders the ceph object store config for nextcloud (ceph.config.php)
+    Returns True if the file changed.
     """
-    template = jinja2.Environment(
-        loader=jinja2.FileSystemLoader(templates_path)
-    ).get_template(template)
     target = Path('/var/www/nextcloud/config/ceph.config.php')
-    target.write_text(template.render(ceph_info))
+    # Holds the ceph secret.
+    return templating.render_to_file(templates_path, template, target, ceph_info,
+                                     mode=0o640, owner=('www-data', 'www-data'))
+
+
+def config_charm_php(system_config, templates_path, template):
+    """
+    Renders the charm owned system config (config/charm.config.php) in one
+    atomic write, replacing a series of 'occ config:system:set' calls.
+    The file is only written if the rendered content changed.
+    Returns True if the file on disk changed.
+    """
+    target = Path('/var/www/nextcloud/config/charm.config.php')
+    return templating.render_to_file(templates_path, template, target,
+                                     {'system_config': system_config},
+                                     mode=0o640, owner=('www-data', 'www-data'))
+
+
+SUPPORTED_PHP_VERSIONS = ("7.2", "7.4", "8.1", "8.3")
 
 
 def get_phpversion():
     """
-    Get php version X.Y from the running system.
+    Get php version X.Y from the running system, probed once and
+    cached in hostfacts until packages change.
     Supports
     - 7.2 (bionic),
     - 7.4 (focal)
+    - 8.1 (jammy)
     - 8.3 (noble)
     :return: string
     """
-    response = sp.check_output(['php', '-v']).decode()
-    lines = response.split("\n")
-    if "PHP 7.4" in lines[0]:
-        return "7.4"
-    elif "PHP 7.2" in lines[0]:
-        return "7.2"
-    elif "PHP 8.1" in lines[0]:
-        return "8.1"
-    elif "PHP 8.3" in lines[0]:
-        return "8.3"
-    else:
+    version = hostfacts.php_version()
+    if version not in SUPPORTED_PHP_VERSIONS:
         raise RuntimeError("No valid PHP version found in check")
+    return version
 
 
 def config_backup(config, data_dir_path, db_host, db_user, db_pass):
@@ -348,11 +915,8 @@ def config_backup(config, data_dir_path, db_host, db_user, db_pass):
         "pagerduty_token": config.get("backup-pagerduty-token"),
         "pagerduty_email": config.get("backup-pagerduty-email")
     }
-    template = jinja2.Environment(
-        loader=jinja2.FileSystemLoader("scripts/backup")
-    ).get_template("run_backup.sh")
     target = Path('/root/scripts/backup/run_backup.sh')
-    target.write_text(template.render(run_backup_info))
+    templating.render_to_file("scripts/backup", "run_backup.sh", target, run_backup_info)
 
     # Configuring Nextcloud-Backup-Restore.conf
     backup_conf_info = {
@@ -361,20 +925,17 @@ def config_backup(config, data_dir_path, db_host, db_user, db_pass):
         "db_user": db_user,
         "db_pass": db_pass
     }
-    template = jinja2.Environment(
-        loader=jinja2.FileSystemLoader("scripts/backup/Nextcloud-Backup-Restore")
-    ).get_template("NextcloudBackupRestore.conf")
     target = Path('/root/scripts/backup/Nextcloud-Backup-Restore/NextcloudBackupRestore.conf')
-    target.write_text(template.render(backup_conf_info))
+    templating.render_to_file("scripts/backup/Nextcloud-Backup-Restore",
+                              "NextcloudBackupRestore.conf", target, backup_conf_info)
 
 
 def getTrustedProxies():
     """
     Returns a json object with the trusted_proxies
     """
-    cmd = ("sudo -u www-data php /var/www/nextcloud/occ config:system:get trusted_proxies --output=json")
-    s = sp.run(cmd.split(), cwd='/var/www/nextcloud',
-               stdout=sp.PIPE, stderr=sp.PIPE, universal_newlines=True)
+    cmd = "config:system:get trusted_proxies --output=json"
+    s = Occ.run(cmd.split())
     # Load an empty dict into json if no trusted proxy exists.
     if s.stdout == '':
         return json.loads(str(dict()))
@@ -393,11 +954,10 @@ def deleteTrustedProxies() -> CompletedProcess:
     """
     Removes all trusted_proxies from config via occ by setting an empty value.
     """
-    cmd = ("sudo -u www-data php /var/www/nextcloud/occ config:system:set"
+    cmd = ("config:system:set"
            " trusted_proxies "
            " --value=")
-    return sp.run(cmd.split(), cwd='/var/www/nextcloud',
-                  stdout=sp.PIPE, stderr=sp.PIPE, universal_newlines=True)
+    return Occ.run(cmd.split())
 
 
 def deleteTrustedProxy(host) -> CompletedProcess:
@@ -408,21 +968,66 @@ def deleteTrustedProxy(host) -> CompletedProcess:
     ps = getTrustedProxies()
     for (idx, val) in ps.items():
         if val == host:
-            cmd = ("sudo -u www-data php /var/www/nextcloud/occ config:system:set"
-                   f" trusted_proxies {idx} --value=")
-            return sp.run(cmd.split(), cwd='/var/www/nextcloud',
-                          stdout=sp.PIPE, stderr=sp.PIPE, universal_newlines=True)
+            cmd = f"config:system:set trusted_proxies {idx} --value="
+            return Occ.run(cmd.split())
 
 
 def setTrustedProxy(host, index) -> CompletedProcess:
     """
     Sets a trusted proxy on the given index.
     """
-    cmd = ("sudo -u www-data php /var/www/nextcloud/occ config:system:set"
+    cmd = ("config:system:set"
            " trusted_proxies {index}"
            " --value={host} ").format(index=index, host=host)
-    return sp.run(cmd.split(), cwd='/var/www/nextcloud',
-                  stdout=sp.PIPE, stderr=sp.PIPE, universal_newlines=True)
+    return Occ.run(cmd.split())
+
+
+def plan_trusted_proxies(current, desired_addresses):
+    """
+    Computes the changes turning trusted_proxies ({index: address}) into the
+    set desired_addresses. Proxies that stay keep their index, new ones take
+    over the slots of removed ones first.
+    Returns (sets, deletes): sets is a list of (index, address) to set,
+    deletes a list of indices to delete.
+    """
+    desired = list(dict.fromkeys(desired_addresses))
+    kept = {}
+    free = []
+    for index, address in sorted(current.items()):
+        if address in desired and address not in kept:
+            kept[address] = index
+        else:
+            free.append(index)
+    missing = [a for a in desired if a not in kept]
+
+    sets = []
+    next_index = max(current, default=-1) + 1
+    for address in missing:
+        if free:
+            sets.append((free.pop(0), address))
+        else:
+            sets.append((next_index, address))
+            next_index += 1
+    return sets, free
+
+
+def sync_trusted_proxies(desired_addresses):
+    """
+    Makes trusted_proxies in config.php contain exactly desired_addresses.
+    Reads the current proxies once and only writes the slots that change,
+    normally a single occ call per joined or departed proxy.
+    Returns the number of changes made.
+    """
+    proxies = getTrustedProxies()
+    current = config_list_to_dict(proxies if isinstance(proxies, (dict, list)) else None)
+    sets, deletes = plan_trusted_proxies(current, desired_addresses)
+    for index, address in sets:
+        Occ.set_trusted_proxy(address, index)
+    for index in deletes:
+        Occ.delete_trusted_proxy(index)
+    if sets or deletes:
+        logger.info(f"trusted_proxies synced: {len(sets)} set, {len(deletes)} deleted.")
+    return len(sets) + len(deletes)
 
 
 def installCrontab():
@@ -432,6 +1037,17 @@ def installCrontab():
     os.system("echo '*/5  *  *  *  * php -f /var/www/nextcloud/cron.php' | crontab -u www-data -")
 
 
+def parse_size(value) -> int:
+    """
+    Parses a size like '512M', '2G' or '1048576' (bytes) into bytes.
+    """
+    value = str(value).strip().upper().rstrip('B')
+    units = {'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3, 'T': 1024 ** 4}
+    if value and value[-1] in units:
+        return int(float(value[:-1]) * units[value[-1]])
+    return int(value)
+
+
 def generatePassword():
     """
     Generate a random password.
@@ -445,6 +1061,6 @@ def setPrettyUrls():
     """
     Use URL rewrite, "Pretty URL". Removes index.php from url:
     https://nextcloud.dwellir.com/index.php/login -> https://nextcloud.dwellir.com/login
+    htaccess.RewriteBase is set in charm.config.php, see config_charm_php().
     """
-    Occ.setRewriteBase()
     Occ.updateHtaccess()
@@ -0,0 +1,59 @@
+#!/usr/bin/env python3
+"""
+Benchmark of the nextcloud tarfile extraction paths in utils.
+
+Recompresses a tarfile with every supported codec and times extraction with
+python's own codec and with each installed multi-threaded decompressor.
+
+    PYTHONPATH=./src:./lib python3 -m tests.bench_extract [nextcloud.tar.bz2] [rounds]
+
+Defaults to tests/nextcloud.tar.bz2; pass a real release tarball
+(e.g. latest-29.tar.bz2) for meaningful numbers.
+"""
+import sys
+import tempfile
+import time
+from pathlib import Path
+import utils
+from tests.test_extract import make_archives
+
+
+def bench(path, rounds, parallel):
+    best = None
+    for _ in range(rounds):
+        with tempfile.TemporaryDirectory() as dst:
+            start = time.monotonic()
+            utils.extract_nextcloud(path, dst=Path(dst), parallel=parallel)
+            elapsed = time.monotonic() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def main():
+    default = Path(__file__).parent / 'nextcloud.tar.bz2'
+    tarfile = Path(sys.argv[1]) if len(sys.argv) > 1 else default
+    rounds = int(sys.argv[2]) if len(sys.argv) > 2 else 3
+
+    with tempfile.TemporaryDirectory() as tmp:
+        archives = make_archives(Path(tmp), tarfile)
+
+        print(f"{'codec':<6} {'size':>12} {'path':<10} {'best of ' + str(rounds):>12}")
+        for codec, path in archives.items():
+            paths = [('python', False)]
+            decompressor = utils.find_parallel_decompressor(codec)
+            if decompressor:
+                paths.append((decompressor[0], True))
+            for name, parallel in paths:
+                if codec == 'zst' and not parallel:
+                    continue
+                elapsed = bench(path, rounds, parallel)
+                print(f"{codec:<6} {path.stat().st_size:>12} {name:<10} {elapsed:>11.3f}s")
+
+        missing = [cmds[0][0] for codec, cmds in utils.PARALLEL_DECOMPRESSORS.items()
+                   if not utils.find_parallel_decompressor(codec)]
+        if missing:
+            print(f"Not installed: {', '.join(missing)}", file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
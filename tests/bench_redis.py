@@ -0,0 +1,139 @@
+#!/usr/bin/env python3
+"""
+Benchmark of memcache.local lookups through redis versus in process memory.
+
+Starts a stand-in redis (a minimal RESP server speaking PING/GET/SET) on
+localhost, optionally delaying every reply to mimic the network hop to a
+redis unit, and times the local cache lookups of one nextcloud request
+against it and against a dict standing in for APCu's shared memory.
+
+    PYTHONPATH=./src:./lib python3 -m tests.bench_redis [lookups] [rtt_ms] [requests]
+
+Pass host:port as REDIS to measure against a real redis instead.
+"""
+import os
+import socket
+import socketserver
+import sys
+import threading
+import time
+
+
+class StubRedisHandler(socketserver.StreamRequestHandler):
+    """
+    Answers PING, GET and SET in RESP, enough for the benchmark.
+    """
+
+    def handle(self):
+        while True:
+            command = self._read_command()
+            if command is None:
+                return
+            if self.server.rtt:
+                time.sleep(self.server.rtt)
+            name = command[0].upper()
+            if name == b'PING':
+                self.wfile.write(b'+PONG\r\n')
+            elif name == b'SET':
+                self.server.data[command[1]] = command[2]
+                self.wfile.write(b'+OK\r\n')
+            elif name == b'GET':
+                value = self.server.data.get(command[1])
+                if value is None:
+                    self.wfile.write(b'$-1\r\n')
+                else:
+                    self.wfile.write(b'$%d\r\n%s\r\n' % (len(value), value))
+            else:
+                self.wfile.write(b'-ERR unknown command\r\n')
+
+    def _read_command(self):
+        line = self.rfile.readline()
+        if not line:
+            return None
+        args = []
+        for _ in range(int(line[1:])):
+            length = int(self.rfile.readline()[1:])
+            args.append(self.rfile.read(length + 2)[:-2])
+        return args
+
+
+class StubRedis(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, rtt):
+        super().__init__(('127.0.0.1', 0), StubRedisHandler)
+        self.rtt = rtt
+        self.data = {}
+
+
+class RedisConnection:
+    """
+    One persistent connection, like phpredis with persistent => true.
+    """
+
+    def __init__(self, host, port):
+        self._sock = socket.create_connection((host, port))
+        self._sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self._file = self._sock.makefile('rb')
+
+    def command(self, *args):
+        payload = b'*%d\r\n' % len(args)
+        for arg in args:
+            arg = arg if isinstance(arg, bytes) else str(arg).encode()
+            payload += b'$%d\r\n%s\r\n' % (len(arg), arg)
+        self._sock.sendall(payload)
+        line = self._file.readline()
+        if line.startswith(b'$'):
+            length = int(line[1:])
+            return None if length < 0 else self._file.read(length + 2)[:-2]
+        return line[1:].strip()
+
+
+def bench_request(get, keys, requests):
+    """
+    Returns the mean time in ms the lookups of one request take.
+    """
+    start = time.perf_counter()
+    for _ in range(requests):
+        for key in keys:
+            get(key)
+    return (time.perf_counter() - start) * 1000 / requests
+
+
+def main():
+    # Nextcloud does tens to a few hundred local cache lookups per request
+    # (app infos, routes, l10n, config), 100 is a middle ground.
+    lookups = int(sys.argv[1]) if len(sys.argv) > 1 else 100
+    rtt = float(sys.argv[2]) / 1000 if len(sys.argv) > 2 else 0.0
+    requests = int(sys.argv[3]) if len(sys.argv) > 3 else 200
+
+    keys = [f'nextcloud/local/{i}' for i in range(lookups)]
+    server = None
+    if os.environ.get('REDIS'):
+        host, port = os.environ['REDIS'].rsplit(':', 1)
+        target = f"redis at {host}:{port}"
+    else:
+        server = StubRedis(rtt)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        host, port = server.server_address
+        target = f"stand-in redis, {rtt * 1000:.2f}ms added per reply"
+
+    redis = RedisConnection(host, int(port))
+    local = {}
+    for key in keys:
+        redis.command('SET', key, 'x' * 256)
+        local[key] = b'x' * 256
+
+    remote_ms = bench_request(lambda k: redis.command('GET', k), keys, requests)
+    local_ms = bench_request(local.get, keys, requests)
+    print(f"{lookups} memcache.local lookups per request, {requests} requests, {target}")
+    print(f"{'redis':<8} {remote_ms:>10.3f} ms/request")
+    print(f"{'apcu':<8} {local_ms:>10.3f} ms/request (in process stand-in)")
+    print(f"saved    {remote_ms - local_ms:>10.3f} ms/request")
+    if server:
+        server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
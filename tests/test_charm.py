@@ -1,9 +1,13 @@
 # Copyright 2020 Erik Lönroth
 # See LICENSE file for licensing details.
 # import sys
+import tempfile
 import unittest
+from pathlib import Path
+from unittest import mock
 from ops.testing import Harness
 import sys
+import templating
 # from unittest.mock import Mock
 # sys.path.append('./lib')
 from charm import NextcloudCharm
@@ -45,3 +49,32 @@ class TestCharm(unittest.TestCase):
         harness.begin()
         harness.charm.on.install.emit()
         self.assertTrue(harness.charm._stored.nextcloud_fetched)
+
+    def test_upgrade_rerenders_changed_templates(self):
+        harness = Harness(NextcloudCharm)
+        self.addCleanup(harness.cleanup)
+        harness.begin()
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        tmp = Path(tmpdir.name)
+        (tmp / 'nextcloud.ini.j2').write_text('memory_limit={{ limit }}\n')
+        target = tmp / 'nextcloud.ini'
+
+        def config_web():
+            templating._environments.clear()
+            templating.render_to_file(tmp, 'nextcloud.ini.j2', target, {'limit': '512M'})
+
+        charm = harness.charm
+        with mock.patch.object(charm, '_web_inputs', return_value={'php': '8.3'}), \
+                mock.patch.object(charm, '_charm_php_inputs', return_value=None), \
+                mock.patch.object(charm, '_config_web', side_effect=config_web), \
+                mock.patch('templating.BYTECODE_CACHE_DIR', tmp / 'jinja'):
+            charm.on.config_changed.emit()
+            self.assertEqual(target.read_text(), 'memory_limit=512M')
+
+            # A charm refresh ships a new template, the step's inputs stay the same.
+            (tmp / 'nextcloud.ini.j2').write_text('memory_limit = {{ limit }}\n')
+            charm.on.config_changed.emit()
+            self.assertEqual(target.read_text(), 'memory_limit=512M')
+            charm.on.upgrade_charm.emit()
+            self.assertEqual(target.read_text(), 'memory_limit = 512M')
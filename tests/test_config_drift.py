@@ -0,0 +1,74 @@
+import os
+import tempfile
+import unittest
+from pathlib import Path
+import config_drift
+
+SHARED = """<?php
+$CONFIG = array (
+  'instanceid' => 'oc1a2b3c',
+  'trusted_domains' =>
+  array (
+    0 => 'localhost',
+    1 => 'cloud.example.com',
+  ),
+  'dbpassword' => 'it\\'s, (secret)',
+  'maintenance' => false,
+);
+"""
+
+
+class TestConfigDrift(unittest.TestCase):
+    """
+    Unittests for config.php drift detection.
+    """
+
+    def test_config_entries(self) -> None:
+        entries = config_drift.config_entries(SHARED)
+        self.assertEqual(list(entries),
+                         ['instanceid', 'trusted_domains', 'dbpassword', 'maintenance'])
+        self.assertEqual(entries['trusted_domains'], "[0=>'localhost',1=>'cloud.example.com',]")
+        self.assertEqual(entries['dbpassword'], "'it\\'s, (secret)'")
+
+    def test_diff_names_keys(self) -> None:
+        local = SHARED.replace("1 => 'cloud.example.com'", "1 => '10.0.0.5'")
+        local = local.replace("  'maintenance' => false,\n", "  'debug' => true,\n")
+        self.assertEqual(config_drift.diff(local, SHARED),
+                         {'changed': ['trusted_domains'], 'local_only': ['debug'],
+                          'shared_only': ['maintenance']})
+        # Formatting alone is no drift.
+        reformatted = SHARED.replace("  array (\n", "  [\n").replace("  ),\n", "  ],\n")
+        self.assertEqual(config_drift.diff(reformatted, SHARED),
+                         {'changed': [], 'local_only': [], 'shared_only': []})
+
+    def test_file_digest_fast_path(self) -> None:
+        cache = {}
+        with tempfile.TemporaryDirectory() as tmp:
+            path = Path(tmp) / 'config.php'
+            self.assertIsNone(config_drift.file_digest(path, cache))
+            path.write_text(SHARED)
+            self.assertEqual(config_drift.file_digest(path, cache), config_drift.digest(SHARED))
+
+            # Same mtime and size: the cached digest is trusted, the file isn't read.
+            st = path.stat()
+            path.write_text(SHARED.upper())
+            os.utime(path, ns=(st.st_atime_ns, st.st_mtime_ns))
+            self.assertEqual(config_drift.file_digest(path, cache), config_drift.digest(SHARED))
+
+            path.write_text(SHARED + '\n')
+            self.assertEqual(config_drift.file_digest(path, cache),
+                             config_drift.digest(SHARED + '\n'))
+
+            # Files are cached side by side.
+            other = Path(tmp) / 'ceph.config.php'
+            other.write_text('<?php\n')
+            self.assertEqual(config_drift.file_digest(other, cache),
+                             config_drift.digest('<?php\n'))
+            self.assertEqual(len(cache), 2)
+            other.unlink()
+            self.assertIsNone(config_drift.file_digest(other, cache))
+            self.assertEqual(list(cache), [str(path)])
+
+
+if __name__ == '__main__':
+    unittest.main()
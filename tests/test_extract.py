@@ -0,0 +1,70 @@
+import bz2
+import gzip
+import lzma
+import os
+import shutil
+import subprocess as sp
+import tempfile
+import unittest
+from pathlib import Path
+import utils
+
+TARFILE = Path(__file__).parent / 'nextcloud.tar.bz2'
+
+
+def make_archives(dst, source=TARFILE):
+    """
+    Recompresses the source tar.bz2 with every supported codec into dst.
+    Returns {codec: path}, zst only if the zstd tool is installed.
+    """
+    tar = bz2.decompress(source.read_bytes())
+    archives = {'bz2': source, 'tar': dst / 'nextcloud.tar'}
+    archives['tar'].write_bytes(tar)
+    archives['xz'] = dst / 'nextcloud.tar.xz'
+    archives['xz'].write_bytes(lzma.compress(tar))
+    archives['gz'] = dst / 'nextcloud.tar.gz'
+    archives['gz'].write_bytes(gzip.compress(tar))
+    if shutil.which('zstd'):
+        archives['zst'] = dst / 'nextcloud.tar.zst'
+        sp.run(['zstd', '-q', '-o', str(archives['zst']), str(archives['tar'])], check=True)
+    return archives
+
+
+class TestExtract(unittest.TestCase):
+    """
+    Unittests for extracting nextcloud tarfiles with each codec path.
+    """
+
+    def setUp(self) -> None:
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.archives = make_archives(Path(self.tmpdir.name))
+
+    def tearDown(self) -> None:
+        self.tmpdir.cleanup()
+
+    def test_detect_tar_codec(self) -> None:
+        for codec, path in self.archives.items():
+            self.assertEqual(utils.detect_tar_codec(path), codec)
+        self.assertIsNone(utils.detect_tar_codec(b'not a tarfile'))
+
+    def test_extract_every_codec_path(self) -> None:
+        for codec, path in self.archives.items():
+            for parallel in (False, True):
+                if not parallel and codec == 'zst':
+                    continue
+                with self.subTest(codec=codec, parallel=parallel), \
+                        tempfile.TemporaryDirectory() as dst:
+                    utils.extract_nextcloud(path, dst=Path(dst), parallel=parallel)
+                    self.assertEqual(os.listdir(dst), ['slask.py'])
+
+    def test_corrupt_archive(self) -> None:
+        corrupt = Path(self.tmpdir.name) / 'corrupt.tar.xz'
+        corrupt.write_bytes(self.archives['xz'].read_bytes()[:40])
+        for parallel in (False, True):
+            with self.subTest(parallel=parallel), tempfile.TemporaryDirectory() as dst:
+                with self.assertRaises(Exception):
+                    utils.extract_nextcloud(corrupt, dst=Path(dst), parallel=parallel)
+
+
+if __name__ == '__main__':
+    unittest.main()
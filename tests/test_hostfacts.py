@@ -0,0 +1,59 @@
+import os
+import tempfile
+import unittest
+from pathlib import Path
+import hostfacts
+
+
+class TestHostFacts(unittest.TestCase):
+    """
+    Unittests for the cached host probes.
+    """
+
+    def setUp(self) -> None:
+        self.tmpdir = tempfile.TemporaryDirectory()
+        tmp = Path(self.tmpdir.name)
+        self.dpkg_status = tmp / 'status'
+        self.dpkg_status.write_text('Package: php8.3\n')
+        self.old = (hostfacts.CACHE_FILE, hostfacts.DPKG_STATUS,
+                    hostfacts.APACHE_MODS_ENABLED, hostfacts._probe_php_version)
+        hostfacts.CACHE_FILE = tmp / 'cache' / 'hostfacts.json'
+        hostfacts.DPKG_STATUS = self.dpkg_status
+        hostfacts.APACHE_MODS_ENABLED = tmp / 'mods-enabled'
+        hostfacts._cache = None
+        self.probes = []
+
+        def probe():
+            self.probes.append('php')
+            return '8.3'
+        hostfacts._probe_php_version = probe
+
+    def tearDown(self) -> None:
+        (hostfacts.CACHE_FILE, hostfacts.DPKG_STATUS,
+         hostfacts.APACHE_MODS_ENABLED, hostfacts._probe_php_version) = self.old
+        hostfacts._cache = None
+        self.tmpdir.cleanup()
+
+    def test_probes_once_per_package_state(self) -> None:
+        self.assertEqual(hostfacts.php_version(), '8.3')
+        self.assertEqual(hostfacts.php_version(), '8.3')
+        # A new hook only has the file to go by.
+        hostfacts._cache = None
+        self.assertEqual(hostfacts.php_version(), '8.3')
+        self.assertEqual(self.probes, ['php'])
+
+        self.dpkg_status.write_text('Package: php8.3\nPackage: php8.3-fpm\n')
+        os.utime(self.dpkg_status, ns=(0, 0))
+        self.assertEqual(hostfacts.php_version(), '8.3')
+        self.assertEqual(self.probes, ['php', 'php'])
+
+    def test_apache_modules(self) -> None:
+        self.assertEqual(hostfacts.apache_modules(), set())
+        hostfacts.APACHE_MODS_ENABLED.mkdir()
+        for name in ['rewrite.load', 'headers.load', 'mime.conf']:
+            (hostfacts.APACHE_MODS_ENABLED / name).touch()
+        self.assertEqual(hostfacts.apache_modules(), {'rewrite', 'headers'})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,64 @@
+"""
+Import-time check of the charm's dispatch path.
+
+Every hook starts by importing src/charm.py; heavy dependencies must only
+be imported by the functions that need them. Run as a script for a report
+of the slowest imports:
+
+    python3 -m tests.test_import_time [count]
+"""
+import os
+import subprocess
+import sys
+import unittest
+from pathlib import Path
+
+ROOT = Path(__file__).parent.parent
+
+# Only needed by install, downloads or rendering templates.
+LAZY_MODULES = [
+    'requests',
+    'jinja2',
+    'charms.operator_libs_linux.v0.apt',
+]
+
+
+def import_times(module='charm') -> dict:
+    """
+    Imports module in a fresh interpreter with -X importtime.
+    Returns {module name: (self us, cumulative us)}.
+    """
+    env = dict(os.environ, PYTHONPATH=f"{ROOT / 'src'}:{ROOT / 'lib'}")
+    cp = subprocess.run([sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+                        env=env, cwd=ROOT, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+                        universal_newlines=True, check=True)
+    times = {}
+    for line in cp.stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        own, cumulative, name = line[len('import time:'):].split('|')
+        times[name.strip()] = (int(own), int(cumulative))
+    return times
+
+
+class TestImportTime(unittest.TestCase):
+    """
+    Keeps heavy dependencies off the dispatch path.
+    """
+
+    def test_heavy_modules_are_lazy(self) -> None:
+        times = import_times('charm')
+        self.assertIn('charm', times)
+        self.assertEqual([m for m in LAZY_MODULES if m in times], [])
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+    times = import_times('charm')
+    print(f"import charm: {times['charm'][1] / 1000:.1f} ms cumulative")
+    for name, (own, _) in sorted(times.items(), key=lambda t: t[1][0], reverse=True)[:count]:
+        print(f"{own / 1000:>8.1f} ms  {name}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,75 @@
+import tempfile
+import unittest
+from pathlib import Path
+import phpmods
+from interface_redis import memcache_local, redis_session_save_path
+
+
+class TestRedisSessionSavePath(unittest.TestCase):
+    """
+    Unittests for the phpredis session.save_path.
+    """
+
+    def setUp(self) -> None:
+        self.redis_info = {
+            'redis_cluster': False,
+            'redis_seeds': ['10.0.0.5:6379'],
+            'redis_hostname': '10.0.0.5',
+            'redis_port': 6379,
+            'redis_socket': '',
+            'redis_password': '',
+            'redis_session_dbindex': 1,
+            'redis_persistent': True,
+            'redis_timeout': 1.5,
+            'redis_read_timeout': 0.0,
+        }
+
+    def test_tcp(self) -> None:
+        self.assertEqual(redis_session_save_path(self.redis_info),
+                         'tcp://10.0.0.5:6379?database=1&persistent=1'
+                         '&timeout=1.5&read_timeout=0.0')
+
+    def test_socket_with_password(self) -> None:
+        self.redis_info.update(redis_socket='/run/redis/redis-server.sock',
+                               redis_password='p&ss "w"')
+        self.assertEqual(redis_session_save_path(self.redis_info),
+                         'unix:///run/redis/redis-server.sock?database=1&persistent=1'
+                         '&timeout=1.5&read_timeout=0.0&auth=p%26ss+%22w%22')
+
+    def test_cluster(self) -> None:
+        self.redis_info.update(redis_cluster=True, redis_seeds=['10.0.0.5:6379', '10.0.0.6:6379'],
+                               redis_password='secret')
+        self.assertEqual(redis_session_save_path(self.redis_info),
+                         'seed[]=10.0.0.5:6379&seed[]=10.0.0.6:6379&timeout=1.5&read_timeout=0.0'
+                         '&failover=error&persistent=1&auth=secret')
+
+
+class TestMemcacheLocal(unittest.TestCase):
+    """
+    Unittests for picking the memcache.local backend.
+    """
+
+    def setUp(self) -> None:
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.etc = Path(self.tmpdir.name)
+        for sapi in ['cli', 'fpm']:
+            (self.etc / '8.3' / sapi / 'conf.d').mkdir(parents=True)
+        (self.etc / '8.3' / 'mods-available').mkdir()
+        self.old_etc = phpmods.PHP_ETC
+        phpmods.PHP_ETC = self.etc
+
+    def tearDown(self) -> None:
+        phpmods.PHP_ETC = self.old_etc
+        self.tmpdir.cleanup()
+
+    def test_apcu_only_when_enabled(self) -> None:
+        # Units installed before php-apcu was a dependency.
+        self.assertEqual(memcache_local(), 'Redis')
+        (self.etc / '8.3' / 'cli' / 'conf.d' / '20-apcu.ini').touch()
+        self.assertEqual(memcache_local(), 'Redis')
+        (self.etc / '8.3' / 'fpm' / 'conf.d' / '20-apcu.ini').touch()
+        self.assertEqual(memcache_local(), 'APCu')
+
+
+if __name__ == '__main__':
+    unittest.main()
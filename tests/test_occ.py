@@ -0,0 +1,91 @@
+import os
+import stat
+import tempfile
+import unittest
+from pathlib import Path
+import occ
+from occ import Occ, OccSession, diff_indexed_list
+
+# Stands in for 'sudo -u www-data php ...': speaks the occ worker protocol
+# when started with 'php -r', otherwise behaves like a forked occ.
+FAKE_SUDO = """#!/usr/bin/env python3
+import json
+import sys
+if '-r' in sys.argv:
+    print('PHP Warning: noise before the handshake', flush=True)
+    print(json.dumps({'ready': True}), flush=True)
+    for line in sys.stdin:
+        request = json.loads(line)
+        if request['argv'] == ['crash']:
+            sys.exit(255)
+        print(json.dumps({'id': request['id'], 'returncode': 0,
+                          'stdout': 'worker ' + ' '.join(request['argv'])}), flush=True)
+else:
+    print('fork ' + ' '.join(sys.argv[5:]))
+"""
+
+
+class TestOccSession(unittest.TestCase):
+    """
+    Unittests for the persistent occ worker session.
+    """
+
+    def setUp(self) -> None:
+        self.tmpdir = tempfile.TemporaryDirectory()
+        tmp = Path(self.tmpdir.name)
+        (tmp / 'bin').mkdir()
+        (tmp / 'config').mkdir()
+        sudo = tmp / 'bin' / 'sudo'
+        sudo.write_text(FAKE_SUDO)
+        sudo.chmod(sudo.stat().st_mode | stat.S_IEXEC)
+        self.old_path = os.environ['PATH']
+        os.environ['PATH'] = f"{tmp / 'bin'}:{self.old_path}"
+        self.old_root = occ.NEXTCLOUD_ROOT
+        occ.NEXTCLOUD_ROOT = str(tmp)
+
+    def tearDown(self) -> None:
+        os.environ['PATH'] = self.old_path
+        occ.NEXTCLOUD_ROOT = self.old_root
+        self.tmpdir.cleanup()
+
+    def test_forks_without_session(self) -> None:
+        self.assertEqual(Occ.status().stdout.strip(), 'fork status --output=json --no-warnings')
+
+    def test_session_reuses_worker(self) -> None:
+        with OccSession(occ.NEXTCLOUD_ROOT) as session:
+            self.assertEqual(Occ.status().stdout, 'worker status --output=json --no-warnings')
+            worker = session._proc
+            Occ.db_add_missing_indices()
+            self.assertIs(session._proc, worker)
+        self.assertIsNone(Occ._session)
+
+    def test_session_falls_back_to_fork(self) -> None:
+        with OccSession(occ.NEXTCLOUD_ROOT):
+            self.assertEqual(Occ.run(['crash']).stdout.strip(), 'fork crash')
+            self.assertEqual(Occ.status().stdout.strip(),
+                             'fork status --output=json --no-warnings')
+
+
+class TestDiffIndexedList(unittest.TestCase):
+    """
+    Unittests for computing trusted_domains changes.
+    """
+
+    def test_unchanged(self) -> None:
+        current = {0: 'localhost', 1: 'cloud.example.com', 2: '10.0.0.1'}
+        self.assertEqual(diff_indexed_list(current, list(current.values())), ([], []))
+
+    def test_departed_peer(self) -> None:
+        current = {0: 'localhost', 1: 'cloud.example.com', 2: '10.0.0.1', 3: '10.0.0.2'}
+        desired = ['localhost', 'cloud.example.com', '10.0.0.2']
+        self.assertEqual(diff_indexed_list(current, desired), ([(2, '10.0.0.2')], [3]))
+
+    def test_holes_are_compacted(self) -> None:
+        current = {0: 'localhost', 2: '10.0.0.1', 5: '10.0.0.2'}
+        desired = ['localhost', '10.0.0.1', '10.0.0.2']
+        self.assertEqual(diff_indexed_list(current, desired),
+                         ([(1, '10.0.0.1'), (2, '10.0.0.2')], [5]))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,46 @@
+import unittest
+import peer_payload
+
+APPS = "".join(f"  'app_{i}' => array ('enabled' => 'yes', 'types' => 'filesystem'),\n"
+               for i in range(200))
+CONFIG_PHP = "<?php\n$CONFIG = array (\n" + APPS + ");\n"
+
+
+class TestPeerPayload(unittest.TestCase):
+    """
+    Unittests for the config payload shared with the peers.
+    """
+
+    def test_roundtrip(self) -> None:
+        files = {'config.php': CONFIG_PHP, 'ceph.config.php': "<?php\n"}
+        payload, sha256 = peer_payload.encode(files)
+        self.assertEqual(peer_payload.decode(payload, sha256), files)
+        self.assertLess(len(payload), len(CONFIG_PHP) // 4)
+        # Same content, same digest: the leader doesn't bump the revision.
+        self.assertEqual(peer_payload.encode(dict(reversed(files.items())))[1], sha256)
+
+    def test_damaged_payload(self) -> None:
+        payload, sha256 = peer_payload.encode({'config.php': CONFIG_PHP})
+        with self.assertRaises(ValueError):
+            peer_payload.decode(payload, '0' * 64)
+        with self.assertRaises(ValueError):
+            peer_payload.decode(payload[:-8])
+        with self.assertRaises(ValueError):
+            peer_payload.decode('<?php not a payload')
+
+    def test_split_secrets(self) -> None:
+        config = ("<?php\n$CONFIG = array (\n  'passwordsalt' => 'salt',\n"
+                  "  'dbpassword' => 'it\\'s => secret',\n  'dbuser' => 'nextcloud',\n);\n")
+        files = {'config.php': config, 'ceph.config.php': "<?php\n"}
+        shared, secrets = peer_payload.split_secrets(files)
+        self.assertEqual(secrets, {'config-php-passwordsalt': "'salt'",
+                                   'config-php-dbpassword': "'it\\'s => secret'"})
+        self.assertNotIn("'salt'", shared['config.php'])
+        self.assertIn("'dbuser' => 'nextcloud'", shared['config.php'])
+        self.assertEqual(peer_payload.join_secrets(shared, secrets), files)
+        with self.assertRaises(ValueError):
+            peer_payload.join_secrets(shared, {})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,90 @@
+import os
+import stat
+import tempfile
+import unittest
+from pathlib import Path
+import phpmods
+
+# Stands in for phpenmod/phpdismod on the fake /etc/php tree: logs its
+# arguments and links or unlinks the module in every SAPI's conf.d.
+FAKE_PHPENMOD = """#!/usr/bin/env python3
+import os
+import sys
+from pathlib import Path
+etc = Path(os.environ['FAKE_PHP_ETC'])
+with open(etc / 'calls.log', 'a') as f:
+    f.write(' '.join([Path(sys.argv[0]).name] + sys.argv[1:]) + '\\n')
+name = sys.argv[-1]
+for confd in etc.glob('*/*/conf.d'):
+    link = confd / f'20-{name}.ini'
+    if sys.argv[0].endswith('phpenmod'):
+        link.unlink(missing_ok=True)
+        link.symlink_to(confd.parent.parent / 'mods-available' / f'{name}.ini')
+    else:
+        link.unlink(missing_ok=True)
+"""
+
+
+class TestPhpMods(unittest.TestCase):
+    """
+    Unittests for the php module manager.
+    """
+
+    def setUp(self) -> None:
+        self.tmpdir = tempfile.TemporaryDirectory()
+        tmp = Path(self.tmpdir.name)
+        self.etc = tmp / 'php'
+        for version in ['8.1', '8.3']:
+            (self.etc / version / 'mods-available').mkdir(parents=True)
+            for sapi in ['apache2', 'cli', 'fpm']:
+                (self.etc / version / sapi / 'conf.d').mkdir(parents=True)
+        (tmp / 'bin').mkdir()
+        for tool in ['phpenmod', 'phpdismod']:
+            path = tmp / 'bin' / tool
+            path.write_text(FAKE_PHPENMOD)
+            path.chmod(path.stat().st_mode | stat.S_IEXEC)
+        self.old_path = os.environ['PATH']
+        os.environ['PATH'] = f"{tmp / 'bin'}:{self.old_path}"
+        os.environ['FAKE_PHP_ETC'] = str(self.etc)
+        self.old_etc = phpmods.PHP_ETC
+        phpmods.PHP_ETC = self.etc
+
+    def tearDown(self) -> None:
+        os.environ['PATH'] = self.old_path
+        del os.environ['FAKE_PHP_ETC']
+        phpmods.PHP_ETC = self.old_etc
+        self.tmpdir.cleanup()
+
+    def calls(self):
+        log = self.etc / 'calls.log'
+        return log.read_text().splitlines() if log.exists() else []
+
+    def test_installed_versions(self) -> None:
+        (self.etc / '7.4').mkdir()  # Leftover without mods-available
+        (self.etc / '8.10' / 'mods-available').mkdir(parents=True)
+        self.assertEqual(phpmods.installed_versions(), ['8.1', '8.3', '8.10'])
+
+    def test_config_module_covers_all_versions(self) -> None:
+        content = '; priority=30\nsession.save_handler = redis\n'
+        self.assertTrue(phpmods.config_module('redis_session', content))
+        for version in ['8.1', '8.3']:
+            ini = self.etc / version / 'mods-available' / 'redis_session.ini'
+            self.assertEqual(ini.read_text(), content)
+        self.assertTrue(phpmods.is_enabled('redis_session'))
+        self.assertEqual(self.calls(), ['phpenmod -v ALL -s ALL redis_session'])
+
+        # Unchanged and enabled: nothing to do.
+        self.assertFalse(phpmods.config_module('redis_session', content))
+        self.assertEqual(len(self.calls()), 1)
+
+    def test_remove_module(self) -> None:
+        self.assertFalse(phpmods.remove_module('redis_session'))
+        phpmods.config_module('redis_session', '; priority=30\n')
+        self.assertTrue(phpmods.remove_module('redis_session'))
+        self.assertFalse(any(self.etc.glob('*/mods-available/redis_session.ini')))
+        self.assertFalse(any(self.etc.glob('*/*/conf.d/*-redis_session.ini')))
+        self.assertEqual(self.calls()[-1], 'phpdismod -v ALL -s ALL redis_session')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,69 @@
+import subprocess
+import sys
+import tempfile
+import unittest
+from pathlib import Path
+import profiler
+
+
+class TestProfiler(unittest.TestCase):
+    """
+    Unittests for the hook profiler.
+    """
+
+    def setUp(self) -> None:
+        self.tmpdir = tempfile.TemporaryDirectory()
+        tmp = Path(self.tmpdir.name)
+        self.old = (profiler.PROFILE_LOG, profiler.PROFILE_DIR)
+        profiler.PROFILE_LOG = tmp / 'hook-profile.jsonl'
+        profiler.PROFILE_DIR = tmp / 'profiles'
+
+    def tearDown(self) -> None:
+        profiler.PROFILE_LOG, profiler.PROFILE_DIR = self.old
+        self.tmpdir.cleanup()
+
+    def test_dispatch_records_timing_tree(self) -> None:
+        sp = profiler.TimedSubprocess(subprocess)
+        with profiler.dispatch('hooks/config-changed'):
+            with profiler.span('hook', 'NextcloudCharm._on_config_changed'):
+                with profiler.span('occ', 'status'):
+                    pass
+                sp.run([sys.executable, '-c', 'pass'], check=True)
+        record = profiler.recent(1)[0]
+        self.assertEqual(record['hook'], 'hooks/config-changed')
+        self.assertIsNone(record['error'])
+        hook = record['spans'][0]
+        self.assertEqual([(c['kind'], c['name']) for c in hook['children']],
+                         [('occ', 'status'), ('subprocess', f'{sys.executable} -c pass')])
+        self.assertEqual(set(record['totals']), {'hook', 'occ', 'subprocess'})
+        self.assertGreaterEqual(record['totals']['hook'], record['totals']['subprocess'])
+
+    def test_spans_outside_dispatch_do_nothing(self) -> None:
+        with profiler.span('occ', 'status') as s:
+            self.assertIsNone(s)
+        self.assertEqual(profiler.recent(), [])
+
+    def test_failed_dispatch_and_slowest(self) -> None:
+        with self.assertRaises(RuntimeError):
+            with profiler.dispatch('hooks/install'):
+                raise RuntimeError("apt failed")
+        with self.assertRaises(SystemExit):
+            with profiler.dispatch('hooks/update-status'):
+                sys.exit(0)
+        records = profiler.recent()
+        self.assertEqual([r['error'] for r in records], ['RuntimeError', None])
+        self.assertEqual(len(profiler.recent(1, slowest=True)), 1)
+
+    def test_cprofile_keeps_slowest_dumps(self) -> None:
+        for _ in range(profiler.KEEP_PROFILES + 2):
+            with profiler.dispatch('hooks/update-status'):
+                profiler.enable('cprofile')
+        self.assertEqual(len(list(profiler.PROFILE_DIR.glob('*.prof'))), profiler.KEEP_PROFILES)
+        kept = {str(p) for p in profiler.PROFILE_DIR.iterdir()}
+        self.assertTrue(kept <= {r.get('profile') for r in profiler.recent()})
+        with self.assertRaises(ValueError):
+            profiler.enable('perf')
+
+
+if __name__ == '__main__':
+    unittest.main()
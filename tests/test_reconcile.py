@@ -0,0 +1,75 @@
+import unittest
+import reconcile
+
+
+class TestRunSteps(unittest.TestCase):
+    """
+    Unittests for the reconcile steps runner.
+    """
+
+    def setUp(self) -> None:
+        self.calls = []
+        self.inputs = {'web': {'php_memory_limit': '512M'}, 'peer': None}
+        self.fingerprints = {}
+
+    def steps(self):
+        return [(name,
+                 lambda name=name: self.inputs[name],
+                 lambda name=name: self.calls.append(name))
+                for name in self.inputs]
+
+    def outcomes(self, report):
+        return {name: outcome for name, outcome, _ in report}
+
+    def test_runs_only_changed_steps(self) -> None:
+        report = reconcile.run_steps(self.steps(), self.fingerprints)
+        self.assertEqual(self.outcomes(report), {'web': reconcile.RAN, 'peer': reconcile.WAITING})
+        self.assertEqual(self.calls, ['web'])
+
+        report = reconcile.run_steps(self.steps(), self.fingerprints)
+        self.assertEqual(self.outcomes(report),
+                         {'web': reconcile.UNCHANGED, 'peer': reconcile.WAITING})
+        self.assertEqual(self.calls, ['web'])
+
+        self.inputs['web'] = {'php_memory_limit': '1G'}
+        self.inputs['peer'] = ['config']
+        report = reconcile.run_steps(self.steps(), self.fingerprints)
+        self.assertEqual(self.outcomes(report), {'web': reconcile.RAN, 'peer': reconcile.RAN})
+        self.assertEqual(self.calls, ['web', 'web', 'peer'])
+        self.assertTrue(all(seconds >= 0 for _, _, seconds in report))
+
+    def test_fingerprint_taken_after_action(self) -> None:
+        # The step changes its own observed state, e.g. enables a module.
+        observed = []
+        steps = [('web', lambda: list(observed), lambda: observed.append('mpm_event'))]
+        reconcile.run_steps(steps, self.fingerprints)
+        report = reconcile.run_steps(steps, self.fingerprints)
+        self.assertEqual(report[0][1], reconcile.UNCHANGED)
+
+    def test_failed_step_runs_again(self) -> None:
+        def fail():
+            raise RuntimeError("occ failed")
+        steps = [('web', lambda: 1, fail)]
+        with self.assertRaises(RuntimeError):
+            reconcile.run_steps(steps, self.fingerprints)
+        self.assertNotIn('web', self.fingerprints)
+
+    def test_step_returning_false_runs_again(self) -> None:
+        results = [False, None]
+        steps = [('peer', lambda: 1, lambda: results.pop(0))]
+        self.assertEqual(reconcile.run_steps(steps, self.fingerprints)[0][1], reconcile.RETRY)
+        self.assertEqual(reconcile.run_steps(steps, self.fingerprints)[0][1], reconcile.RAN)
+        self.assertEqual(reconcile.run_steps(steps, self.fingerprints)[0][1], reconcile.UNCHANGED)
+
+    def test_waiting_step_forgets_fingerprint(self) -> None:
+        self.inputs['peer'] = ['config']
+        reconcile.run_steps(self.steps(), self.fingerprints)
+        self.inputs['peer'] = None
+        reconcile.run_steps(self.steps(), self.fingerprints)
+        self.inputs['peer'] = ['config']
+        reconcile.run_steps(self.steps(), self.fingerprints)
+        self.assertEqual(self.calls.count('peer'), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,62 @@
+import os
+import tempfile
+import unittest
+from pathlib import Path
+from release_cache import ReleaseCache
+from tests.test_extract import make_archives
+
+TARFILE = Path(__file__).parent / 'nextcloud.tar.bz2'
+
+
+class TestReleaseCache(unittest.TestCase):
+    """
+    Unittests for the local release cache.
+    """
+
+    def setUp(self) -> None:
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.tmp = Path(self.tmpdir.name)
+
+    def tearDown(self) -> None:
+        self.tmpdir.cleanup()
+
+    def test_add_file_and_install(self) -> None:
+        cache = ReleaseCache(self.tmp / 'cache')
+        digest = cache.add_file(TARFILE)
+        self.assertEqual(cache.add_file(TARFILE), digest)
+        self.assertEqual(cache.lookup('file', sha256=digest.upper()), digest)
+
+        dst = self.tmp / 'www'
+        dst.mkdir()
+        cache.install(digest, dst=dst)
+        self.assertEqual(os.listdir(dst), ['slask.py'])
+        # Survives a new instance, like a new hook on the same machine.
+        self.assertIn(digest, ReleaseCache(self.tmp / 'cache').entries())
+
+    def test_evicts_least_recently_used(self) -> None:
+        archives = make_archives(self.tmp)
+        cache = ReleaseCache(self.tmp / 'cache')
+        old = cache.add_file(archives['xz'])
+        new = cache.add_file(archives['gz'])
+        limit = max(entry['size'] for entry in cache.entries().values())
+
+        # Installing the older release makes the newer one least recently used.
+        dst = self.tmp / 'www'
+        dst.mkdir()
+        cache.install(old, dst=dst)
+        evicted = ReleaseCache(self.tmp / 'cache', max_size=limit).evict()
+        self.assertEqual(evicted, [new])
+        self.assertEqual(list(ReleaseCache(self.tmp / 'cache').entries()), [old])
+
+    def test_evict_keeps_release(self) -> None:
+        archives = make_archives(self.tmp)
+        cache = ReleaseCache(self.tmp / 'cache')
+        old = cache.add_file(archives['xz'])
+        new = cache.add_file(archives['gz'])
+
+        evicted = ReleaseCache(self.tmp / 'cache', max_size=1).evict(keep=[old])
+        self.assertEqual(evicted, [new])
+
+
+if __name__ == '__main__':
+    unittest.main()
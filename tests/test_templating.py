@@ -0,0 +1,88 @@
+import os
+import stat
+import tempfile
+import unittest
+from pathlib import Path
+from unittest import mock
+import templating
+
+
+class TestWriteIfChanged(unittest.TestCase):
+    """
+    Unittests for change aware rendering.
+    """
+
+    def test_write_if_changed(self) -> None:
+        with tempfile.TemporaryDirectory() as tmp:
+            target = Path(tmp) / 'nextcloud.ini'
+            self.assertTrue(templating.write_if_changed(target, 'memory_limit=512M\n', mode=0o640))
+            mtime = target.stat().st_mtime_ns
+            self.assertFalse(templating.write_if_changed(target, 'memory_limit=512M\n'))
+            self.assertEqual(target.stat().st_mtime_ns, mtime)
+            self.assertTrue(templating.write_if_changed(target, 'memory_limit=1G\n'))
+            self.assertEqual(target.read_text(), 'memory_limit=1G\n')
+            # Mode of the existing file is kept.
+            self.assertEqual(target.stat().st_mode & 0o777, 0o640)
+            self.assertEqual(os.listdir(tmp), ['nextcloud.ini'])
+
+    def test_temp_file_never_wider_than_mode(self) -> None:
+        modes = []
+        real_fsync = os.fsync
+
+        def fsync(fd):
+            st = os.fstat(fd)
+            # The temp file holds the content by now, directories are synced too.
+            if stat.S_ISREG(st.st_mode):
+                modes.append(stat.S_IMODE(st.st_mode))
+            real_fsync(fd)
+
+        old_umask = os.umask(0)
+        try:
+            with tempfile.TemporaryDirectory() as tmp:
+                target = Path(tmp) / 'redis.config.php'
+                # Left over by a crash, world readable.
+                leftover = Path(tmp) / '.redis.config.php.tmp'
+                leftover.touch(mode=0o666)
+                with mock.patch('os.fsync', side_effect=fsync):
+                    templating.write_if_changed(target, "'password' => 'secret'", mode=0o640)
+                    templating.write_if_changed(target, "'password' => 'other'")
+                self.assertEqual(target.stat().st_mode & 0o777, 0o640)
+        finally:
+            os.umask(old_umask)
+        self.assertEqual(modes, [0o640, 0o640])
+
+
+class TestPhpLiteral(unittest.TestCase):
+    """
+    Unittests for rendering values into *.config.php files.
+    """
+
+    def test_scalars(self) -> None:
+        self.assertEqual(templating.php_literal(True), 'true')
+        self.assertEqual(templating.php_literal(None), 'null')
+        self.assertEqual(templating.php_literal(6379), '6379')
+        self.assertEqual(templating.php_literal("it's a \\path"), "'it\\'s a \\\\path'")
+
+    def test_arrays(self) -> None:
+        self.assertEqual(templating.php_literal(['a', 1]), "['a', 1]")
+        self.assertEqual(templating.php_literal({'host': 'h', 'port': 1}),
+                         "['host' => 'h', 'port' => 1]")
+
+
+class TestRender(unittest.TestCase):
+    """
+    Unittests for the shared template environment.
+    """
+
+    def test_render_to_file(self) -> None:
+        with tempfile.TemporaryDirectory() as tmp:
+            (Path(tmp) / 'test.conf.j2').write_text("host = {{ host|php }}\n")
+            target = Path(tmp) / 'test.conf'
+            self.assertIs(templating.environment(tmp), templating.environment(tmp + '/'))
+            self.assertTrue(templating.render_to_file(tmp, 'test.conf.j2', target, {'host': 'h'}))
+            self.assertFalse(templating.render_to_file(tmp, 'test.conf.j2', target, {'host': 'h'}))
+            self.assertEqual(target.read_text(), "host = 'h'")
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,78 @@
+import unittest
+import tuning
+from tuning import MiB, php_tuning, parse_overrides
+
+GiB = 1024 * MiB
+
+
+class TestPhpTuning(unittest.TestCase):
+    """
+    Unittests for sizing the php-fpm pool and opcache.
+    """
+
+    def assertConsistent(self, t) -> None:
+        self.assertLessEqual(t['pm.min_spare_servers'], t['pm.start_servers'])
+        self.assertLessEqual(t['pm.start_servers'], t['pm.max_spare_servers'])
+        self.assertLessEqual(t['pm.max_spare_servers'], t['pm.max_children'])
+
+    def test_small_unit(self) -> None:
+        t = php_tuning(cores=1, memory=2 * GiB, memory_limit=1 * GiB)
+        self.assertEqual(t['opcache.memory_consumption'], 128)
+        self.assertEqual(t['opcache.interned_strings_buffer'], 16)
+        self.assertEqual(t['pm.max_children'], 4)
+        self.assertConsistent(t)
+
+    def test_bigger_unit_gets_more(self) -> None:
+        small = php_tuning(cores=2, memory=4 * GiB, memory_limit=512 * MiB)
+        big = php_tuning(cores=16, memory=64 * GiB, memory_limit=512 * MiB)
+        self.assertEqual(big['opcache.memory_consumption'], 512)
+        self.assertEqual(big['opcache.max_accelerated_files'], 20000)
+        self.assertGreater(big['pm.max_children'], small['pm.max_children'])
+        self.assertEqual(big['pm.max_children'], 16 * tuning.CHILDREN_PER_CORE)
+        self.assertConsistent(small)
+        self.assertConsistent(big)
+
+    def test_unlimited_memory_limit(self) -> None:
+        self.assertEqual(php_tuning(4, 8 * GiB, -1),
+                         php_tuning(4, 8 * GiB, tuning.UNLIMITED_MEMORY_LIMIT))
+
+    def test_overrides_keep_pool_consistent(self) -> None:
+        t = php_tuning(cores=8, memory=32 * GiB, memory_limit=512 * MiB,
+                       overrides={'pm.max_children': 6, 'opcache.memory_consumption': 256})
+        self.assertEqual(t['pm.max_children'], 6)
+        self.assertEqual(t['opcache.memory_consumption'], 256)
+        self.assertEqual(t['opcache.interned_strings_buffer'], 32)
+        self.assertConsistent(t)
+
+    def test_derived_spare_servers_fit_overrides(self) -> None:
+        t = php_tuning(cores=8, memory=32 * GiB, memory_limit=512 * MiB,
+                       overrides={'pm.max_spare_servers': 4})
+        self.assertEqual(t['pm.min_spare_servers'], 4)
+        self.assertConsistent(t)
+
+    def test_min_spare_above_max_children(self) -> None:
+        with self.assertRaises(ValueError):
+            php_tuning(cores=8, memory=32 * GiB, memory_limit=512 * MiB,
+                       overrides={'pm.max_children': 6, 'pm.min_spare_servers': 10})
+
+    def test_max_spare_below_min_spare(self) -> None:
+        with self.assertRaises(ValueError):
+            php_tuning(cores=8, memory=32 * GiB, memory_limit=512 * MiB,
+                       overrides={'pm.min_spare_servers': 8, 'pm.max_spare_servers': 4})
+        # Only checked for dynamic pools.
+        overrides = {'pm': 'static', 'pm.min_spare_servers': 8, 'pm.max_spare_servers': 4}
+        php_tuning(cores=8, memory=32 * GiB, memory_limit=512 * MiB, overrides=overrides)
+
+    def test_parse_overrides(self) -> None:
+        self.assertEqual(parse_overrides(''), {})
+        self.assertEqual(
+            parse_overrides('pm=static, pm.max_children=40\nopcache.memory_consumption=256'),
+            {'pm': 'static', 'pm.max_children': 40, 'opcache.memory_consumption': 256})
+        with self.assertRaises(ValueError):
+            parse_overrides('pm.max_kids=40')
+        with self.assertRaises(ValueError):
+            parse_overrides('pm.max_children=lots')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -2,6 +2,11 @@
 import os
 import unittest
 import threading
+import functools
+import hashlib
+import tempfile
+from pathlib import Path
+from unittest import mock
 from http.server import SimpleHTTPRequestHandler, HTTPServer
 # sys.path.append('./src')
 import utils
@@ -12,20 +17,23 @@ class TestUtils(unittest.TestCase):
     Unittests for utils functions
     """
 
-    def setUp(self) -> None:
+    @classmethod
+    def setUpClass(cls) -> None:
         """
         Launch a local webserver to serve a fake nextcloud.tar.bz2 file
         :return:
         """
-        os.chdir('tests')
-        handler = SimpleHTTPRequestHandler
-        httpd = HTTPServer(("", 8081), handler)
-        self.httpd_thread = threading.Thread(target=httpd.serve_forever)
-        self.httpd_thread.daemon = True
-        self.httpd_thread.start()
+        cls.tests_dir = os.path.dirname(os.path.abspath(__file__))
+        handler = functools.partial(SimpleHTTPRequestHandler, directory=cls.tests_dir)
+        cls.httpd = HTTPServer(("", 8081), handler)
+        cls.httpd_thread = threading.Thread(target=cls.httpd.serve_forever)
+        cls.httpd_thread.daemon = True
+        cls.httpd_thread.start()
 
-    def tearDown(self) -> None:
-        pass
+    @classmethod
+    def tearDownClass(cls) -> None:
+        cls.httpd.shutdown()
+        cls.httpd.server_close()
 
     def test_fetch_and_extract_nextcloud(self) -> None:
         """
@@ -33,6 +41,107 @@ class TestUtils(unittest.TestCase):
         """
         utils.fetch_and_extract_nextcloud('http://localhost:8081/nextcloud.tar.bz2')
 
+    def test_fetch_and_extract_nextcloud_checksum(self) -> None:
+        """
+        Test that the streamed download is verified against its sha256.
+        """
+        with open(os.path.join(self.tests_dir, 'nextcloud.tar.bz2'), 'rb') as f:
+            digest = hashlib.sha256(f.read()).hexdigest()
+        with tempfile.TemporaryDirectory() as dst:
+            progress = []
+            utils.fetch_and_extract_nextcloud('http://localhost:8081/nextcloud.tar.bz2',
+                                              sha256=digest, dst=Path(dst),
+                                              progress=lambda done, total: progress.append(done))
+            self.assertEqual(os.listdir(dst), ['slask.py'])
+            self.assertTrue(progress)
+
+        with tempfile.TemporaryDirectory() as dst:
+            with self.assertRaises(utils.ChecksumMismatchError):
+                utils.fetch_and_extract_nextcloud('http://localhost:8081/nextcloud.tar.bz2',
+                                                  sha256='0' * 64, dst=Path(dst))
+            self.assertEqual(os.listdir(dst), [])
+
+    def test_get_status_php(self) -> None:
+        """
+        Test the status.php probe, served here from tests/status.json.
+        """
+        status = utils.get_status_php('http://localhost:8081/status.json')
+        self.assertEqual(status['version'], '28.0.1.1')
+        self.assertTrue(utils.wait_for_status_php('http://localhost:8081/status.json', timeout=1))
+        self.assertIsNone(utils.get_status_php('http://localhost:8081/nextcloud.tar.bz2'))
+        self.assertIsNone(utils.get_status_php('http://localhost:8081/missing.php'))
+
+    def test_wait_for_status_php_times_out(self) -> None:
+        """
+        Test that the readiness probe gives up after its timeout.
+        """
+        self.assertFalse(utils.wait_for_status_php('http://localhost:8081/status.php',
+                                                   timeout=1, interval=0.2))
+
+
+class TestIsLocalAddress(unittest.TestCase):
+    """
+    Unittests for detecting co-located services.
+    """
+
+    def test_is_local_address(self) -> None:
+        self.assertTrue(utils.is_local_address('127.0.0.1'))
+        self.assertTrue(utils.is_local_address('localhost'))
+        self.assertFalse(utils.is_local_address('192.0.2.1'))
+        self.assertFalse(utils.is_local_address('no-such-host.invalid'))
+
+
+class TestPlanTrustedProxies(unittest.TestCase):
+    """
+    Unittests for the trusted_proxies reconciliation plan.
+    """
+
+    def test_join_adds_one_slot(self) -> None:
+        current = {0: '10.0.0.1', 1: '10.0.0.2'}
+        plan = utils.plan_trusted_proxies(current, ['10.0.0.1', '10.0.0.2', '10.0.0.3'])
+        self.assertEqual(plan, ([(2, '10.0.0.3')], []))
+
+    def test_depart_deletes_one_slot(self) -> None:
+        current = {0: '10.0.0.1', 1: '10.0.0.2', 2: '10.0.0.3'}
+        plan = utils.plan_trusted_proxies(current, ['10.0.0.1', '10.0.0.3'])
+        self.assertEqual(plan, ([], [1]))
+
+    def test_replacement_reuses_slot(self) -> None:
+        current = {0: '10.0.0.1', 1: '10.0.0.2', 2: '10.0.0.2'}
+        plan = utils.plan_trusted_proxies(current, ['10.0.0.4', '10.0.0.2'])
+        self.assertEqual(plan, ([(0, '10.0.0.4')], [2]))
+
+
+class TestFixOwnership(unittest.TestCase):
+    """
+    Unittests for the incremental ownership fixer.
+    """
+
+    @unittest.skipUnless(os.geteuid() == 0, "changing ownership needs root")
+    def test_only_changes_differing_entries(self) -> None:
+        with tempfile.TemporaryDirectory() as tmp:
+            root = Path(tmp)
+            for d in ['config', 'apps/files', 'data/admin']:
+                (root / d).mkdir(parents=True)
+                (root / d / 'file').touch()
+            (root / 'apps' / 'link').symlink_to('/etc/hostname')
+
+            # root, config, apps, apps/files, 2 files and a symlink
+            self.assertEqual(utils.fix_ownership([root], 1, 1, exclude=[root / 'data']), 7)
+            self.assertEqual(utils.fix_ownership([root], 1, 1, exclude=[root / 'data']), 0)
+            self.assertEqual((root / 'data' / 'admin').stat().st_uid, 0)
+            self.assertEqual(os.stat('/etc/hostname').st_uid, 0)
+            self.assertEqual(utils.fix_ownership([root / 'data'], 1, 1), 3)
+
+    def test_nested_paths_walked_once(self) -> None:
+        with tempfile.TemporaryDirectory() as tmp:
+            root = Path(tmp)
+            (root / 'data' / 'admin').mkdir(parents=True)
+            with mock.patch('os.scandir', wraps=os.scandir) as scandir:
+                utils.fix_ownership([root, root / 'data'], os.getuid(), os.getgid())
+            # root, data and data/admin
+            self.assertEqual(scandir.call_count, 3)
+
 
 if __name__ == '__main__':
     unittest.main()